@@ -13,12 +13,13 @@
 #
 # Backup data.db before running on live data
 
-from flask import Flask, render_template_string, request, jsonify, redirect, url_for, flash, send_file
+from flask import Flask, render_template_string, request, jsonify, redirect, url_for, flash, g, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask_cors import CORS
 from datetime import datetime, timedelta, date
 from decimal import Decimal, ROUND_HALF_UP, getcontext, InvalidOperation
-import io, csv, os, sqlite3, json
+import io, csv, os, sqlite3, json, bisect, functools, collections
 import requests
 import yfinance as yf
 import numpy as np
@@ -28,6 +29,12 @@ from statsmodels.tsa.arima.model import ARIMA
 from statsmodels.tsa.arima_model import ARIMAResults
 from datetime import datetime, timedelta, date
 import threading
+from cgt_trace import Tracer
+import cgt_archive
+import cgt_blob
+from cgt_engine import (CGTEngine, Checkpoint, TaxSettings, VestingRecord, EsppRecord, SaleRecord, FxRecord, FxTable, LotStore,
+                        REPLAY_LOOKBACK, safe_decimal, q2, q6, get_aea, tax_year_of, build_fragment_detail_struct,
+                        render_equations, render_explanation, equation_snippet, SNIPPET_EQUATIONS, summarise_tax_year, summarise_all_years, allocate_cgt, pool_at)
 
 # Optional imports for advanced predictions (fallback if missing)
 try:
@@ -67,13 +74,22 @@ from statistics import mean
 getcontext().prec = 50
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "data.db")
+DB_PATH = os.environ.get("CGT_DB_PATH") or os.path.join(BASE_DIR, "data.db")
 DB_URI = f"sqlite:///{DB_PATH}"
 DATE_FMT = "%Y-%m-%d"
 
-# Global lock for recalc to prevent concurrent runs
+# One non-hypothetical recalc builds a run at a time in this process (see _recalc_all); start_run
+# and publish_run guard against runs built by other processes
 recalc_lock = threading.Lock()
 
+# JSON export of the most recent traced recalc (CGT_TRACE=info|debug); see cgt_trace
+last_recalc_trace = None
+
+# Incremental replay: persist lot balances every N sales; a change dated D replays
+# from the last checkpoint strictly before D - REPLAY_LOOKBACK (30-day forward matching; a
+# checkpoint dated exactly then may sit between two sales that day, both inside the window).
+CHECKPOINT_INTERVAL = 25
+
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = DB_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -82,6 +98,17 @@ db = SQLAlchemy(app)
 CORS(app)
 
 # ---------- Models ----------
+class CompressedText(db.TypeDecorator):
+    """Text column stored as a cgt_blob (version byte + zlib/zstd); legacy TEXT rows read back unchanged."""
+    impl = db.LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return cgt_blob.encode(value)
+
+    def process_result_value(self, value, dialect):
+        return cgt_blob.decode(value)
+
 class Setting(db.Model):
     __tablename__ = "settings"
     key = db.Column(db.String(64), primary_key=True)
@@ -90,7 +117,7 @@ class Setting(db.Model):
 class ExchangeRate(db.Model):
     __tablename__ = "exchange_rates"
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.Date, nullable=False, index=True)
+    date = db.Column(db.Date, nullable=False, index=True, unique=True)
     description = db.Column(db.String(200))
     usd_gbp = db.Column(db.Numeric(28,12), nullable=False)  # USD per GBP
     notes = db.Column(db.String(200))
@@ -133,12 +160,21 @@ class SaleInput(db.Model):
     sale_price_usd = db.Column(db.Numeric(28,12))
     exchange_rate = db.Column(db.Numeric(28,12), nullable=True)
     incidental_costs_gbp = db.Column(db.Numeric(28,12), default=Decimal("0"))
+    tax_year = db.Column(db.Integer, index=True)  # tax_year_of(date), kept in step by set_tax_year
+
+    @db.validates("date")
+    def set_tax_year(self, key, value):
+        self.tax_year = tax_year_of(value) if value else None
+        return value
 
 class DisposalResult(db.Model):
     __tablename__ = "disposal_results"
     id = db.Column(db.Integer, primary_key=True)
-    sale_date = db.Column(db.Date, index=True)
-    sale_input_id = db.Column(db.Integer)
+    calc_run_id = db.Column(db.Integer, nullable=False, index=True)
+    superseded_run_id = db.Column(db.Integer, index=True)
+    sale_date = db.Column(db.Date)
+    tax_year = db.Column(db.Integer)  # tax_year_of(sale_date), kept in step by set_tax_year
+    sale_input_id = db.Column(db.Integer, index=True)
     matched_date = db.Column(db.Date)
     matching_type = db.Column(db.String(32))
     matched_shares = db.Column(db.Numeric(28,12))
@@ -147,14 +183,32 @@ class DisposalResult(db.Model):
     cost_basis_gbp = db.Column(db.Numeric(28,12))
     gain_gbp = db.Column(db.Numeric(28,12))
     cgt_due_gbp = db.Column(db.Numeric(28,12))
-    calculation_json = db.Column(db.Text)
+    calculation_json = db.Column(CompressedText)
+    # Listing columns copied out of calculation_json when the row is written; "\n"-joined first equations
+    fragment_index = db.Column(db.Integer)
+    lot_entry = db.Column(db.String(32))
+    lot_source = db.Column(db.String(16))
+    rate_used = db.Column(db.String(40))
+    equation_snippet = db.Column(db.Text)
+    # Listing order (sale_date, id), overall and within a tax year; runs share rows, so the run
+    # filter (see visible_in) is checked on each row as the index is walked
+    __table_args__ = (db.Index("ix_disposal_results_sale_date_id", "sale_date", "id"),
+                      db.Index("ix_disposal_results_year_sale_date_id", "tax_year", "sale_date", "id"),
+                      db.Index("ix_disposal_results_lot_entry", "lot_entry"))
+
+    @db.validates("sale_date")
+    def set_tax_year(self, key, value):
+        self.tax_year = tax_year_of(value) if value else None
+        return value
 
 class PoolSnapshot(db.Model):
     __tablename__ = "pool_snapshot"
     id = db.Column(db.Integer, primary_key=True)
+    calc_run_id = db.Column(db.Integer, nullable=False, index=True)
+    superseded_run_id = db.Column(db.Integer, index=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     tax_year = db.Column(db.Integer, index=True, nullable=True)
-    snapshot_json = db.Column(db.Text)
+    snapshot_json = db.Column(CompressedText)
     total_shares = db.Column(db.Numeric(28,12))
     total_cost_gbp = db.Column(db.Numeric(28,12))
     avg_cost_gbp = db.Column(db.Numeric(28,12))
@@ -162,10 +216,14 @@ class PoolSnapshot(db.Model):
 class CalculationStep(db.Model):
     __tablename__ = "calculation_steps"
     id = db.Column(db.Integer, primary_key=True)
+    calc_run_id = db.Column(db.Integer, nullable=False, index=True)
+    superseded_run_id = db.Column(db.Integer, index=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     sale_input_id = db.Column(db.Integer, nullable=True, index=True)
+    tax_year = db.Column(db.Integer)  # tax year of the step's sale; set by ResultWriter
     step_order = db.Column(db.Integer, nullable=False, index=True)
     message = db.Column(db.Text, nullable=False)
+    __table_args__ = (db.Index("ix_calculation_steps_tax_year", "tax_year"),)
 
 class CarryForwardLoss(db.Model):
     __tablename__ = "carry_forward_losses"
@@ -179,9 +237,71 @@ class CalculationDetail(db.Model):
     disposal_id = db.Column(db.Integer, nullable=False, index=True)
     sale_input_id = db.Column(db.Integer, nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
-    equations = db.Column(db.Text, nullable=False)
+    equations = db.Column(CompressedText, nullable=False)
     explanation = db.Column(db.Text, nullable=False)
 
+class PoolCheckpoint(db.Model):
+    __tablename__ = "pool_checkpoints"
+    id = db.Column(db.Integer, primary_key=True)
+    calc_run_id = db.Column(db.Integer, nullable=False, index=True)
+    superseded_run_id = db.Column(db.Integer, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    as_of_date = db.Column(db.Date, nullable=False, index=True)  # date of the first sale NOT yet applied
+    next_sale_id = db.Column(db.Integer, nullable=False)
+    sales_processed = db.Column(db.Integer, nullable=False, index=True)
+    lots_json = db.Column(db.Text, nullable=False)  # {entry: remaining} for lots dated before as_of_date + 30 days
+    # Exact Decimal strings, like lots_json: a NUMERIC column would come back from SQLite as a float
+    pool_shares = db.Column(db.String(64))
+    pool_cost_gbp = db.Column(db.String(64))
+
+class CalcRun(db.Model):
+    """One non-hypothetical recalc; readers only see the run published through the "current_run" pointer.
+
+    Disposals, snapshots, steps and checkpoints are shared between runs: a row carries the run that
+    wrote it (calc_run_id) and the later run that rebuilt it (superseded_run_id), and is seen by
+    every run in between (see visible_in). Year summaries are small and written per run.
+    """
+    __tablename__ = "calc_runs"
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(16), nullable=False)  # full | partial
+    base_run_id = db.Column(db.Integer)  # run published when this one started; its unchanged rows are shared
+    status = db.Column(db.String(16), nullable=False, default="building")  # building | complete | failed
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+class DataVersion(db.Model):
+    """Generation counters bumped on every change to a cached dataset (e.g. "rates"); see bump_generation.
+    The "current_run" row instead holds the id of the published CalcRun (see publish_run)."""
+    __tablename__ = "data_versions"
+    name = db.Column(db.String(32), primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
+class TaxYearSummary(db.Model):
+    """Materialised per-tax-year totals; rebuilt by refresh_tax_year_summaries after every recalc."""
+    __tablename__ = "tax_year_summaries"
+    calc_run_id = db.Column(db.Integer, primary_key=True)
+    tax_year = db.Column(db.Integer, primary_key=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    disposal_count = db.Column(db.Integer, nullable=False)
+    total_proceeds_gbp = db.Column(db.Numeric(28,12))
+    total_cost_gbp = db.Column(db.Numeric(28,12))
+    total_gain_gbp = db.Column(db.Numeric(28,12))
+    gains_gbp = db.Column(db.Numeric(28,12))
+    losses_gbp = db.Column(db.Numeric(28,12))
+    net_gain_gbp = db.Column(db.Numeric(28,12))
+    excess_loss_gbp = db.Column(db.Numeric(28,12))
+    carry_forward_loss_gbp = db.Column(db.Numeric(28,12))
+    carry_forward_used_gbp = db.Column(db.Numeric(28,12))
+    net_gain_after_losses_gbp = db.Column(db.Numeric(28,12))
+    cgt_allowance_gbp = db.Column(db.Numeric(28,12))
+    non_savings_income_gbp = db.Column(db.Numeric(28,12))
+    basic_threshold_gbp = db.Column(db.Numeric(28,12))
+    basic_band_available_gbp = db.Column(db.Numeric(28,12))
+    taxable_gain_gbp = db.Column(db.Numeric(28,12))
+    basic_taxable_gbp = db.Column(db.Numeric(28,12))
+    higher_taxable_gbp = db.Column(db.Numeric(28,12))
+    estimated_cgt_gbp = db.Column(db.Numeric(28,12))
+
 
 class StockData(db.Model):
     __tablename__ = "stock_data"
@@ -195,6 +315,8 @@ class StockData(db.Model):
     prediction_type = db.Column(db.String(20))
     prediction_json = db.Column(db.Text)
     notes = db.Column(db.String(200))
+    # One cached price per ticker/day, kept apart from predictions for the same day (see upsert_stock_data)
+    __table_args__ = (db.Index("ux_stock_data_ticker_prediction_date", "ticker", "is_prediction", "date", unique=True),)
 
 
 # ---------- Utilities ----------
@@ -207,57 +329,157 @@ def to_date(v):
         return v
     return datetime.strptime(v, DATE_FMT).date()
 
-def safe_decimal(x, default=Decimal("0")):
-    try:
-        if x is None or x == "":
-            return default
-        if isinstance(x, Decimal):
-            return x
-        return Decimal(str(x))
-    except (InvalidOperation, ValueError):
-        return default
-
-def q2(d) -> Decimal:
-    return safe_decimal(d).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-
-def q6(d: Decimal) -> Decimal:
-    return d.quantize(Decimal("0.000001"), rounding=ROUND_HALF_UP)
-
-def get_aea(tax_year):
-    """Get Annual Exempt Amount based on tax year (ending year, e.g., 2024 for 2024/25)"""
-    if tax_year is None:
-        return Decimal("12300")
-    aea_map = {
-        2024: Decimal("3000"),  # 2024/25
-        2023: Decimal("6000"),  # 2023/24
-    }
-    for yr in range(2022, 2020, -1):  # 2022/23 to 2020/21: 12300
-        aea_map[yr] = Decimal("12300")
-    # Default for earlier or future: 12300 pre-2023, 3000 post-2024
-    return aea_map.get(tax_year, Decimal("3000") if tax_year > 2024 else Decimal("12300"))
-
 def load_rates_sorted():
-    rows = ExchangeRate.query.order_by(ExchangeRate.date.asc()).all()
     year_map = {}
-    for r in rows:
-        year_map[r.date.year] = safe_decimal(r.usd_gbp)
+    for d, rate in fx_index().items():
+        year_map[d.year] = rate
     return sorted([(y, year_map[y]) for y in year_map.keys()], key=lambda x: x[0])
 
+# ---------- Data generations (cross-process cache invalidation) ----------
+def current_generation(name):
+    """Generation counter for `name` (0 if never bumped); one primary-key read, never from the identity map."""
+    return db.session.execute(db.select(DataVersion.generation).where(DataVersion.name == name)).scalar() or 0
+
+def bump_generation(name):
+    """Atomically increment the `name` generation in the caller's transaction; the caller commits."""
+    db.session.execute(sqlite_insert(DataVersion).values(name=name, generation=1).on_conflict_do_update(
+        index_elements=[DataVersion.name], set_={"generation": DataVersion.generation + 1}))
+
+# Every write that can change what the read APIs return (inputs, settings, rates, a published
+# run) bumps the "data" generation in its own transaction; the read endpoints tag responses with
+# it, so a client holding the current tag gets a 304 after a single primary-key read.
+DATA_VERSION = "data"
+RESPONSE_CACHE_SIZE = 256  # read-API responses kept per process
+
+class ResponseCache:
+    """LRU of read-API response bodies keyed by (endpoint, arguments, data version), with hit/miss counters.
+
+    Keys carry the data version, so a write in any process makes older entries unreachable;
+    data_changed() also clears this process's entries straight away to free them.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "entries": len(self.entries), "capacity": self.capacity, "invalidations": self.invalidations}
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+def data_changed():
+    """Call before committing any change served by the read APIs: bumps the "data" generation and
+    drops this process's cached responses."""
+    bump_generation(DATA_VERSION)
+    response_cache.clear()
+
+def data_etag():
+    """ETag value for the read APIs' view of the data (sent weak: JSON bodies are not byte-stable)."""
+    return f"data-{current_generation(DATA_VERSION)}"
+
+def versioned_response(view):
+    """Tag a read endpoint's 200 responses with data_etag(), answer a matching If-None-Match with
+    304 and serve repeat requests from response_cache; neither path queries the results tables."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = data_etag()
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(sorted(request.args.items(multi=True))), etag)
+            cached = response_cache.get(key)
+            if cached is not None:
+                response = app.response_class(cached[0], mimetype=cached[1])
+            else:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                response_cache.put(key, (response.get_data(), response.mimetype))
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "no-cache"  # always revalidate; the 304 is the cheap path
+        return response
+    return wrapper
+
+# In-memory FX index: every ExchangeRate row as a sorted FxTable, tagged with the "rates"
+# generation it was loaded at. Each process re-checks the generation once per request (app
+# context) and reloads only when another process, or this one, has changed the rates.
+_fx_index = None  # (generation, FxTable)
+
+def fx_index():
+    """FxTable over all stored rates (nearest date, earlier wins ties; first row per date wins)."""
+    global _fx_index
+    if _fx_index is not None and g.get("rates_generation") == _fx_index[0]:
+        return _fx_index[1]
+    generation = current_generation("rates")  # read before the rows: a concurrent bump only costs a reload
+    if _fx_index is None or _fx_index[0] != generation:
+        _fx_index = (generation, FxTable(FxRecord.from_row(r) for r in ExchangeRate.query.order_by(ExchangeRate.date.asc(), ExchangeRate.id.asc())))
+    g.rates_generation = generation
+    return _fx_index[1]
+
+def invalidate_fx_index():
+    """Drop this process's index (e.g. after switching databases); other processes are unaffected."""
+    global _fx_index
+    _fx_index = None
+
+def rates_changed(added=None, since=None):
+    """Call before committing any ExchangeRate add/edit/delete/upload: bumps the shared generation.
+
+    When the change only inserted new dates, pass them as `added` (FxRecords): a current index
+    is patched in place of a full reload, recomputing just the calendar days around each date.
+    `since` is the earliest rate date touched: pool checkpoints after the rate stored before it
+    were costed at the old rates and are discarded (all of them when it is not given).
+    """
+    global _fx_index
+    previous = None
+    if since is not None:  # days up to the previous rate still resolve to it or an earlier one
+        previous = db.session.query(db.func.max(ExchangeRate.date)).filter(ExchangeRate.date < since).scalar()
+    discard_checkpoints(after=previous)
+    if added is not None:  # as the rows read back: rounded to the column's scale
+        quantum = Decimal(1).scaleb(-ExchangeRate.usd_gbp.type.scale)
+        added = [FxRecord(r.date, safe_decimal(r.usd_gbp).quantize(quantum)) for r in added]
+    before = current_generation("rates")
+    bump_generation("rates")
+    data_changed()
+    if added is not None and _fx_index is not None and _fx_index[0] == before:
+        _fx_index = (before + 1, _fx_index[1].with_rates(added))
+        g.rates_generation = before + 1
+    else:
+        invalidate_fx_index()
+
 def get_rate_for_date(target_date, rates_list):
     if target_date is None:
         return Decimal("1")
-    # First, try exact date from DB
-    exact_rate = ExchangeRate.query.filter_by(date=target_date).first()
-    if exact_rate:
-        return safe_decimal(exact_rate.usd_gbp)
-    # Fallback to closest date in DB
-    # Find the rate with the smallest date difference, ordered by date for consistency
-    closest_rate = ExchangeRate.query.order_by(
-        db.func.abs(db.func.julianday(ExchangeRate.date) - db.func.julianday(target_date)),
-        ExchangeRate.date.asc()
-    ).first()
-    if closest_rate:
-        return safe_decimal(closest_rate.usd_gbp)
+    # Exact or nearest stored rate, from the cached daily calendar
+    fx = fx_index()
+    if len(fx):
+        return fx.rate_for(target_date)
     # If no rates in DB, fallback to year-based from loaded rates
     year = target_date.year
     if not rates_list:
@@ -273,476 +495,503 @@ def get_rate_for_date(target_date, rates_list):
         return later[0][1]
     return Decimal("1")
 
-def build_fragment_detail_struct(sale_price_usd: Decimal, lot, qty, rate_for_sale, fragment_index):
-    sale_price_usd = safe_decimal(sale_price_usd)
-    qty = safe_decimal(qty)
-    lot_usd_total = safe_decimal(lot.get("usd_total")) if lot.get("usd_total") is not None else None
-    lot_rate_used = safe_decimal(lot.get("rate_used")) if lot.get("rate_used") is not None else None
-    lot_paye = safe_decimal(lot.get("paye")) if lot.get("paye") is not None else Decimal("0")
-
-    proceeds_per_share_gbp = (sale_price_usd / safe_decimal(rate_for_sale)) if safe_decimal(rate_for_sale) != 0 else sale_price_usd
-    proceeds_total = q2(proceeds_per_share_gbp * qty)
-
-    cost_per_share_used = q2(safe_decimal(lot["avg_cost"]))
-    cost_total = q2(cost_per_share_used * qty)
-
-    equations = []
-    equations.append(f"Proceeds per share (GBP) = round(sale_price_usd / rate) = round({sale_price_usd} / {rate_for_sale}) = {q2(proceeds_per_share_gbp)}")
-    equations.append(f"Total proceeds = {q2(proceeds_per_share_gbp)} × {qty} = {proceeds_total}")
-    equations.append(f"Cost per share used = {cost_per_share_used}")
-    equations.append(f"Total cost = {cost_per_share_used} × {qty} = {cost_total}")
-    if lot_usd_total is not None and lot_rate_used is not None:
-        purchase_gbp = q2(lot_usd_total / lot_rate_used) if lot_rate_used != 0 else q2(lot_usd_total)
-        equations.append(f"Lot USD total {lot_usd_total} → GBP = {lot_usd_total} / {lot_rate_used} = {purchase_gbp}")
-        if lot_paye and lot_paye != 0:
-            equations.append(f"PAYE added = £{q2(lot_paye)} → chosen lot total = £{q2(purchase_gbp + lot_paye)}")
-    gain = q2(proceeds_total - cost_total)
-    equations.append(f"Gain = {proceeds_total} − {cost_total} = {gain}")
-
-    numeric_trace = {
-        "sale_price_usd": str(sale_price_usd),
-        "rate_for_sale": str(rate_for_sale),
-        "proceeds_per_share_gbp": str(q2(proceeds_per_share_gbp)),
-        "proceeds_total_gbp": str(proceeds_total),
-        "cost_per_share_gbp": str(cost_per_share_used),
-        "cost_total_gbp": str(cost_total),
-        "gain_gbp": str(gain),
-        "lot_usd_total": str(lot_usd_total) if lot_usd_total is not None else None,
-        "lot_rate_used": str(lot_rate_used) if lot_rate_used is not None else None,
-        "lot_paye_gbp": str(lot_paye) if lot_paye is not None else None,
-        "shares_matched": str(q6(qty)),
-        "fragment_index": int(fragment_index)
-    }
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+@functools.lru_cache(maxsize=1)
+def _calendar_array(fx):
+    """(first ordinal, object array of the FxTable's per-day rates + a trailing Decimal("1") for missing dates)."""
+    first, calendar = fx.calendar()
+    table = np.empty(len(calendar) + 1, dtype=object)
+    table[:-1] = calendar
+    table[-1] = Decimal("1")
+    return first, table
+
+def resolve_rates(dates):
+    """USD/GBP rate for each of `dates` in one vectorised pass over the daily calendar.
+
+    `dates` is a sequence of dates / datetimes / ISO strings, or a pandas Series (the result is then
+    a Series on the same index). Same nearest-date policy as get_rate_for_date; missing or
+    unparseable dates get Decimal("1").
+    """
+    is_series = isinstance(dates, pd.Series)
+    if is_series and pd.api.types.is_datetime64_any_dtype(dates):
+        values = dates
+    else:
+        values = pd.to_datetime(dates if is_series else pd.Series(list(dates), dtype=object), errors="coerce")
+    missing = values.isna().to_numpy()
+    first, table = _calendar_array(fx_index())
+    calendar = table[:-1]
+    if len(calendar):
+        ordinals = values.to_numpy().astype("datetime64[D]").astype(np.int64) + _EPOCH_ORDINAL
+        idx = np.clip(ordinals - first, 0, len(calendar) - 1)  # before / after the range: first / last rate
+        idx[missing] = len(calendar)
+    else:
+        idx = np.full(len(values), len(calendar), dtype=np.int64)
+    rates = table[idx]
+    return pd.Series(rates, index=dates.index, dtype=object) if is_series else rates.tolist()
+
+# ---------- Calc runs (versioned results) ----------
+# Each non-hypothetical recalc writes its rows under a new CalcRun id, then flips the
+# "current_run" pointer in the same commit as its last rows. Readers filter on the pointer, read
+# once per request, so they keep serving the previous complete run while a new one is built.
+# A run only writes the rows it rebuilds and shares the rest with the runs before it (see
+# visible_in / retire_rows), so a partial recalc costs time in proportion to the sales it replays.
+# Run 0 holds results from before runs were versioned. Old runs are deleted by collect_old_runs.
+CURRENT_RUN = "current_run"
+RUN_RETENTION = 2  # complete runs kept: the current one and the one a slow reader may still be on
+STALE_RUN_AGE = timedelta(hours=1)  # a run still "building" after this is treated as abandoned
+
+def current_run_id():
+    """Id of the published run; read once per request (app context) so one request sees one run."""
+    run_id = g.get("current_run_id")
+    if run_id is None:
+        run_id = g.current_run_id = current_generation(CURRENT_RUN)
+    return run_id
+
+def visible_in(model, run_id):
+    """Filter for the rows of a shared result `model` seen by run `run_id`: written by it or an
+    earlier run, and not yet rebuilt by it. (coalesce, rather than an OR, keeps the planner on the
+    ordering indexes.)"""
+    return db.and_(model.calc_run_id <= run_id, db.func.coalesce(model.superseded_run_id, run_id + 1) > run_id)
+
+def run_rows(model, run_id=None):
+    """`model.query` restricted to one run's rows (default: the published run)."""
+    run_id = current_run_id() if run_id is None else run_id
+    if model is TaxYearSummary:
+        return model.query.filter(model.calc_run_id == run_id)
+    return model.query.filter(visible_in(model, run_id))
+
+def run_tax_years(run_id=None, with_sales=False):
+    """Sorted tax years with disposals in the run, plus (`with_sales`) any year with a stored sale."""
+    years = db.select(DisposalResult.tax_year).where(visible_in(DisposalResult, current_run_id() if run_id is None else run_id),
+                                                     DisposalResult.tax_year.is_not(None))
+    if with_sales:
+        years = db.union(years, db.select(SaleInput.tax_year).where(SaleInput.tax_year.is_not(None)))
+    else:
+        years = years.distinct()
+    return sorted(db.session.scalars(years))
+
+class RunConflictError(RuntimeError):
+    """Another run is being built, or was published after this run started."""
+
+def start_run(kind):
+    """Commit a new "building" CalcRun based on the published run and return it.
+
+    Raises RunConflictError while another run (say, from another process) is still building; the
+    check and the insert are one statement, so two callers cannot both pass it.
+    """
+    base_run_id = current_generation(CURRENT_RUN)
+    started_at = datetime.utcnow()
+    abandon_runs(started_at - STALE_RUN_AGE)
+    building = db.select(CalcRun.id).where(CalcRun.status == "building", CalcRun.started_at > started_at - STALE_RUN_AGE)
+    inserted = db.session.execute(db.insert(CalcRun).from_select(
+        ["kind", "base_run_id", "status", "started_at"],
+        db.select(db.literal(kind), db.literal(base_run_id), db.literal("building"), db.literal(started_at)).where(~building.exists())))
+    if not inserted.rowcount:
+        db.session.rollback()
+        raise RunConflictError("Another recalc is in progress; try again when it has finished")
+    db.session.commit()
+    return db.session.get(CalcRun, inserted.lastrowid)
+
+def publish_run(run):
+    """Mark `run` complete and point readers at it, in the caller's transaction; the caller commits.
+
+    Raises RunConflictError if the published run is no longer the one `run` was built on: publishing
+    it would drop whatever that newer run changed.
+    """
+    pointer = db.update(DataVersion).where(DataVersion.name == CURRENT_RUN, DataVersion.generation == run.base_run_id).values(generation=run.id)
+    if not db.session.execute(pointer).rowcount:
+        published = current_generation(CURRENT_RUN)
+        if published != run.base_run_id:
+            raise RunConflictError(f"Run {run.id} was built on run {run.base_run_id}, but run {published} has been published since")
+        db.session.add(DataVersion(name=CURRENT_RUN, generation=run.id))  # first run published
+    run.status, run.finished_at = "complete", datetime.utcnow()
+    data_changed()
+    g.current_run_id = run.id
+
+SHARED_RESULTS = (DisposalResult, CalculationStep, PoolSnapshot, PoolCheckpoint)
+
+def retire_rows(run_id, replayed_sales=None, checkpoint=None):
+    """Mark the rows run `run_id` rebuilds as superseded by it, SQL-side; every other row stays shared.
+
+    replayed_sales: None for a full recalc, which rebuilds every row; otherwise a select of the
+    SaleInput ids a partial recalc replays. Their disposals and steps are rebuilt (and those of
+    deleted sales dropped), as are the checkpoints from the one the replay resumes from; snapshots
+    only by full recalcs. The caller commits.
+    """
+    def retire(model, *where):
+        db.session.execute(db.update(model).where(model.superseded_run_id.is_(None), model.calc_run_id < run_id, *where)
+                           .values(superseded_run_id=run_id).execution_options(synchronize_session=False))
+
+    if replayed_sales is None:
+        for model in SHARED_RESULTS:
+            retire(model)
+        return
+    stored = db.select(SaleInput.id)
+    retire(DisposalResult, db.or_(DisposalResult.sale_input_id.in_(replayed_sales), DisposalResult.sale_input_id.not_in(stored)))
+    retire(CalculationStep, db.or_(CalculationStep.sale_input_id.in_(replayed_sales), CalculationStep.sale_input_id.not_in(stored)))
+    retire(PoolCheckpoint, *([PoolCheckpoint.sales_processed >= checkpoint.sales_processed] if checkpoint else []))
+
+def claim_rows(model, run_id, *where):
+    """Copy-on-write before run `run_id` updates rows in place: each shared row matching `where` is
+    replaced by a copy the run owns. The caller commits."""
+    cols = [c for c in model.__table__.columns if c.name not in ("id", "calc_run_id", "superseded_run_id")]
+    shared = db.and_(visible_in(model, run_id), model.calc_run_id < run_id, *where)
+    db.session.execute(db.insert(model).from_select([c.name for c in cols] + ["calc_run_id"], db.select(*cols, db.literal(run_id)).where(shared)))
+    db.session.execute(db.update(model).where(shared).values(superseded_run_id=run_id).execution_options(synchronize_session=False))
+
+def purge_run(run_id):
+    """Delete an unpublished run's rows and hand the rows it superseded back to the runs before it; the caller commits."""
+    CalculationDetail.query.filter(CalculationDetail.disposal_id.in_(db.select(DisposalResult.id).where(DisposalResult.calc_run_id == run_id))) \
+        .delete(synchronize_session=False)
+    for model in SHARED_RESULTS:
+        model.query.filter(model.calc_run_id == run_id).delete(synchronize_session=False)
+        model.query.filter(model.superseded_run_id == run_id).update({"superseded_run_id": None}, synchronize_session=False)
+    TaxYearSummary.query.filter(TaxYearSummary.calc_run_id == run_id).delete(synchronize_session=False)
+
+def abandon_runs(started_before):
+    """Mark runs still building that started before `started_before` failed and purge them; the caller commits."""
+    for run in CalcRun.query.filter(CalcRun.status == "building", CalcRun.started_at < started_before):
+        purge_run(run.id)
+        run.status = "failed"
+
+def collect_old_runs():
+    """Delete the runs other than the newest RUN_RETENTION complete runs, the published run and runs still
+    building, with the rows none of the kept runs can see; returns the number of runs removed."""
+    published = current_generation(CURRENT_RUN)
+    kept = {published}
+    kept.update(db.session.execute(db.select(CalcRun.id).where(CalcRun.status == "complete")
+                                   .order_by(CalcRun.id.desc()).limit(RUN_RETENTION)).scalars())
+    abandon_runs(datetime.utcnow() - STALE_RUN_AGE)
+    # A row superseded by the oldest kept run or earlier is seen by none of them
+    oldest = min(kept)
+    doomed = db.select(DisposalResult.id).where(DisposalResult.superseded_run_id <= oldest)
+    CalculationDetail.query.filter(CalculationDetail.disposal_id.in_(doomed)).delete(synchronize_session=False)
+    for model in SHARED_RESULTS:
+        model.query.filter(model.superseded_run_id <= oldest).delete(synchronize_session=False)
+    building = db.select(CalcRun.id).where(CalcRun.status == "building")
+    TaxYearSummary.query.filter(TaxYearSummary.calc_run_id.not_in(kept), TaxYearSummary.calc_run_id.not_in(building)).delete(synchronize_session=False)
+    removed = CalcRun.query.filter(CalcRun.id.not_in(kept), CalcRun.status != "building").delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
+def _collect_old_runs_in_background():
+    with app.app_context():
+        try:
+            collect_old_runs()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Run GC failed: {e}")
+
+def schedule_run_gc():
+    """Collect old runs off the request thread (inline under TESTING, where the database is per-connection)."""
+    if app.config.get("TESTING"):
+        collect_old_runs()
+    else:
+        threading.Thread(target=_collect_old_runs_in_background, name="run-gc", daemon=True).start()
+
+# ---------- Engine inputs from the database ----------
+def load_tax_settings(tax_year=None):
+    sa = db.session.get(Setting, "CGT_Allowance"); sc = db.session.get(Setting, "NonSavingsIncome"); sd = db.session.get(Setting, "BasicBandThreshold")
+    return TaxSettings(
+        allowance=safe_decimal(sa.value) if sa and safe_decimal(sa.value) > 0 and (tax_year is None or tax_year < 2024) else get_aea(tax_year),
+        non_savings_income=safe_decimal(sc.value) if sc else Decimal("0"),
+        basic_threshold=safe_decimal(sd.value) if sd else Decimal("37700"),
+    )
+
+def engine_from_db(tax_year=None):
+    """CGTEngine over every stored vesting, ESPP purchase and FX rate, detached from the session."""
+    return CGTEngine(
+        vestings=[VestingRecord.from_row(v) for v in Vesting.query.order_by(Vesting.date.asc(), Vesting.id.asc())],
+        espp=[EsppRecord.from_row(p) for p in ESPPPurchase.query.order_by(ESPPPurchase.date.asc(), ESPPPurchase.id.asc())],
+        fx_rates=fx_index(),
+        settings=load_tax_settings(tax_year),
+    )
+
+# ---------- Materialised tax-year summaries ----------
+def summarise_years_from_db(disposals=None, years=(), run_id=None):
+    """summarise_all_years over `disposals` (default: every DisposalResult of the run) with stored settings and losses."""
+    if disposals is None:
+        disposals = run_rows(DisposalResult, run_id).with_entities(DisposalResult.sale_date, DisposalResult.proceeds_gbp,
+                                                       DisposalResult.cost_basis_gbp, DisposalResult.gain_gbp).all()
+    losses = {loss.tax_year: safe_decimal(loss.amount) for loss in CarryForwardLoss.query}
+    return summarise_all_years(disposals, load_tax_settings, losses, years=years)
+
+def tax_year_summary_row(ys, run_id=None):
+    t = ys.tax
+    return TaxYearSummary(
+        calc_run_id=run_id, tax_year=ys.tax_year, disposal_count=ys.disposal_count, total_proceeds_gbp=ys.total_proceeds, total_cost_gbp=ys.total_cost,
+        total_gain_gbp=ys.total_gain, gains_gbp=t.pos, losses_gbp=t.neg, net_gain_gbp=t.net_gain, excess_loss_gbp=t.excess_loss,
+        carry_forward_loss_gbp=t.carry_forward_loss, carry_forward_used_gbp=ys.carry_forward_used, net_gain_after_losses_gbp=t.net_gain_after_losses,
+        cgt_allowance_gbp=t.settings.allowance, non_savings_income_gbp=t.settings.non_savings_income, basic_threshold_gbp=t.settings.basic_threshold,
+        basic_band_available_gbp=t.settings.basic_band_available, taxable_gain_gbp=t.taxable_gain, basic_taxable_gbp=t.basic_taxable,
+        higher_taxable_gbp=t.higher_taxable, estimated_cgt_gbp=t.estimated_cgt)
+
+def refresh_tax_year_summaries(disposals=None, run_id=None):
+    """Replace the run's TaxYearSummary rows (default: the published run); the caller commits."""
+    run_id = current_run_id() if run_id is None else run_id
+    run_rows(TaxYearSummary, run_id).delete()
+    db.session.add_all([tax_year_summary_row(ys, run_id) for ys in summarise_years_from_db(disposals, run_id=run_id).values()])
+
+def get_tax_year_summary(year):
+    """TaxYearSummary for `year`; a year without disposals gets an unsaved all-zero row.
+
+    A database from before the table existed is backfilled on first read.
+    """
+    run_id = current_run_id()
+    row = db.session.get(TaxYearSummary, (run_id, year))
+    if row is None and run_rows(TaxYearSummary).first() is None and run_rows(DisposalResult).first() is not None:
+        refresh_tax_year_summaries()
+        db.session.commit()
+        row = db.session.get(TaxYearSummary, (run_id, year))
+    if row is None:
+        row = tax_year_summary_row(summarise_years_from_db([], years=(year,))[year])
+    return row
+
+# ---------- Columnar archive of closed tax years (see cgt_archive) ----------
+ARCHIVE_DIR = os.environ.get("CGT_ARCHIVE_DIR") or os.path.join(BASE_DIR, "archive")
+
+def archive_tax_years(years=None, directory=None):
+    """Write each closed tax year's disposals (default: every closed year with any) to the archive.
+
+    A tax year is closed once today falls in a later one. Returns [(tax_year, fragments, path)].
+    Re-run after a recalc that changes a closed year; reads never fall back to the database.
+    """
+    directory = directory or ARCHIVE_DIR
+    current = tax_year_of(date.today())
+    if years is None:
+        years = run_tax_years()
+    written = []
+    for year in years:
+        if year >= current:
+            continue
+        rows = run_rows(DisposalResult).filter(DisposalResult.tax_year == year).order_by(DisposalResult.sale_date, DisposalResult.id).all()
+        if rows:
+            written.append((year, len(rows), cgt_archive.write_year(directory, year, [cgt_archive.flatten(r, year) for r in rows])))
+    return written
+
+# ---------- Pool checkpoints (incremental replay) ----------
+def load_replay_checkpoint(changed_from, run_id=None):
+    """Return the run's latest Checkpoint usable for a change dated `changed_from`, or None."""
+    cp = run_rows(PoolCheckpoint, run_id).filter(PoolCheckpoint.as_of_date < changed_from - REPLAY_LOOKBACK) \
+        .order_by(PoolCheckpoint.sales_processed.desc()).first()
+    if not cp:
+        return None
+    return Checkpoint(id=cp.id, as_of_date=cp.as_of_date, next_sale_id=cp.next_sale_id, sales_processed=cp.sales_processed,
+                      balances=tuple(json.loads(cp.lots_json).items()),
+                      pool_shares=safe_decimal(cp.pool_shares), pool_cost_gbp=safe_decimal(cp.pool_cost_gbp))
+
+def discard_checkpoints(after=None):
+    """Delete every run's checkpoints dated after `after` (all when None) once the inputs they were
+    built from change under them. They are only a replay cache: the next partial recalc resumes from
+    an earlier one, or replays in full. The caller commits."""
+    stale = PoolCheckpoint.query
+    if after is not None:
+        stale = stale.filter(PoolCheckpoint.as_of_date > after)
+    stale.delete(synchronize_session=False)
+
+# ---------- Result persistence ----------
+class ResultWriter:
+    """Persistence sink: buffers one recalc run's DisposalResult / CalculationDetail / CalculationStep rows,
+    tagged with `run_id` (default: the published run).
+
+    `commit` inserts everything in a single transaction; a single flush assigns the
+    disposal ids that CalculationDetail rows need, instead of committing row by row.
+    Engine results only carry numeric traces; equation text is rendered per request by
+    `rendered_trace`, so `add_result` writes no CalculationDetail rows.
+    """
 
-    return {"equations": equations, "numeric_trace": numeric_trace}
+    def __init__(self, run_id=None):
+        self.run_id = current_run_id() if run_id is None else run_id
+        self.disposals = []
+        self.details = []  # (DisposalResult, CalculationDetail kwargs)
+        self.steps = []
+
+    def add_disposal(self, dr, equations=None, explanation=None):
+        dr.calc_run_id = self.run_id
+        self.disposals.append(dr)
+        if equations is not None:
+            self.details.append((dr, {"sale_input_id": dr.sale_input_id, "equations": equations, "explanation": explanation}))
+
+    def add_step(self, step):
+        step.calc_run_id = self.run_id
+        self.steps.append(step)
+
+    def add_result(self, result, explain=False):
+        """Queue rows for an EngineResult; steps are only stored when `explain` is set."""
+        for d in result.disposals:
+            dr = DisposalResult(sale_date=d.sale_date, sale_input_id=d.sale_id, matched_date=d.matched_date, matching_type=d.matching_type,
+                                matched_shares=d.matched_shares, avg_cost_gbp=d.avg_cost_gbp, proceeds_gbp=d.proceeds_gbp,
+                                cost_basis_gbp=d.cost_basis_gbp, gain_gbp=d.gain_gbp, cgt_due_gbp=Decimal("0"), calculation_json=d.calculation_json,
+                                fragment_index=d.fragment_index or None, lot_entry=d.lot_entry, lot_source=d.lot_source, rate_used=d.rate_used,
+                                equation_snippet="\n".join(d.equation_snippet))
+            self.add_disposal(dr)
+        if explain:
+            years = {d.sale_id: tax_year_of(d.sale_date) for d in result.disposals}
+            unmatched = {st.sale_input_id for st in result.steps if st.sale_input_id is not None} - years.keys()
+            if unmatched:
+                years.update(db.session.execute(db.select(SaleInput.id, SaleInput.tax_year).where(SaleInput.id.in_(unmatched))).tuples())
+            for st in result.steps:
+                self.add_step(CalculationStep(sale_input_id=st.sale_input_id, tax_year=years.get(st.sale_input_id), step_order=st.step_order, message=st.message))
+        for cp in result.checkpoints:
+            db.session.add(PoolCheckpoint(calc_run_id=self.run_id, as_of_date=cp.as_of_date, next_sale_id=cp.next_sale_id, sales_processed=cp.sales_processed,
+                                          lots_json=json.dumps({entry: str(remaining) for entry, remaining in cp.balances}),
+                                          pool_shares=str(cp.pool_shares), pool_cost_gbp=str(cp.pool_cost_gbp)))
+
+    def commit(self):
+        db.session.add_all(self.disposals)
+        db.session.add_all(self.steps)
+        db.session.flush()
+        db.session.add_all([CalculationDetail(disposal_id=dr.id, **kw) for dr, kw in self.details])
+        db.session.commit()
+        written = len(self.disposals)
+        self.disposals, self.details, self.steps = [], [], []
+        return written
 
 # ---------- Core matching & snapshot logic (enhanced) ----------
-def recalc_all(explain=False, tax_year_filter=None, sale_filter=None, hypothetical=False, sales_all=None):
+def recalc_all(explain=False, tax_year_filter=None, sale_filter=None, hypothetical=False, sales_all=None, tracer=None):
     """
+    Load inputs, run CGTEngine over them and persist the result through ResultWriter.
     sale_filter: Optional list of sale_input_ids or date_from (str 'YYYY-MM-DD') to recompute only affected sales.
-    If None, full recalc (default).
+    If None, full recalc (default). Partial runs restore lot balances from the last PoolCheckpoint
+    on or before (earliest change - 30 days) and replay only the sales after it.
     hypothetical: If True, simulate without DB writes (for optimization).
     sales_all: For hypothetical mode, provide list of SaleInput-like objects; otherwise ignored.
+    tracer: cgt_trace.Tracer for this run; defaults to one configured from CGT_TRACE. When tracing is
+    on, the JSON export is returned under "trace" and kept for /api/recalc/trace.
     """
+    global last_recalc_trace
+    tracer = tracer or Tracer.from_env()
+    with tracer.span("recalc"):
+        result = _recalc_all(explain, tax_year_filter, sale_filter, hypothetical, sales_all, tracer)
+    if tracer.info:
+        result["trace"] = last_recalc_trace = tracer.export()
+        if os.environ.get("CGT_TRACE_DIR"):
+            tracer.write(os.environ["CGT_TRACE_DIR"])
+    return result
+
+def _recalc_all(explain, tax_year_filter, sale_filter, hypothetical, sales_all, tracer):
     if hypothetical:
-        full_mode = False
-        if sales_all is not None:
-            sales_all = sales_all
-        else:
+        if sales_all is None:
             sales_all = SaleInput.query.order_by(SaleInput.date.asc(), SaleInput.id.asc()).all()
-    else:
+        return _run_recalc(None, False, None, explain, tax_year_filter, sales_all, tracer)
+    if sale_filter is not None and not isinstance(sale_filter, (list, str)):
+        raise ValueError("sale_filter must be list of IDs or date string")
+    # Runs are built one at a time, each on the run published before it
+    with recalc_lock:
+        return _build_run(explain, tax_year_filter, sale_filter, tracer)
+
+def _build_run(explain, tax_year_filter, sale_filter, tracer):
+    run = start_run("full" if sale_filter is None else "partial")
+    try:
+        checkpoint = None
         if sale_filter is None:
-            # Full recalc: clear all
-            DisposalResult.query.delete()
-            PoolSnapshot.query.delete()
-            CalculationStep.query.delete()
-            CalculationDetail.query.delete()
-            db.session.commit()
+            # Full recalc: every row of the new run is rebuilt
             full_mode = True
             sales_all = SaleInput.query.order_by(SaleInput.date.asc(), SaleInput.id.asc()).all()
+            retire_rows(run.id)
         else:
             full_mode = False
-            # Partial: only delete affected results
+            # Partial: find the earliest changed date, then replay from the checkpoint before it
             if isinstance(sale_filter, list):
-                # Filter by sale IDs
                 affected_sales = SaleInput.query.filter(SaleInput.id.in_(sale_filter)).all()
-                affected_ids = [s.id for s in affected_sales]
-                DisposalResult.query.filter(DisposalResult.sale_input_id.in_(affected_ids)).delete()
-            elif isinstance(sale_filter, str):
-                # Filter by date_from: delete results for sales on/after date
-                date_from = to_date(sale_filter)
-                affected_sales = SaleInput.query.filter(SaleInput.date >= date_from).all()
-                affected_ids = [s.id for s in affected_sales]
-                DisposalResult.query.filter(DisposalResult.sale_input_id.in_(affected_ids)).delete()
+                changed_from = min((s.date for s in affected_sales), default=None)
             else:
-                raise ValueError("sale_filter must be list of IDs or date string")
-            db.session.commit()
-            sales_all = SaleInput.query.order_by(SaleInput.date.asc(), SaleInput.id.asc()).all()
-
-    rates = load_rates_sorted()
-    lots = []
-    explanation = []
-    step_idx = 0
-    errors_present = False
-
-    def log_step(msg, sale_input_id=None):
-        nonlocal step_idx
-        step_idx += 1
-        explanation.append((sale_input_id, step_idx, msg))
-        if explain:
-            cs = CalculationStep(sale_input_id=sale_input_id, step_order=step_idx, message=msg)
-            db.session.add(cs)
-
-    log_step("Building lots from Vestings and ESPP purchases (ordered).")
+                changed_from = to_date(sale_filter)
+            replayed = db.select(SaleInput.id).where(db.false())
+            if changed_from is None:
+                sales_all = []
+            else:
+                checkpoint = load_replay_checkpoint(changed_from, run.base_run_id)
+                replayed = db.select(SaleInput.id)
+                if checkpoint:
+                    replayed = replayed.where(db.or_(
+                        SaleInput.date > checkpoint.as_of_date,
+                        db.and_(SaleInput.date == checkpoint.as_of_date, SaleInput.id >= checkpoint.next_sale_id)
+                    ))
+                sales_all = SaleInput.query.filter(SaleInput.id.in_(replayed)).order_by(SaleInput.date.asc(), SaleInput.id.asc()).all()
+            # Everything the replay does not rebuild stays shared with the published run
+            retire_rows(run.id, replayed, checkpoint)
+        return _run_recalc(run, full_mode, checkpoint, explain, tax_year_filter, sales_all, tracer)
+    except Exception:
+        db.session.rollback()
+        purge_run(run.id)
+        run.status = "failed"
+        db.session.commit()
+        raise
 
-    for v in Vesting.query.order_by(Vesting.date.asc(), Vesting.id.asc()).all():
-        net = safe_decimal(v.net_shares) if v.net_shares is not None else (safe_decimal(v.shares_vested) - safe_decimal(v.shares_sold or 0))
-        if net <= 0:
-            log_step(f"Skip vesting {v.id} net {net}")
-            continue
-        usd_total = safe_decimal(v.total_usd) if v.total_usd else (safe_decimal(v.price_usd) * safe_decimal(v.shares_vested) if v.price_usd else Decimal("0"))
-        exc = safe_decimal(v.exchange_rate) if v.exchange_rate else (get_rate_for_date(v.date, rates) or Decimal("1"))
-        if exc == 0: exc = Decimal("1")
-        total_gbp = (usd_total / exc) + safe_decimal(v.incidental_costs_gbp or 0)
-        avg_cost = (total_gbp / net) if net != 0 else Decimal("0")
-        entry_key = f"V:{v.id}"
-        tooltip = f"RSU {v.date}: USD {usd_total} / rate {exc} → £{q2(total_gbp - safe_decimal(v.incidental_costs_gbp or 0))}; incidental £{q2(v.incidental_costs_gbp or 0)}; per-share £{q2(avg_cost)}"
-        lots.append({"date": v.date, "remaining": net, "avg_cost": avg_cost, "usd_total": usd_total, "rate_used": exc, "paye": None, "entry": entry_key, "source": "RSU", "tooltip": tooltip})
-        log_step(f"Added RSU lot {entry_key} shares {net} per-share {q2(avg_cost)} (incidental {q2(v.incidental_costs_gbp or 0)})")
+def _run_recalc(run, full_mode, checkpoint, explain, tax_year_filter, sales_all, tracer):
+    """Run the engine over `sales_all`; with a `run`, persist into it and publish it (None: hypothetical)."""
+    hypothetical = run is None
+    engine = engine_from_db(tax_year_filter)
+    result = engine.run([SaleRecord.from_row(s) for s in sales_all], tax_year=tax_year_filter, resume_from=checkpoint,
+                        checkpoint_every=None if hypothetical else CHECKPOINT_INTERVAL, tracer=tracer)
+    per_sale_snapshots = list(result.snapshots)
+    errors_present = result.errors_present
 
-    for p in ESPPPurchase.query.order_by(ESPPPurchase.date.asc(), ESPPPurchase.id.asc()).all():
-        shares = safe_decimal(p.shares_retained)
-        if shares <= 0:
-            log_step(f"Skip ESPP {p.id} retained {shares}"); continue
-        purchase_price_usd = safe_decimal(p.purchase_price_usd) if p.purchase_price_usd else Decimal("0")
-        exc = safe_decimal(p.exchange_rate) if p.exchange_rate else (get_rate_for_date(p.date, rates) or Decimal("1"))
-        if exc == 0: exc = Decimal("1")
-        usd_total = purchase_price_usd * shares
-        purchase_gbp = (usd_total / exc) if exc != 0 else usd_total + safe_decimal(p.incidental_costs_gbp or 0)
-        paye = safe_decimal(p.paye_tax_gbp) if p.paye_tax_gbp else Decimal("0")
-        chosen_total_gbp = purchase_gbp + (paye if p.discount_taxed_paye else Decimal("0"))
-        avg_cost = (chosen_total_gbp / shares) if shares != 0 else Decimal("0")
-        entry_key = f"E:{p.id}"
-        tooltip = f"ESPP {p.date}: USD {usd_total} / rate {exc} → purchase £{q2(purchase_gbp - safe_decimal(p.incidental_costs_gbp or 0))}; incidental £{q2(p.incidental_costs_gbp or 0)}; PAYE £{q2(paye)}; per-share £{q2(avg_cost)}"
-        lots.append({"date": p.date, "remaining": shares, "avg_cost": avg_cost, "usd_total": usd_total, "rate_used": exc, "paye": (paye if p.paye_tax_gbp else None), "entry": entry_key, "source": "ESPP", "tooltip": tooltip})
-        log_step(f"Added ESPP lot {entry_key} shares {shares} per-share {q2(avg_cost)} (incidental {q2(p.incidental_costs_gbp or 0)})")
-
-    lots.sort(key=lambda x: (x["date"], x["entry"]))
-    log_step(f"Total lots built: {len(lots)}")
-
-    sa = db.session.get(Setting, "CGT_Allowance"); sb = db.session.get(Setting, "CGT_Rate"); sc = db.session.get(Setting, "NonSavingsIncome"); sd = db.session.get(Setting, "BasicBandThreshold")
-    cgt_allowance = safe_decimal(sa.value) if sa and safe_decimal(sa.value) > 0 and (tax_year_filter is None or tax_year_filter < 2024) else get_aea(tax_year_filter)
-    non_savings_income = safe_decimal(sc.value) if sc else Decimal("0")
-    basic_threshold = safe_decimal(sd.value) if sd else Decimal("37700")
-    cgt_rate_basic = Decimal("10") / Decimal("100")
-    cgt_rate_higher = Decimal("20") / Decimal("100")
-    basic_band_available = max(Decimal("0"), basic_threshold - non_savings_income)
-    log_step(f"Using allowance £{q2(cgt_allowance)} for tax year {tax_year_filter if tax_year_filter else 'all'}, non-savings income £{q2(non_savings_income)}, basic band available £{q2(basic_band_available)} (threshold £{q2(basic_threshold)}).")
-
-    per_sale_snapshots = []
-    all_fragments = []
-
-    # For hypothetical, sales_all already set or provided
     if not hypothetical:
-        if full_mode:
-            sales_all = SaleInput.query.order_by(SaleInput.date.asc(), SaleInput.id.asc()).all()
-        else:
-            if isinstance(sale_filter, list):
-                sales_all = SaleInput.query.filter(SaleInput.id.in_(sale_filter)).order_by(SaleInput.date.asc(), SaleInput.id.asc()).all()
-            elif isinstance(sale_filter, str):
-                date_from = to_date(sale_filter)
-                sales_all = SaleInput.query.filter(SaleInput.date >= date_from).order_by(SaleInput.date.asc(), SaleInput.id.asc()).all()
+        with tracer.span("persistence"):
+            writer = ResultWriter(run.id)
+            writer.add_result(result, explain=explain)
+            # Only a full recalc writes snapshots: a partial run's replay covers only the later sales of a
+            # year, so it keeps sharing the base run's snapshot rows (see retire_rows)
+            if full_mode:
+                snaps_by_ty = {}
+                for snap in per_sale_snapshots:
+                    snaps_by_ty.setdefault(tax_year_of(date.fromisoformat(snap["sale"]["date"])), []).append(snap)
+                totals = {"total_shares": result.holding_shares, "total_cost_gbp": result.holding_cost_gbp, "avg_cost_gbp": result.holding_avg_cost_gbp}
+                for ty, snaps in snaps_by_ty.items():
+                    db.session.add(PoolSnapshot(calc_run_id=run.id, timestamp=datetime.utcnow(), tax_year=ty, snapshot_json=json.dumps(snaps), **totals))
+                db.session.add(PoolSnapshot(calc_run_id=run.id, timestamp=datetime.utcnow(), tax_year=None, snapshot_json=json.dumps(per_sale_snapshots), **totals))
+                closing_step = "Stored snapshots and final pool snapshot."
             else:
-                sales_all = []  # Should not happen
-
-    for s in sales_all:
-        log_step(f"Process sale {s.id} date {s.date} shares {safe_decimal(s.shares_sold)}", s.id)
-        remaining = safe_decimal(s.shares_sold)
-        rate_for_sale = safe_decimal(s.exchange_rate) if s.exchange_rate else get_rate_for_date(s.date, rates)
-        incidental_sale = safe_decimal(s.incidental_costs_gbp or 0)
-        if rate_for_sale == Decimal("1") and not rates and not s.exchange_rate:
-            log_step("No year-level FX configured; using 1.0", s.id)
-        fragments = []
-        changed = {}
-        print(f"DEBUG: Processing sale {s.id}, remaining={remaining}, rate={rate_for_sale}, incidental={incidental_sale}, lots before match: {[(l['entry'], l['remaining']) for l in lots if l['remaining'] > 0]}")
-
-        for lot in lots:
-            if remaining <= 0: break
-            if lot["date"] == s.date and lot["remaining"] > 0:
-                before = safe_decimal(lot["remaining"])
-                take = min(lot["remaining"], remaining)
-                lot["remaining"] -= take
-                after = safe_decimal(lot["remaining"])
-                changed[lot["entry"]] = {"matching": "Same-day", "before": float(before), "after": float(after), "delta": float(after - before)}
-                fragments.append(("Same-day", lot, take))
-                remaining -= take
-
-        if remaining > 0:
-            window_start = s.date - timedelta(days=30)
-            for lot in lots:
-                if remaining <= 0: break
-                if lot["date"] >= window_start and lot["date"] < s.date and lot["remaining"] > 0:
-                    before = safe_decimal(lot["remaining"])
-                    take = min(lot["remaining"], remaining)
-                    lot["remaining"] -= take
-                    after = safe_decimal(lot["remaining"])
-                    changed[lot["entry"]] = {"matching": "30-day", "before": float(before), "after": float(after), "delta": float(after - before)}
-                    fragments.append(("30-day", lot, take))
-                    remaining -= take
-
-        if remaining > 0:
-            window_end = s.date + timedelta(days=30)
-            for lot in lots:
-                if remaining <= 0: break
-                if lot["date"] > s.date and lot["date"] <= window_end and lot["remaining"] > 0:
-                    before = safe_decimal(lot["remaining"])
-                    take = min(lot["remaining"], remaining)
-                    lot["remaining"] -= take
-                    after = safe_decimal(lot["remaining"])
-                    changed[lot["entry"]] = {"matching": "30-day forward", "before": float(before), "after": float(after), "delta": float(after - before)}
-                    fragments.append(("30-day forward", lot, take))
-                    remaining -= take
-                    log_step(f"30-day forward match from {lot['entry']} {take} shares", s.id)
-
-        if remaining > 0:
-            # Section 104 pooling: compute average from all prior remaining lots
-            prior_lots = [lot for lot in lots if lot["date"] < s.date and safe_decimal(lot["remaining"]) > 0]
-            if prior_lots:
-                prior_shares = sum(safe_decimal(lot["remaining"]) for lot in prior_lots)
-                prior_cost = sum(safe_decimal(lot["avg_cost"]) * safe_decimal(lot["remaining"]) for lot in prior_lots)
-                avg_cost_s104 = prior_cost / prior_shares if prior_shares > 0 else Decimal("0")
-                take = remaining
-                cost_total_s104 = avg_cost_s104 * take
-                # Deplete prior lots FIFO
-                depleted_take = Decimal("0")
-                for lot in prior_lots:
-                    if take <= 0: break
-                    this_take = min(safe_decimal(lot["remaining"]), take)
-                    before = safe_decimal(lot["remaining"])
-                    lot["remaining"] -= this_take
-                    after = safe_decimal(lot["remaining"])
-                    changed[lot["entry"]] = {"matching": "Section 104", "before": float(before), "after": float(after), "delta": float(after - before)}
-                    take -= this_take
-                    depleted_take += this_take
-                # Create virtual lot for fragment
-                virtual_lot = {
-                    "entry": "S104_POOL",
-                    "date": s.date,
-                    "source": "POOLED",
-                    "avg_cost": avg_cost_s104,
-                    "usd_total": None,
-                    "rate_used": None,
-                    "paye": None,
-                    "tooltip": f"s104 average from prior lots: £{q2(avg_cost_s104)} for {depleted_take} shares"
-                }
-                fragments.append(("Section 104", virtual_lot, depleted_take))
-                remaining = 0
-                log_step(f"s104 match: {depleted_take} shares at avg £{q2(avg_cost_s104)}", s.id)
+                closing_step = f"Partial recalc complete for {len(sales_all)} sales. No new snapshots created; run a full recalc to refresh them."
+            if explain:
+                writer.add_step(CalculationStep(sale_input_id=None, step_order=len(result.steps) + 1, message=closing_step))
+            # Disposals, details, steps, checkpoints and snapshots land in one transaction
+            writer.commit()
+
+    taxable_summary = None
+    if tax_year_filter is not None and not errors_present:
+        with tracer.span("tax_summary"):
+            if hypothetical:
+                disposals = result.disposals_in_tax_year(tax_year_filter)
             else:
-                log_step("s104: No prior lots available", s.id)
+                if not full_mode:
+                    # cgt_due_gbp is set below: the run takes its own copy of the year's shared rows
+                    claim_rows(DisposalResult, run.id, DisposalResult.tax_year == tax_year_filter)
+                disposals = run_rows(DisposalResult, run.id).filter(DisposalResult.tax_year == tax_year_filter).all()
+            if tracer.debug:
+                tracer.event("tax_year_disposals", tax_year=tax_year_filter, count=len(disposals), gains=[str(d.gain_gbp) for d in disposals])
+            # Apply carry-forward losses from previous years
+            carry_forward_losses = CarryForwardLoss.query.filter(CarryForwardLoss.tax_year < tax_year_filter).all()
+            total_carry_forward_loss = safe_decimal(sum(safe_decimal(loss.amount) for loss in carry_forward_losses))
+            summary = summarise_tax_year([d.gain_gbp for d in disposals], engine.settings, total_carry_forward_loss, tracer=tracer)
+            taxable_summary = summary.as_dict()
 
-        if remaining > 0:
             if not hypothetical:
-                dr = DisposalResult(sale_date=s.date, sale_input_id=s.id, matched_date=None, matching_type="ERROR: insufficient holdings",
-                                    matched_shares=Decimal("0"), avg_cost_gbp=Decimal("0"), proceeds_gbp=Decimal("0"),
-                                    cost_basis_gbp=Decimal("0"), gain_gbp=Decimal("0"), cgt_due_gbp=Decimal("0"),
-                                    calculation_json=json.dumps({"error": "insufficient holdings", "requested": str(s.shares_sold), "remaining_unmatched": str(remaining)}))
-                db.session.add(dr)
-                db.session.commit()
-            log_step(f"ERROR sale {s.id} insufficient remaining {remaining}", s.id)
-            errors_present = True
-            pool_after = [{"entry": lot["entry"], "date": lot["date"].isoformat(), "source": lot["source"], "remaining": float(lot["remaining"]), "per_share_cost": float(q2(lot["avg_cost"])), "tooltip": lot.get("tooltip","")} for lot in lots]
-            per_sale_snapshots.append({"sale": {"id": s.id, "date": s.date.isoformat(), "shares": float(s.shares_sold)}, "changed": changed, "pool_after": pool_after, "error": True})
-            continue
-
-        # Build raw fragments without db add
-        raw_fragments = []
-        frag_index = 0
-        for mtype, lot, qty in fragments:
-            frag_index += 1
-            struct = build_fragment_detail_struct(s.sale_price_usd, lot, qty, rate_for_sale, frag_index)
-            struct["inputs"] = {"sale_price_usd": str(s.sale_price_usd), "sale_rate_used": str(rate_for_sale), "lot": {"entry": lot["entry"], "date": str(lot["date"]), "source": lot["source"], "usd_total": str(lot.get("usd_total")), "rate_used": str(lot.get("rate_used")), "paye": str(lot.get("paye"))}}
-            proceeds_total = Decimal(struct["numeric_trace"]["proceeds_total_gbp"])
-            cost_total = Decimal(struct["numeric_trace"]["cost_total_gbp"])
-            gain = Decimal(struct["numeric_trace"]["gain_gbp"])
-            print(f"DEBUG: Raw Fragment {frag_index} for sale {s.id}: type={mtype}, qty={qty}, proceeds={proceeds_total}, cost={cost_total}, gain={gain}")
-            raw_fragments.append((mtype, lot, qty, struct, proceeds_total, cost_total, gain, frag_index))
-
-        # Apply incidental costs to proceeds
-        if incidental_sale > 0 and raw_fragments:
-            total_gross_proceeds = sum(f[4] for f in raw_fragments)
-            if total_gross_proceeds > 0:
-                net_proceeds = total_gross_proceeds - incidental_sale
-                pro_rata = net_proceeds / total_gross_proceeds
-                log_step(f"Applied incidental costs £{q2(incidental_sale)} to sale {s.id} (pro-rata {q2(pro_rata * 100)}%)", s.id)
-                for i, (mtype, lot, qty, struct, gross_proceeds, cost_total, raw_gain, frag_index) in enumerate(raw_fragments):
-                    adjusted_proceeds = q2(gross_proceeds * pro_rata)
-                    adjusted_gain = q2(adjusted_proceeds - cost_total)
-                    # Update equations
-                    struct["equations"][1] = f"Adjusted total proceeds = {q2(gross_proceeds)} × {q2(pro_rata)} (after £{q2(incidental_sale)} incidental) = {adjusted_proceeds}"
-                    struct["numeric_trace"]["proceeds_total_gbp"] = str(adjusted_proceeds)
-                    struct["numeric_trace"]["gain_gbp"] = str(adjusted_gain)
-                    # Add incidental to inputs
-                    struct["inputs"]["incidental_sale"] = str(incidental_sale)
-                    dr = DisposalResult(sale_date=s.date, sale_input_id=s.id, matched_date=lot["date"], matching_type=mtype,
-                                        matched_shares=qty, avg_cost_gbp=safe_decimal(lot["avg_cost"]), proceeds_gbp=adjusted_proceeds,
-                                        cost_basis_gbp=cost_total, gain_gbp=adjusted_gain, cgt_due_gbp=Decimal("0"),
-                                        calculation_json=json.dumps({"inputs": struct["inputs"], "equations": struct["equations"], "numeric_trace": struct["numeric_trace"]}))
-                    if not hypothetical:
-                        db.session.add(dr)
-                        db.session.commit()
-                        cd = CalculationDetail(disposal_id=dr.id, sale_input_id=s.id, equations="\n".join(struct["equations"]), explanation=f"Fragment {frag_index} matched {qty} shares from {lot['entry']} ({mtype}), adjusted for incidental costs")
-                        db.session.add(cd)
-                        db.session.commit()
-                        all_fragments.append(dr)
+                if summary.excess_loss > 0:
+                    loss = CarryForwardLoss.query.filter_by(tax_year=tax_year_filter).first()
+                    if loss:
+                        loss.amount += summary.excess_loss
                     else:
-                        # Temp dr for hypothetical
-                        temp_dr = type('TempDR', (), {
-                            'id': -1,
-                            'sale_date': s.date,
-                            'sale_input_id': s.id,
-                            'matched_date': lot["date"],
-                            'matching_type': mtype,
-                            'matched_shares': qty,
-                            'avg_cost_gbp': safe_decimal(lot["avg_cost"]),
-                            'proceeds_gbp': adjusted_proceeds,
-                            'cost_basis_gbp': cost_total,
-                            'gain_gbp': adjusted_gain,
-                            'cgt_due_gbp': Decimal("0"),
-                            'calculation_json': json.dumps({"inputs": struct["inputs"], "equations": struct["equations"], "numeric_trace": struct["numeric_trace"]})
-                        })()
-                        all_fragments.append(temp_dr)
-            else:
-                log_step(f"No proceeds to adjust for incidental £{q2(incidental_sale)} on sale {s.id}", s.id)
-        else:
-            for i, (mtype, lot, qty, struct, proceeds_total, cost_total, gain, frag_index) in enumerate(raw_fragments):
-                dr = DisposalResult(sale_date=s.date, sale_input_id=s.id, matched_date=lot["date"], matching_type=mtype,
-                                    matched_shares=qty, avg_cost_gbp=safe_decimal(lot["avg_cost"]), proceeds_gbp=proceeds_total,
-                                    cost_basis_gbp=cost_total, gain_gbp=gain, cgt_due_gbp=Decimal("0"),
-                                    calculation_json=json.dumps({"inputs": struct["inputs"], "equations": struct["equations"], "numeric_trace": struct["numeric_trace"]}))
-                if not hypothetical:
-                    db.session.add(dr)
-                    db.session.commit()
-                    cd = CalculationDetail(disposal_id=dr.id, sale_input_id=s.id, equations="\n".join(struct["equations"]), explanation=f"Fragment {frag_index} matched {qty} shares from {lot['entry']} ({mtype})")
-                    db.session.add(cd)
-                    db.session.commit()
-                    all_fragments.append(dr)
-                else:
-                    # Temp dr for hypothetical
-                    temp_dr = type('TempDR', (), {
-                        'id': -1,
-                        'sale_date': s.date,
-                        'sale_input_id': s.id,
-                        'matched_date': lot["date"],
-                        'matching_type': mtype,
-                        'matched_shares': qty,
-                        'avg_cost_gbp': safe_decimal(lot["avg_cost"]),
-                        'proceeds_gbp': proceeds_total,
-                        'cost_basis_gbp': cost_total,
-                        'gain_gbp': gain,
-                        'cgt_due_gbp': Decimal("0"),
-                        'calculation_json': json.dumps({"inputs": struct["inputs"], "equations": struct["equations"], "numeric_trace": struct["numeric_trace"]})
-                    })()
-                    all_fragments.append(temp_dr)
-
-        pool_after = [{"entry": lot["entry"], "date": lot["date"].isoformat(), "source": lot["source"], "remaining": float(lot["remaining"]), "per_share_cost": float(q2(lot["avg_cost"])), "tooltip": lot.get("tooltip","")} for lot in lots]
-        per_sale_snapshots.append({"sale": {"id": s.id, "date": s.date.isoformat(), "shares": float(s.shares_sold)}, "changed": changed, "pool_after": pool_after, "error": False})
-    
-    # Only create snapshots if full recalc or if tax_year_filter specified
-    if full_mode or tax_year_filter:
-        snaps_by_ty = {}
-        for snap in per_sale_snapshots:
-            sale_date = datetime.fromisoformat(snap["sale"]["date"]).date()
-            ty = sale_date.year if sale_date >= date(sale_date.year,4,6) else sale_date.year - 1
-            snaps_by_ty.setdefault(ty, []).append(snap)
-    
-        for ty, snaps in snaps_by_ty.items():
-            total_shares = sum([safe_decimal(lot["remaining"]) for lot in lots])
-            total_cost = sum([safe_decimal(lot["avg_cost"]) * safe_decimal(lot["remaining"]) for lot in lots])
-            avg_cost = (total_cost / total_shares) if total_shares != 0 else Decimal("0")
-            if not hypothetical:
-                ps = PoolSnapshot(timestamp=datetime.utcnow(), tax_year=ty, snapshot_json=json.dumps(snaps), total_shares=total_shares, total_cost_gbp=total_cost, avg_cost_gbp=avg_cost)
-                db.session.add(ps)
-    
-        # Final snapshot only on full
-        if full_mode:
-            total_shares = sum([safe_decimal(lot["remaining"]) for lot in lots])
-            total_cost = sum([safe_decimal(lot["avg_cost"]) * safe_decimal(lot["remaining"]) for lot in lots])
-            avg_cost = (total_cost / total_shares) if total_shares != 0 else Decimal("0")
-            if not hypothetical:
-                ps_final = PoolSnapshot(timestamp=datetime.utcnow(), tax_year=None, snapshot_json=json.dumps(per_sale_snapshots), total_shares=total_shares, total_cost_gbp=total_cost, avg_cost_gbp=avg_cost)
-                db.session.add(ps_final)
-                db.session.commit()
-                log_step("Stored snapshots and final pool snapshot.")
-            else:
-                log_step("Hypothetical mode: No snapshots stored.")
-        else:
-            if not hypothetical:
+                        db.session.add(CarryForwardLoss(tax_year=tax_year_filter, amount=summary.excess_loss, notes=f"Excess loss from {tax_year_filter}"))
+                for d in disposals:
+                    alloc = allocate_cgt(d.gain_gbp, summary)
+                    if alloc is not None:
+                        d.cgt_due_gbp = alloc
                 db.session.commit()
-            log_step(f"Partial recalc complete for {len(sales_all)} sales. No new snapshots created.")
 
-    taxable_summary = None
-    if tax_year_filter is not None and not errors_present:
-        tax_start = date(tax_year_filter,4,6); tax_end = date(tax_year_filter+1,4,5)
-        if hypothetical:
-            # Use simulated all_fragments for hypothetical mode
-            disposals = [dr for dr in all_fragments if dr.sale_date and tax_start <= dr.sale_date <= tax_end]
-        else:
-            disposals = DisposalResult.query.filter(DisposalResult.sale_date >= tax_start, DisposalResult.sale_date <= tax_end).all()
-        print(f"DEBUG: {len(disposals)} disposals for tax year {tax_year_filter}: {[ (d.sale_input_id, d.gain_gbp, type(d.gain_gbp)) for d in disposals ]}")
-        gains = [safe_decimal(d.gain_gbp) for d in disposals if safe_decimal(d.gain_gbp) > 0]
-        losses = [safe_decimal(d.gain_gbp) for d in disposals if safe_decimal(d.gain_gbp) < 0]
-        pos = safe_decimal(sum(gains))
-        neg = safe_decimal(sum([abs(l) for l in losses]))
-        print(f"DEBUG: pos={pos} (type {type(pos)}), neg={neg} (type {type(neg)})")
-        net_gain = pos - neg
-        excess_current_loss = max(Decimal("0"), neg - pos)
-        if net_gain < 0: net_gain = Decimal("0")
-
-        if excess_current_loss > 0 and tax_year_filter is not None:
-            loss_year = tax_year_filter
-            loss = CarryForwardLoss.query.filter_by(tax_year=loss_year).first()
-            if loss:
-                if not hypothetical:
-                    loss.amount += excess_current_loss
-                    db.session.add(loss)
-                    db.session.commit()
-            else:
-                if not hypothetical:
-                    loss = CarryForwardLoss(tax_year=loss_year, amount=excess_current_loss, notes=f"Excess loss from {tax_year_filter}")
-                    db.session.add(loss)
-                    db.session.commit()
-
-        # Apply carry-forward losses from previous years
-        carry_forward_losses = CarryForwardLoss.query.filter(CarryForwardLoss.tax_year < tax_year_filter).all()
-        total_carry_forward_loss = safe_decimal(sum(safe_decimal(loss.amount) for loss in carry_forward_losses))
-        
-        # Subtract carry-forward losses from net gain before applying allowance
-        net_gain_after_losses = max(Decimal("0"), net_gain - total_carry_forward_loss)
-        
-        sa = db.session.get(Setting, "CGT_Allowance")
-        sc = db.session.get(Setting, "NonSavingsIncome")
-        sd = db.session.get(Setting, "BasicBandThreshold")
-        cgt_allowance = safe_decimal(sa.value) if sa and safe_decimal(sa.value) > 0 and tax_year_filter < 2024 else get_aea(tax_year_filter)
-        non_savings_income = safe_decimal(sc.value) if sc else Decimal("0")
-        basic_threshold = safe_decimal(sd.value) if sd else Decimal("37700")
-        basic_band_available = max(Decimal("0"), basic_threshold - non_savings_income)
-        taxable_gain = net_gain_after_losses - cgt_allowance
-        if taxable_gain < 0: taxable_gain = Decimal("0")
-        basic_taxable = min(taxable_gain, basic_band_available)
-        higher_taxable = taxable_gain - basic_taxable
-        estimated_cgt = q2(basic_taxable * Decimal("0.10") + higher_taxable * Decimal("0.20"))
-        taxable_summary = {
-            "pos": float(q2(pos)), "neg": float(q2(neg)), "net_gain": float(q2(net_gain)),
-            "cgt_allowance": float(q2(cgt_allowance)),
-            "non_savings_income": float(q2(non_savings_income)),
-            "basic_threshold": float(q2(basic_threshold)),
-            "basic_band_available": float(q2(basic_band_available)),
-            "total_carry_forward_loss": float(q2(total_carry_forward_loss)),
-            "net_gain_after_losses": float(q2(net_gain_after_losses)),
-            "taxable_gain": float(q2(taxable_gain)),
-            "basic_taxable": float(q2(basic_taxable)),
-            "higher_taxable": float(q2(higher_taxable)),
-            "estimated_cgt": float(estimated_cgt)
-        }
-    if not hypothetical and taxable_summary:
-        pos = safe_decimal(taxable_summary["pos"])
-        if pos > 0 and estimated_cgt > 0:
-            for d in disposals:
-                g = safe_decimal(d.gain_gbp)
-                if g > 0:
-                    share = g / pos
-                    alloc = q2(estimated_cgt * share)
-                    d.cgt_due_gbp = alloc
-                    db.session.add(d)
-            db.session.commit()
-        
-        # Commit the new carry-forward loss if added
-        if excess_current_loss > 0 and tax_year_filter is not None:
+    if not hypothetical:
+        # Every year's totals, for api_summary / SA108 / summary CSV; a full run already has every disposal in hand
+        with tracer.span("year_summaries"):
+            refresh_tax_year_summaries(result.disposals if full_mode else None, run_id=run.id)
+            # The run becomes visible to readers in the same commit as its last rows
+            publish_run(run)
             db.session.commit()
+        schedule_run_gc()
 
     return {"per_sale_snapshots": per_sale_snapshots, "errors_present": errors_present, "taxable_summary": taxable_summary}
-
 # ---------- Templates (Audit Dashboard + Editor) ----------
 AUDIT_DASH_HTML = """
 <!doctype html>
@@ -1093,64 +1342,103 @@ def upload_boe_csv():
         flash("File must be a CSV", "danger")
         return redirect(url_for("index_full"))
     try:
-        content = file.read().decode("utf-8")
-        stream = io.StringIO(content, newline=None)
-        reader = csv.reader(stream)
-        if not reader:  # empty file
-            flash("Empty CSV file", "danger")
-            return redirect(url_for("index_full"))
-        next(reader, None)  # skip header
-        existing_dates = set(r.date for r in ExchangeRate.query.all())
-        inserted = 0
-        for row in reader:
-            if len(row) < 2:
-                continue
-            date_str = row[0].strip().strip('"')
-            rate_str = row[1].strip().strip('"')
-            if not date_str or not rate_str:
-                continue
-            try:
-                dt = datetime.strptime(date_str, "%d %b %y").date()
-                if dt.year < 2010 or dt.year > 2025:
-                    continue
-                usd_gbp = safe_decimal(rate_str)
-                if usd_gbp and usd_gbp > 0 and dt not in existing_dates:
-                    er = ExchangeRate(
-                        date=dt,
-                        usd_gbp=usd_gbp,
-                        description=f"BoE daily spot {dt}",
-                        notes="Uploaded from BoE CSV"
-                    )
-                    db.session.add(er)
-                    inserted += 1
-                    existing_dates.add(dt)
-            except ValueError:
-                continue
+        inserted, skipped, invalid = import_boe_csv(io.TextIOWrapper(file.stream, encoding="utf-8-sig", newline=""))
         db.session.commit()
-        flash(f"Inserted {inserted} daily rates from BoE CSV", "success")
+        if inserted or skipped:
+            flash(f"BoE CSV: inserted {inserted} daily rates, skipped {skipped} already stored, {invalid} invalid rows", "success")
+        else:
+            flash(f"No rates found in CSV ({invalid} invalid rows)", "danger")
     except Exception as e:
         db.session.rollback()
         flash(f"Error processing CSV: {str(e)}", "danger")
     return redirect(url_for("index_full"))
 
+BOE_DATE_FORMATS = ("%d %b %y", "%d %b %Y")
+BOE_IMPORT_CHUNK = 1000
+
+def parse_boe_row(row):
+    """(date, rate) for a BoE "DATE","XUDLUSS" row, or None if it is not a usable rate."""
+    if len(row) < 2:
+        return None
+    date_str, rate_str = row[0].strip().strip('"'), row[1].strip().strip('"')
+    for fmt in BOE_DATE_FORMATS:
+        try:
+            dt = datetime.strptime(date_str, fmt).date()
+            break
+        except ValueError:
+            continue
+    else:
+        return None
+    try:
+        rate = Decimal(rate_str)
+    except InvalidOperation:
+        return None
+    return (dt, rate) if rate.is_finite() and rate > 0 else None
+
+def import_boe_csv(lines, chunk_size=BOE_IMPORT_CHUNK):
+    """Stream BoE USD/GBP rows from `lines` into exchange_rates; returns (inserted, skipped, invalid).
+
+    Rows are parsed one at a time and written in chunks of INSERT ... ON CONFLICT(date) DO NOTHING,
+    so dates already stored (or repeated in the file) are skipped by the unique date index rather than
+    by loading the table. A leading header row is not counted as invalid. When anything was inserted
+    the FX index is patched with the new dates (see rates_changed). The caller commits.
+    """
+    inserted = valid = invalid = 0
+    header = True
+    chunk = []
+    added = []
+
+    stmt = sqlite_insert(ExchangeRate.__table__).on_conflict_do_nothing(index_elements=["date"])
+    conn = db.session.connection()
+
+    def flush():
+        nonlocal inserted
+        inserted += conn.execute(stmt, chunk).rowcount  # executemany: one compiled statement per import
+        chunk.clear()
+
+    for row in csv.reader(lines):
+        if not any(cell.strip() for cell in row):
+            continue
+        parsed = parse_boe_row(row)
+        if parsed is None:
+            invalid += not header
+            header = False
+            continue
+        header = False
+        dt, rate = parsed
+        valid += 1
+        added.append(FxRecord(dt, rate))
+        chunk.append({"date": dt, "usd_gbp": rate, "description": f"BoE daily spot {dt}", "notes": "Uploaded from BoE CSV"})
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    if inserted:
+        rates_changed(added=added, since=min(r.date for r in added))  # dates that hit the conflict are already in the index and are skipped
+    return inserted, valid - inserted, invalid
+
 @app.route("/")
 def index():
-    rates = load_rates_sorted()
+    vestings = Vesting.query.order_by(Vesting.date.asc(), Vesting.id.asc()).all()
+    purchases = ESPPPurchase.query.order_by(ESPPPurchase.date.asc(), ESPPPurchase.id.asc()).all()
+    rates = iter(resolve_rates([row.date for row in vestings + purchases]))
     lots = []
-    for v in Vesting.query.order_by(Vesting.date.asc(), Vesting.id.asc()).all():
+    for v in vestings:
+        fx_rate = next(rates)
         net = safe_decimal(v.net_shares) if v.net_shares is not None else (safe_decimal(v.shares_vested) - safe_decimal(v.shares_sold or 0))
         if net <= 0: continue
         usd_total = safe_decimal(v.total_usd) if v.total_usd else (safe_decimal(v.price_usd) * safe_decimal(v.shares_vested) if v.price_usd else Decimal("0"))
-        exc = safe_decimal(v.exchange_rate) if v.exchange_rate else (get_rate_for_date(v.date, rates) or Decimal("1"))
+        exc = safe_decimal(v.exchange_rate) if v.exchange_rate else (fx_rate or Decimal("1"))
         if exc == 0: exc = Decimal("1")
         total_gbp = usd_total / exc
         avg_cost = (total_gbp / net) if net != 0 else Decimal("0")
         lots.append({"entry": f"V:{v.id}", "date": v.date, "source":"RSU", "remaining": float(net), "avg_cost": float(q2(avg_cost)), "tooltip": f"RSU {v.date}: USD {usd_total} / rate {exc} → £{q2(total_gbp)}; per-share £{q2(avg_cost)}"})
-    for p in ESPPPurchase.query.order_by(ESPPPurchase.date.asc(), ESPPPurchase.id.asc()).all():
+    for p in purchases:
+        fx_rate = next(rates)
         shares = safe_decimal(p.shares_retained)
         if shares <= 0: continue
         purchase_price_usd = safe_decimal(p.purchase_price_usd)
-        exc = safe_decimal(p.exchange_rate) if p.exchange_rate else (get_rate_for_date(p.date, rates) or Decimal("1"))
+        exc = safe_decimal(p.exchange_rate) if p.exchange_rate else (fx_rate or Decimal("1"))
         if exc == 0: exc = Decimal("1")
         usd_total = purchase_price_usd * shares
         purchase_gbp = usd_total / exc
@@ -1182,21 +1470,27 @@ def add_rate():
     d = to_date(request.form.get("date"))
     rate = safe_decimal(request.form.get("rate"))
     if not d or rate <= 0: flash("Invalid rate", "danger"); return redirect(url_for("index_full"))
-    db.session.add(ExchangeRate(date=d, usd_gbp=rate, description="", notes=""))
-    db.session.commit(); flash("Rate added", "success"); return redirect(url_for("index_full"))
+    existing = ExchangeRate.query.filter_by(date=d).first()  # one rate per date: a manual entry overrides
+    if existing: existing.usd_gbp = rate; rates_changed(since=d)
+    else: db.session.add(ExchangeRate(date=d, usd_gbp=rate, description="", notes="")); rates_changed(added=[FxRecord(d, rate)], since=d)
+    db.session.commit(); flash("Rate updated" if existing else "Rate added", "success"); return redirect(url_for("index_full"))
 
 @app.route("/delete_rate/<int:id>")
 def delete_rate(id):
     r = ExchangeRate.query.get(id)
-    if r: db.session.delete(r); db.session.commit(); flash("Rate deleted", "info")
+    if r: db.session.delete(r); rates_changed(since=r.date); db.session.commit(); flash("Rate deleted", "info")
     return redirect(url_for("index_full"))
 
 @app.route("/edit_rate/<int:id>", methods=["GET","POST"])
 def edit_rate(id):
     r = ExchangeRate.query.get_or_404(id)
     if request.method=="POST":
-        r.date = to_date(request.form.get("date")); r.usd_gbp = safe_decimal(request.form.get("rate"))
-        db.session.add(r); db.session.commit(); flash("Rate updated","success"); return redirect(url_for("index_full"))
+        new_date = to_date(request.form.get("date"))
+        if ExchangeRate.query.filter(ExchangeRate.date == new_date, ExchangeRate.id != r.id).first():
+            flash(f"A rate for {new_date} already exists", "danger"); return redirect(url_for("index_full"))
+        since = min(r.date, new_date) if new_date else r.date
+        r.date = new_date; r.usd_gbp = safe_decimal(request.form.get("rate"))
+        db.session.add(r); rates_changed(since=since); db.session.commit(); flash("Rate updated","success"); return redirect(url_for("index_full"))
     return f"<form method='post'><input type='date' name='date' value='{r.date}' required><input type='number' step='0.000001' name='rate' value='{r.usd_gbp}' required><button>Save</button></form>"
 
 # Vesting CRUD
@@ -1208,7 +1502,7 @@ def add_vesting():
     sold = safe_decimal(request.form.get("shares_sold") or "0")
     if not d or shares <= 0: flash("Invalid vesting", "danger"); return redirect(url_for("index_full"))
     v = Vesting(date=d, shares_vested=shares, price_usd=safe_decimal(price) if price else None, shares_sold=sold, net_shares=(shares - sold))
-    db.session.add(v); db.session.commit(); flash("Vesting added","success")
+    db.session.add(v); data_changed(); db.session.commit(); flash("Vesting added","success")
     # Trigger partial recalc for sales after this date
     recalc_all(sale_filter=d.isoformat())
     return redirect(url_for("index_full"))
@@ -1217,11 +1511,11 @@ def add_vesting():
 def edit_vesting(id):
     v = Vesting.query.get_or_404(id)
     if request.method=="POST":
+        old_date = v.date
         v.date = to_date(request.form.get("date")); v.shares_vested = safe_decimal(request.form.get("shares_vested"))
         v.price_usd = safe_decimal(request.form.get("price_usd")) if request.form.get("price_usd") else None
         v.shares_sold = safe_decimal(request.form.get("shares_sold") or "0"); v.net_shares = v.shares_vested - v.shares_sold
-        old_date = v.date  # Before update, but since date might change, use new date for filter
-        db.session.add(v); db.session.commit(); flash("Vesting updated","success")
+        db.session.add(v); data_changed(); db.session.commit(); flash("Vesting updated","success")
         # Partial recalc from min(old_date, new_date)
         new_date = v.date
         recalc_date = min(old_date, new_date).isoformat() if old_date and new_date else None
@@ -1233,7 +1527,11 @@ def edit_vesting(id):
 @app.route("/delete_vesting/<int:id>")
 def delete_vesting(id):
     v = Vesting.query.get(id)
-    if v: db.session.delete(v); db.session.commit(); flash("Vesting deleted","info")
+    if v:
+        d = v.date
+        db.session.delete(v); data_changed(); db.session.commit(); flash("Vesting deleted","info")
+        # Replay the sales that could have matched the lot
+        recalc_all(sale_filter=d.isoformat())
     return redirect(url_for("index_full"))
 
 # ESPP CRUD
@@ -1261,7 +1559,7 @@ def add_espp():
         if not qualifying:
             flash(f"Warning: ESPP discount {q2(discount)}% > 15%. Full market value treated as income; ensure PAYE is flagged.", "warning")
     p = ESPPPurchase(date=d, shares_retained=shares, purchase_price_usd=purchase, market_price_usd=market, discount=discount, paye_tax_gbp=safe_decimal(paye) if paye else None, exchange_rate=safe_decimal(exch) if exch else None, discount_taxed_paye=discount_taxed, qualifying=qualifying)
-    db.session.add(p); db.session.commit(); flash("ESPP added","success")
+    db.session.add(p); data_changed(); db.session.commit(); flash("ESPP added","success")
     # Trigger partial recalc
     recalc_all(sale_filter=d.isoformat())
     return redirect(url_for("index_full"))
@@ -1274,6 +1572,7 @@ def edit_espp(id):
         if new_shares <= 0:
             flash("Invalid: Positive shares required","danger")
             return redirect(url_for("index_full"))
+        old_date = p.date
         p.date = to_date(request.form.get("date"))
         p.shares_retained = new_shares
         purchase_str = request.form.get("purchase_price_usd")
@@ -1297,8 +1596,7 @@ def edit_espp(id):
         p.paye_tax_gbp = safe_decimal(request.form.get("paye_tax_gbp")) if request.form.get("paye_tax_gbp") else None
         p.exchange_rate = safe_decimal(request.form.get("exchange_rate")) if request.form.get("exchange_rate") else None
         p.discount_taxed_paye = True if request.form.get("discount_taxed")=="on" else False
-        old_date = p.date
-        db.session.add(p); db.session.commit(); flash("ESPP updated","success")
+        db.session.add(p); data_changed(); db.session.commit(); flash("ESPP updated","success")
         new_date = p.date
         recalc_date = min(old_date, new_date).isoformat() if old_date and new_date else None
         if recalc_date:
@@ -1309,7 +1607,10 @@ def edit_espp(id):
 @app.route("/delete_espp/<int:id>")
 def delete_espp(id):
     p = ESPPPurchase.query.get(id)
-    if p: db.session.delete(p); db.session.commit(); flash("ESPP deleted","info")
+    if p:
+        d = p.date
+        db.session.delete(p); data_changed(); db.session.commit(); flash("ESPP deleted","info")
+        recalc_all(sale_filter=d.isoformat())
     return redirect(url_for("index_full"))
 
 # Sale CRUD
@@ -1322,7 +1623,7 @@ def add_sale():
     if not d or shares <= 0 or not price:
         flash("Invalid sale: Date, positive shares, and price required","danger"); return redirect(url_for("index_full"))
     s = SaleInput(date=d, shares_sold=shares, sale_price_usd=safe_decimal(price), exchange_rate=safe_decimal(exch) if exch else None)
-    db.session.add(s); db.session.commit(); flash("Sale added","success")
+    db.session.add(s); data_changed(); db.session.commit(); flash("Sale added","success")
     # Trigger partial recalc for this sale
     recalc_all(sale_filter=[s.id])
     return redirect(url_for("index_full"))
@@ -1337,20 +1638,25 @@ def edit_sale(id):
         if not new_date or new_shares <= 0 or not price:
             flash("Invalid: Date, positive shares, and price required","danger")
             return redirect(url_for("index_full"))
+        old_date = s.date
         s.date = new_date
         s.shares_sold = new_shares
         s.sale_price_usd = safe_decimal(price)
         s.exchange_rate = safe_decimal(request.form.get("exchange_rate")) if request.form.get("exchange_rate") else None
-        db.session.add(s); db.session.commit(); flash("Sale updated","success")
-        # Recompute this sale
-        recalc_all(sale_filter=[s.id])
+        db.session.add(s); data_changed(); db.session.commit(); flash("Sale updated","success")
+        # Replay from the earlier of the old and new sale dates
+        recalc_all(sale_filter=min(old_date, new_date).isoformat())
         return redirect(url_for("index_full"))
     return f"<form method='post'><input type='date' name='date' value='{s.date}' required><input type='number' step='0.000001' name='shares_sold' value='{s.shares_sold}' required><input type='number' step='0.000001' name='sale_price_usd' value='{s.sale_price_usd}' required><input type='number' step='0.000001' name='exchange_rate' value='{s.exchange_rate or ''}'><button>Save</button></form>"
 
 @app.route("/delete_sale/<int:id>")
 def delete_sale(id):
     s = SaleInput.query.get(id)
-    if s: db.session.delete(s); db.session.commit(); flash("Sale deleted","info")
+    if s:
+        d = s.date
+        db.session.delete(s); data_changed(); db.session.commit(); flash("Sale deleted","info")
+        # Later sales match against the shares it no longer takes
+        recalc_all(sale_filter=d.isoformat())
     return redirect(url_for("index_full"))
 
 # Carry-forward loss CRUD
@@ -1370,6 +1676,9 @@ def add_carry_loss():
     else:
         loss = CarryForwardLoss(tax_year=tax_year, amount=amount, notes=notes)
         db.session.add(loss)
+    db.session.flush()
+    refresh_tax_year_summaries()
+    data_changed()
     db.session.commit()
     flash(f"Carry-forward loss for {tax_year} updated to £{q2(amount)}", "success")
     return redirect(url_for("index_full"))
@@ -1379,6 +1688,9 @@ def delete_carry_loss(tax_year):
     loss = CarryForwardLoss.query.filter_by(tax_year=tax_year).first()
     if loss:
         db.session.delete(loss)
+        db.session.flush()
+        refresh_tax_year_summaries()
+        data_changed()
         db.session.commit()
         flash(f"Carry-forward loss for {tax_year} deleted", "info")
     return redirect(url_for("index_full"))
@@ -1411,103 +1723,164 @@ def audit():
     return render_template_string(AUDIT_DASH_HTML, tax_years=tax_years, sel_tax_year=sel_tax_year)
 
 # CSV exports
+CSV_FLUSH_ROWS = 500  # rows per chunk of a streamed CSV export
+CSV_YIELD_PER = 1000  # rows fetched from SQLite per round trip while streaming
+
+def stream_csv(header, rows):
+    """CSV text chunks: the header at once, then CSV_FLUSH_ROWS rows per chunk."""
+    buf = io.StringIO(); cw = csv.writer(buf)
+    cw.writerow(header)
+    yield buf.getvalue()
+    buf.seek(0); buf.truncate()
+    for n, row in enumerate(rows, start=1):
+        cw.writerow(row)
+        if n % CSV_FLUSH_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0); buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+def csv_response(filename, header, rows):
+    """Streamed CSV attachment; `rows` is iterated lazily, inside the request's app context."""
+    return app.response_class(stream_with_context(stream_csv(header, rows)), mimetype="text/csv",
+                              headers={"Content-Disposition": f"attachment; filename={filename}"})
+
 @app.route("/download/<kind>")
 def download_csv(kind):
+    """CSV exports, streamed: result rows are fetched CSV_YIELD_PER at a time, never all at once."""
     tax_year_q = request.args.get("tax_year")
     today = datetime.utcnow().date()
     default_tax_year = today.year if today >= date(today.year,4,6) else today.year - 1
     tax_year = int(tax_year_q) if tax_year_q and tax_year_q.isdigit() else default_tax_year
-    si = io.StringIO(); cw = csv.writer(si)
     if kind == "disposals":
-        rows = DisposalResult.query.order_by(DisposalResult.sale_date.asc(), DisposalResult.id.asc()).all()
-        cw.writerow(["disposal_id","sale_date","sale_input_id","matched_date","matching_type","matched_shares","avg_cost_gbp","proceeds_gbp","cost_basis_gbp","gain_gbp","cgt_due_gbp"])
-        for r in rows:
-            cw.writerow([r.id, r.sale_date.isoformat() if r.sale_date else "", r.sale_input_id, r.matched_date.isoformat() if r.matched_date else "", r.matching_type, float(r.matched_shares or 0), float(q2(safe_decimal(r.avg_cost_gbp))), float(q2(safe_decimal(r.proceeds_gbp))), float(q2(safe_decimal(r.cost_basis_gbp))), float(q2(safe_decimal(r.gain_gbp))), float(q2(safe_decimal(r.cgt_due_gbp)))])
-        buf = io.BytesIO(); buf.write(si.getvalue().encode()); buf.seek(0); return send_file(buf, mimetype="text/csv", as_attachment=True, download_name="disposals.csv")
+        query = run_rows(DisposalResult).with_entities(
+            DisposalResult.id, DisposalResult.sale_date, DisposalResult.sale_input_id, DisposalResult.matched_date, DisposalResult.matching_type,
+            DisposalResult.matched_shares, DisposalResult.avg_cost_gbp, DisposalResult.proceeds_gbp, DisposalResult.cost_basis_gbp,
+            DisposalResult.gain_gbp, DisposalResult.cgt_due_gbp).order_by(DisposalResult.sale_date.asc(), DisposalResult.id.asc())
+        rows = ([r.id, r.sale_date.isoformat() if r.sale_date else "", r.sale_input_id, r.matched_date.isoformat() if r.matched_date else "", r.matching_type, float(r.matched_shares or 0), float(q2(safe_decimal(r.avg_cost_gbp))), float(q2(safe_decimal(r.proceeds_gbp))), float(q2(safe_decimal(r.cost_basis_gbp))), float(q2(safe_decimal(r.gain_gbp))), float(q2(safe_decimal(r.cgt_due_gbp)))]
+                for r in query.yield_per(CSV_YIELD_PER))
+        return csv_response("disposals.csv", ["disposal_id","sale_date","sale_input_id","matched_date","matching_type","matched_shares","avg_cost_gbp","proceeds_gbp","cost_basis_gbp","gain_gbp","cgt_due_gbp"], rows)
     elif kind == "pool":
-        snaps = PoolSnapshot.query.order_by(PoolSnapshot.timestamp.desc()).limit(50).all()
-        cw.writerow(["timestamp","tax_year","total_shares","total_cost_gbp","avg_cost_gbp","snapshot_json"])
-        for s in snaps:
-            cw.writerow([s.timestamp.isoformat(), s.tax_year if s.tax_year else "", float(q6(s.total_shares or 0)), float(q2(s.total_cost_gbp or 0)), float(q2(s.avg_cost_gbp or 0)), s.snapshot_json])
-        buf = io.BytesIO(); buf.write(si.getvalue().encode()); buf.seek(0); return send_file(buf, mimetype="text/csv", as_attachment=True, download_name="pool_snapshots.csv")
+        # One snapshot (and its decoded JSON) in memory at a time
+        snaps = run_rows(PoolSnapshot).order_by(PoolSnapshot.timestamp.desc()).limit(50).yield_per(1)
+        rows = ([s.timestamp.isoformat(), s.tax_year if s.tax_year else "", float(q6(s.total_shares or 0)), float(q2(s.total_cost_gbp or 0)), float(q2(s.avg_cost_gbp or 0)), s.snapshot_json]
+                for s in snaps)
+        return csv_response("pool_snapshots.csv", ["timestamp","tax_year","total_shares","total_cost_gbp","avg_cost_gbp","snapshot_json"], rows)
     elif kind == "summary":
         tax_start = date(tax_year,4,6); tax_end = date(tax_year+1,4,5)
-        disposals = DisposalResult.query.filter(DisposalResult.sale_date >= tax_start, DisposalResult.sale_date <= tax_end).order_by(DisposalResult.sale_date.asc()).all()
-        total_proceeds = sum([safe_decimal(r.proceeds_gbp or 0) for r in disposals])
-        total_cost = sum([safe_decimal(r.cost_basis_gbp or 0) for r in disposals])
-        total_gain = sum([safe_decimal(r.gain_gbp or 0) for r in disposals])
-        pos = sum([safe_decimal(r.gain_gbp) for r in disposals if safe_decimal(r.gain_gbp) > 0])
-        neg = sum([abs(safe_decimal(r.gain_gbp)) for r in disposals if safe_decimal(r.gain_gbp) < 0])
-        net_gain = pos - neg
-        if net_gain < 0: net_gain = Decimal("0")
-        sa = Setting.query.get("CGT_Allowance"); sb = Setting.query.get("CGT_Rate")
-        cgt_allowance = safe_decimal(sa.value) if sa and safe_decimal(sa.value) > 0 and tax_year < 2024 else get_aea(tax_year)
-        cgt_rate_pct = safe_decimal(sb.value) if sb else Decimal("20")
-        cgt_rate = cgt_rate_pct / Decimal("100")
-        taxable = net_gain - cgt_allowance
-        if taxable < 0: taxable = Decimal("0")
-        estimated_cgt = q2(taxable * cgt_rate)
-        cw.writerow(["tax_year_start","tax_year_end","cgt_allowance_gbp","cgt_rate_percent","total_disposals","total_proceeds","total_cost","total_gain","net_gain","taxable_after_allowance","estimated_cgt"])
-        cw.writerow([tax_start.isoformat(), tax_end.isoformat(), float(q2(cgt_allowance)), float(q2(cgt_rate_pct)), len(disposals), float(q2(total_proceeds)), float(q2(total_cost)), float(q2(total_gain)), float(q2(net_gain)), float(q2(taxable)), float(q2(estimated_cgt))])
-        buf = io.BytesIO(); buf.write(si.getvalue().encode()); buf.seek(0); return send_file(buf, mimetype="text/csv", as_attachment=True, download_name=f"summary_{tax_year}.csv")
+        row = get_tax_year_summary(tax_year)
+        return csv_response(f"summary_{tax_year}.csv",
+                            ["tax_year_start","tax_year_end","cgt_allowance_gbp","total_disposals","total_proceeds","total_cost","total_gain","net_gain","taxable_after_allowance","basic_taxable_gain","higher_taxable_gain","estimated_cgt"],
+                            [[tax_start.isoformat(), tax_end.isoformat(), float(q2(row.cgt_allowance_gbp)), row.disposal_count, float(q2(row.total_proceeds_gbp)), float(q2(row.total_cost_gbp)), float(q2(row.total_gain_gbp)), float(q2(row.net_gain_gbp)), float(q2(row.taxable_gain_gbp)), float(q2(row.basic_taxable_gbp)), float(q2(row.higher_taxable_gbp)), float(q2(row.estimated_cgt_gbp))]])
     else:
         return "Unknown kind", 404
 
+@functools.lru_cache(maxsize=4096)
+def rendered_trace(calculation_json, matching_type):
+    """(equations, explanation) for a disposal, rendered from its stored numeric trace.
+
+    Keyed on the JSON text rather than the disposal id, since ids are reused after a recalc.
+    Rows written before traces were rendered lazily keep their stored equations.
+    """
+    try:
+        calc = json.loads(calculation_json or "{}")
+    except ValueError:
+        return (), None
+    if "numeric_trace" not in calc:
+        return tuple(calc.get("equations") or ()), None
+    equations = calc.get("equations") or render_equations(calc["numeric_trace"])
+    return tuple(equations), render_explanation(calc, matching_type)
+
+def listing_columns(calculation_json):
+    """DisposalResult listing columns for a stored calculation_json (rows the engine writes get them directly)."""
+    try:
+        calc = json.loads(calculation_json or "{}")
+    except ValueError:
+        calc = {}
+    inputs = calc.get("inputs") or {}
+    lot = inputs.get("lot") or {}
+    snippet = (calc.get("equations") or (equation_snippet(calc["numeric_trace"]) if "numeric_trace" in calc else ()))[:SNIPPET_EQUATIONS]
+    return {"fragment_index": (calc.get("numeric_trace") or {}).get("fragment_index"), "lot_entry": lot.get("entry"),
+            "lot_source": lot.get("source"), "rate_used": inputs.get("sale_rate_used"), "equation_snippet": "\n".join(snippet)}
+
 @app.route("/clear_steps", methods=["POST"])
 def clear_steps():
-    CalculationStep.query.delete(); CalculationDetail.query.delete(); db.session.commit(); flash("Cleared steps and details", "info"); return redirect(url_for("audit"))
+    CalculationStep.query.delete(); CalculationDetail.query.delete(); data_changed(); db.session.commit(); flash("Cleared steps and details", "info"); return redirect(url_for("audit"))
 
 # ---------- API endpoints for UI ----------
+TRANSACTIONS_MAX_LIMIT = 5000
+
+# What transaction_item reads: plain column tuples, so listings build no ORM objects and decode no JSON
+LISTING_COLUMNS = (DisposalResult.id, DisposalResult.sale_date, DisposalResult.sale_input_id, DisposalResult.fragment_index,
+                   DisposalResult.matched_shares, DisposalResult.matching_type, DisposalResult.lot_entry, DisposalResult.matched_date,
+                   DisposalResult.lot_source, DisposalResult.rate_used, DisposalResult.avg_cost_gbp, DisposalResult.proceeds_gbp,
+                   DisposalResult.cost_basis_gbp, DisposalResult.gain_gbp, DisposalResult.equation_snippet)
+
+def transaction_item(r):
+    """Listing row for one DisposalResult (or a LISTING_COLUMNS row), as served by /api/transactions."""
+    return {
+        "disposal_id": r.id,
+        "sale_date": r.sale_date.isoformat() if r.sale_date else None,
+        "sale_input_id": r.sale_input_id,
+        "fragment_index": r.fragment_index or 1,
+        "matched_shares": float(q6(safe_decimal(r.matched_shares or 0))),
+        "matching_type": r.matching_type,
+        "lot_entry": r.lot_entry,
+        "matched_date": r.matched_date.isoformat() if r.matched_date else None,
+        "source": r.lot_source,
+        "rate_used": r.rate_used,
+        "avg_cost_gbp": float(q2(safe_decimal(r.avg_cost_gbp or 0))),
+        "proceeds_gbp": float(q2(safe_decimal(r.proceeds_gbp or 0))),
+        "cost_basis_gbp": float(q2(safe_decimal(r.cost_basis_gbp or 0))),
+        "gain_gbp": float(q2(safe_decimal(r.gain_gbp or 0))),
+        "pool_rsu_pct": 0.0,
+        "pool_espp_pct": 0.0,
+        "calculation_snippet": r.equation_snippet.split("\n") if r.equation_snippet else []
+    }
+
 @app.route("/api/transactions")
+@versioned_response
 def api_transactions():
-    ty = request.args.get("tax_year")
-    matching = request.args.get("matching")
-    q = request.args.get("q")
-    limit = int(request.args.get("limit") or 500)
-    items = []
-    query = DisposalResult.query.order_by(DisposalResult.sale_date.asc(), DisposalResult.id.asc())
-    rows = query.limit(5000).all()
+    """Disposal fragments of the published run in (sale_date, id) order, one keyset page at a time.
 
-    for r in rows:
-        calc = {}
-        if r.calculation_json:
-            try:
-                calc = json.loads(r.calculation_json)
-            except Exception:
-                calc = {}
-        pool_rsu_pct = 0.0
-        pool_espp_pct = 0.0
-        frag_idx = None
-        if calc.get("numeric_trace") and calc["numeric_trace"].get("fragment_index"):
-            frag_idx = calc["numeric_trace"]["fragment_index"]
-        item = {
-            "disposal_id": r.id,
-            "sale_date": r.sale_date.isoformat() if r.sale_date else None,
-            "sale_input_id": r.sale_input_id,
-            "fragment_index": frag_idx or 1,
-            "matched_shares": float(q6(safe_decimal(r.matched_shares or 0))),
-            "matching_type": r.matching_type,
-            "lot_entry": calc.get("inputs",{}).get("lot",{}).get("entry") if calc.get("inputs") else None,
-            "matched_date": r.matched_date.isoformat() if r.matched_date else None,
-            "source": calc.get("inputs",{}).get("lot",{}).get("source") if calc.get("inputs") else None,
-            "rate_used": calc.get("inputs",{}).get("sale_rate_used") if calc.get("inputs") else None,
-            "avg_cost_gbp": float(q2(safe_decimal(r.avg_cost_gbp or 0))),
-            "proceeds_gbp": float(q2(safe_decimal(r.proceeds_gbp or 0))),
-            "cost_basis_gbp": float(q2(safe_decimal(r.cost_basis_gbp or 0))),
-            "gain_gbp": float(q2(safe_decimal(r.gain_gbp or 0))),
-            "pool_rsu_pct": pool_rsu_pct,
-            "pool_espp_pct": pool_espp_pct,
-            "calculation_snippet": (calc.get("equations")[:3] if calc.get("equations") else [])
-        }
-        items.append(item)
+    Filters, all in SQL: tax_year, matching (type), sale_id, lot (exact lot entry) and q (substring
+    of the lot entry or sale id). Pass the response's next_after_id as ?after_id= for the following
+    page; it is null on the last page.
+    """
+    try:
+        ty, sale_id, after_id = (int(request.args[k]) if request.args.get(k) else None for k in ("tax_year", "sale_id", "after_id"))
+        limit = min(max(int(request.args.get("limit") or 500), 1), TRANSACTIONS_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"error": "tax_year, sale_id, after_id and limit must be integers"}), 400
+    matching = request.args.get("matching")
+    lot = request.args.get("lot")
+    q = (request.args.get("q") or "").lower()
 
+    query = run_rows(DisposalResult)
+    if ty is not None:
+        query = query.filter(DisposalResult.tax_year == ty)
     if matching:
-        items = [i for i in items if i.get("matching_type") == matching]
+        query = query.filter(DisposalResult.matching_type == matching)
+    if sale_id is not None:
+        query = query.filter(DisposalResult.sale_input_id == sale_id)
+    if lot:
+        query = query.filter(DisposalResult.lot_entry == lot)
     if q:
-        ql = q.lower()
-        items = [i for i in items if ql in (str(i.get("lot_entry") or "")).lower() or ql in (str(i.get("sale_input_id") or ""))]
+        pattern = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        query = query.filter(db.or_(DisposalResult.lot_entry.ilike(pattern, escape="\\"),
+                                    db.cast(DisposalResult.sale_input_id, db.String).like(pattern, escape="\\")))
+    if after_id is not None:
+        cursor = run_rows(DisposalResult).filter(DisposalResult.id == after_id).with_entities(DisposalResult.sale_date).first()
+        if cursor is None:
+            return jsonify({"error": f"after_id {after_id} is not in the current results; restart from the first page"}), 400
+        # Keyset: strictly after (sale_date, id) of the cursor row, served by ix_disposal_results_run_sale_date_id
+        query = query.filter(db.tuple_(DisposalResult.sale_date, DisposalResult.id) > db.tuple_(cursor.sale_date, after_id))
+    query = query.order_by(DisposalResult.sale_date.asc(), DisposalResult.id.asc())
+
+    items = [transaction_item(r) for r in query.with_entities(*LISTING_COLUMNS).limit(limit + 1)]
+    more = len(items) > limit
     items = items[:limit]
-    return jsonify({"items": items, "count": len(items)})
+    return jsonify({"items": items, "count": len(items), "next_after_id": items[-1]["disposal_id"] if more else None})
 
 @app.route("/api/transaction/<int:id>")
 def api_transaction(id):
@@ -1518,8 +1891,13 @@ def api_transaction(id):
             calc = json.loads(r.calculation_json)
         except Exception:
             calc = {"raw": r.calculation_json}
+    equations, explanation = rendered_trace(r.calculation_json, r.matching_type)
+    if equations:
+        calc["equations"] = list(equations)
     details = CalculationDetail.query.filter_by(disposal_id=r.id).order_by(CalculationDetail.created_at.asc()).all()
     details_list = [{"equations": d.equations, "explanation": d.explanation} for d in details]
+    if not details_list and explanation:
+        details_list = [{"equations": "\n".join(equations), "explanation": explanation}]
     return jsonify({
         "disposal_id": r.id,
         "sale_date": r.sale_date.isoformat() if r.sale_date else None,
@@ -1590,27 +1968,46 @@ def fetch_stock_history(ticker: str, days: int = 365) -> pd.DataFrame:
         raise ValueError(f"Failed to fetch historical data for {ticker}")
 
 
+def upsert_stock_data(rows, replace=False):
+    """Write StockData rows (built but not added to the session) in one INSERT ... ON CONFLICT on
+    (ticker, is_prediction, date): a stored row is kept, or overwritten when `replace` is set
+    (predictions are refreshed on every run). Returns rows written; the caller commits."""
+    if not rows:
+        return 0
+    key = ["ticker", "is_prediction", "date"]
+    columns = [c.name for c in StockData.__table__.columns if c.name != "id"]
+    values = [{**{name: getattr(r, name) for name in columns}, "is_prediction": bool(r.is_prediction)} for r in rows]
+    stmt = sqlite_insert(StockData.__table__)
+    if replace:
+        stmt = stmt.on_conflict_do_update(index_elements=key, set_={name: stmt.excluded[name] for name in columns if name not in key})
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=key)
+    return db.session.execute(stmt, values).rowcount
+
+
 def cache_stock_data(df: pd.DataFrame, ticker: str, rates_list: list = None):
-    """Cache historical data to StockData, converting to GBP."""
+    """Cache historical data to StockData, converting to GBP; days already cached are kept."""
     if df.empty:
         return
-    rates = load_rates_sorted() if rates_list is None else rates_list
-    for _, row in df.iterrows():
-        date = row['Date']
+    if rates_list and not len(fx_index()):  # no daily rates stored: caller's year-based fallback
+        rates = df['Date'].map(lambda d: get_rate_for_date(d, rates_list))
+    else:
+        rates = resolve_rates(df['Date'])
+    rows = []
+    for i, row in df.iterrows():
         price_usd = safe_decimal(row['price_usd'])
-        rate = get_rate_for_date(date, rates)
+        rate = rates.at[i]
         price_gbp = price_usd / rate if rate != 0 else price_usd
-        existing = StockData.query.filter_by(ticker=ticker, date=date).first()
-        if not existing:
-            sd = StockData(
-                ticker=ticker,
-                date=date,
-                price_usd=price_usd,
-                price_gbp=price_gbp,
-                volume=int(row['Volume']) if 'Volume' in row else None,
-                notes=f"Fetched from yfinance on {datetime.now().date()}"
-            )
-            db.session.add(sd)
+        rows.append(StockData(
+            ticker=ticker,
+            date=to_date(row['Date']),
+            price_usd=price_usd,
+            price_gbp=price_gbp,
+            volume=int(row['Volume']) if 'Volume' in row else None,
+            is_prediction=False,
+            notes=f"Fetched from yfinance on {datetime.now().date()}"
+        ))
+    upsert_stock_data(rows)
     db.session.commit()
 
 
@@ -1625,8 +2022,6 @@ def get_cached_history(ticker: str, days: int = 365) -> list:
         StockData.is_prediction == False
     ).order_by(StockData.date.asc()).all()
     
-    rates = load_rates_sorted()
-    
     if len(cached) < days * 0.8:  # If <80% cached, refresh
         hist_df = fetch_stock_history(ticker, days)
         if not hist_df.empty:
@@ -1641,12 +2036,13 @@ def get_cached_history(ticker: str, days: int = 365) -> list:
     
     # Reconstruct df and compute indicators if not cached (for now, compute always)
     if cached:
+        rates = resolve_rates([sd.date for sd in cached])
         df = pd.DataFrame([{
             'date': sd.date,
             'price_usd': float(sd.price_usd),
-            'price_gbp': float(sd.price_gbp) if sd.price_gbp else (float(sd.price_usd) / get_rate_for_date(sd.date, rates) or float(sd.price_usd)),
+            'price_gbp': float(sd.price_gbp) if sd.price_gbp else (float(sd.price_usd) / float(rate) or float(sd.price_usd)),
             'volume': sd.volume
-        } for sd in cached])
+        } for sd, rate in zip(cached, rates)])
         df = compute_indicators(df)
         # Update return to include indicators
         return [{
@@ -1717,6 +2113,7 @@ def predict_prices(ticker: str, method: str = 'sma', horizon: int = 30, history_
         recent_rsi = None
     
     predictions = []
+    cached = []  # StockData prediction rows, upserted together below
     last_date = pd.to_datetime(df['date'].max())
     rates = load_rates_sorted()
     last_rate = get_rate_for_date(last_date.date(), rates) or Decimal('1')
@@ -1753,7 +2150,7 @@ def predict_prices(ticker: str, method: str = 'sma', horizon: int = 30, history_
                     prediction_json=json.dumps({'base': float(base_pred), 'confidence': confidence}),
                     notes=f"Predicted {method} horizon {i}"
                 )
-                db.session.add(sd)
+                cached.append(sd)
             except Exception as cache_err:
                 print(f"Cache error: {cache_err}")
     
@@ -1790,7 +2187,7 @@ def predict_prices(ticker: str, method: str = 'sma', horizon: int = 30, history_
                     prediction_json=json.dumps({'base_ema': float(base_pred), 'alpha': str(alpha), 'confidence': float(confidence)}),
                     notes=f"Predicted {method} horizon {i}"
                 )
-                db.session.add(sd)
+                cached.append(sd)
             except Exception as cache_err:
                 print(f"Cache error: {cache_err}")
             current_ema = alpha * pred_price_gbp + (Decimal('1') - alpha) * current_ema
@@ -1828,7 +2225,7 @@ def predict_prices(ticker: str, method: str = 'sma', horizon: int = 30, history_
                     prediction_json=json.dumps({'slope': slope, 'intercept': intercept, 'r_squared': confidence}),
                     notes=f"Predicted {method} horizon {i}"
                 )
-                db.session.add(sd)
+                cached.append(sd)
             except Exception as cache_err:
                 print(f"Cache error: {cache_err}")
     
@@ -1865,7 +2262,7 @@ def predict_prices(ticker: str, method: str = 'sma', horizon: int = 30, history_
                         prediction_json=json.dumps({'aic': aic, 'order': (1,1,1), 'confidence': float(confidence)}),
                         notes=f"Predicted {method} horizon {i+1}"
                     )
-                    db.session.add(sd)
+                    cached.append(sd)
                 except Exception as cache_err:
                     print(f"Cache error: {cache_err}")
         except Exception as e:
@@ -1873,8 +2270,10 @@ def predict_prices(ticker: str, method: str = 'sma', horizon: int = 30, history_
             return predict_prices(ticker, 'sma', horizon, history_days)  # Recursive fallback
     
     try:
+        upsert_stock_data(cached, replace=True)
         db.session.commit()
     except Exception as commit_err:
+        db.session.rollback()
         print(f"Commit error: {commit_err}")
     
     return predictions
@@ -1889,7 +2288,7 @@ def optimize_sell(ticker: str, horizon: int = 30, shares_fraction: float = 1.0)
             raise ValueError("No predictions available")
 
         # Get current pool snapshot
-        latest_snapshot = PoolSnapshot.query.order_by(PoolSnapshot.timestamp.desc()).first()
+        latest_snapshot = run_rows(PoolSnapshot).order_by(PoolSnapshot.timestamp.desc()).first()
         if not latest_snapshot or safe_decimal(latest_snapshot.total_shares) <= 0:
             raise ValueError("No share pool available; run full recalc_all first")
     
@@ -2111,17 +2510,78 @@ def get_stock_history():
         return jsonify({"error": f"History fetch failed: {str(e)}. Ensure yfinance installed and network OK."}), 500
 
 
+@app.route("/api/archive", methods=["GET", "POST"])
+def api_archive():
+    """GET: archived tax years. POST {"years": [...]} (optional): (re)write closed years to the archive."""
+    if request.method == "POST":
+        years = (request.get_json(silent=True) or {}).get("years")
+        if years is not None and not (isinstance(years, list) and all(isinstance(y, int) for y in years)):
+            return jsonify({"error": "years must be a list of tax years"}), 400
+        written = archive_tax_years(years)
+        return jsonify({"archived": [{"tax_year": y, "fragments": n, "file": os.path.basename(path)} for y, n, path in written]})
+    return jsonify({"tax_years": cgt_archive.archived_years(ARCHIVE_DIR), "format": "parquet" if cgt_archive.HAS_PYARROW else "csv.gz"})
+
+@app.route("/api/archive/<int:year>")
+def api_archive_year(year):
+    """Fragment counts and totals for an archived year, grouped by ?by=matching_type,lot_source; read from the archive file only."""
+    by = [c for c in request.args.get("by", "matching_type,lot_source").split(",") if c]
+    try:
+        groups = cgt_archive.summarise_year(ARCHIVE_DIR, year, by=by)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if groups is None:
+        return jsonify({"error": f"Tax year {year} is not archived"}), 404
+    money = ("matched_shares", "proceeds_gbp", "cost_basis_gbp", "gain_gbp")
+    return jsonify({"tax_year": year, "by": by, "groups": [
+        {k: float(v) if k in money else (v.isoformat() if isinstance(v, date) else v) for k, v in g.items()} for g in groups]})
+
+@app.route("/api/rates/resolve", methods=["GET", "POST"])
+def api_resolve_rates():
+    """USD/GBP rate per date for a whole table: ?dates=2024-01-05,2024-01-06 or POST {"dates": [...]}."""
+    if request.method == "POST":
+        dates = (request.get_json(silent=True) or {}).get("dates")
+    else:
+        dates = [d for d in request.args.get("dates", "").split(",") if d.strip()]
+    if not isinstance(dates, list):
+        return jsonify({"error": "dates must be a list of YYYY-MM-DD strings"}), 400
+    parsed = []
+    for i, d in enumerate(dates):
+        try:
+            parsed.append(to_date(d.strip()) if isinstance(d, str) else None)
+        except ValueError:
+            parsed.append(None)
+        if parsed[-1] is None:
+            return jsonify({"error": f"dates[{i}] is not a YYYY-MM-DD date: {d!r}"}), 400
+    rates = resolve_rates(parsed)
+    return jsonify({"dates": [d.isoformat() for d in parsed], "rates": [float(r) for r in rates]})
+
+
 @app.route("/api/snapshot/<int:year>")
+@versioned_response
 def api_snapshot(year):
-    snapshot = PoolSnapshot.query.filter_by(tax_year=year).order_by(PoolSnapshot.timestamp.desc()).first()
+    """Latest pool snapshot for a tax year.
+
+    snapshot_json holds the delta-encoded per-sale snapshots; pool_after is the full pool
+    rebuilt for the year's last sale, or for ?sale_id= when given.
+    """
+    snapshot = run_rows(PoolSnapshot).filter_by(tax_year=year).order_by(PoolSnapshot.timestamp.desc()).first()
     if not snapshot:
         return jsonify({"error": "No snapshot for year"}), 404
+    per_sale = json.loads(snapshot.snapshot_json or "[]")
+    index = len(per_sale) - 1
+    sale_id = request.args.get("sale_id", type=int)
+    if sale_id is not None:
+        index = next((i for i, snap in enumerate(per_sale) if snap["sale"]["id"] == sale_id), None)
+        if index is None:
+            return jsonify({"error": f"Sale {sale_id} not in {year} snapshot"}), 404
     return jsonify({
         "timestamp": snapshot.timestamp.isoformat(),
         "tax_year": snapshot.tax_year,
         "total_shares": float(q6(safe_decimal(snapshot.total_shares or 0))),
         "total_cost_gbp": float(q2(safe_decimal(snapshot.total_cost_gbp or 0))),
         "avg_cost_gbp": float(q2(safe_decimal(snapshot.avg_cost_gbp or 0))),
+        "sale_id": per_sale[index]["sale"]["id"] if per_sale else None,
+        "pool_after": pool_at(per_sale, index) if per_sale else [],
         "snapshot_json": snapshot.snapshot_json
     })
 
@@ -2137,123 +2597,53 @@ def api_update_settings():
     else:
         setting = Setting(key=key, value=str(value))
         db.session.add(setting)
+    db.session.flush()
+    refresh_tax_year_summaries()
+    data_changed()
     db.session.commit()
     return jsonify({"success": True, "key": key, "value": value})
 
 @app.route("/api/summary/<int:year>")
+@versioned_response
 def api_summary(year):
-    tax_start = date(year, 4, 6)
-    tax_end = date(year + 1, 4, 5)
-    disposals = DisposalResult.query.filter(
-        DisposalResult.sale_date >= tax_start,
-        DisposalResult.sale_date <= tax_end
-    ).order_by(DisposalResult.sale_date.asc()).all()
-    
-    total_proceeds = safe_decimal(sum([safe_decimal(r.proceeds_gbp or 0) for r in disposals]))
-    total_cost = safe_decimal(sum([safe_decimal(r.cost_basis_gbp or 0) for r in disposals]))
-    total_gain = safe_decimal(sum([safe_decimal(r.gain_gbp or 0) for r in disposals]))
-    pos = safe_decimal(sum([safe_decimal(r.gain_gbp) for r in disposals if safe_decimal(r.gain_gbp) > 0]))
-    neg = safe_decimal(sum([abs(safe_decimal(r.gain_gbp)) for r in disposals if safe_decimal(r.gain_gbp) < 0]))
-    net_gain = pos - neg
-    if net_gain < 0:
-        net_gain = Decimal("0")
-    
-    # Apply carry-forward losses from previous years
-    carry_forward_losses = CarryForwardLoss.query.filter(CarryForwardLoss.tax_year < year).all()
-    total_carry_forward_loss = safe_decimal(sum(safe_decimal(loss.amount) for loss in carry_forward_losses))
-    
-    # Subtract carry-forward losses from net gain before applying allowance
-    net_gain_after_losses = max(Decimal("0"), net_gain - total_carry_forward_loss)
-    
-    sa = db.session.get(Setting, "CGT_Allowance")
-    sc = db.session.get(Setting, "NonSavingsIncome")
-    sd = db.session.get(Setting, "BasicBandThreshold")
-    cgt_allowance = safe_decimal(sa.value) if sa and safe_decimal(sa.value) > 0 and year < 2024 else get_aea(year)
-    non_savings_income = safe_decimal(sc.value) if sc else Decimal("0")
-    basic_threshold = safe_decimal(sd.value) if sd else Decimal("37700")
-    basic_band_available = max(Decimal("0"), basic_threshold - non_savings_income)
-    taxable_gain = net_gain_after_losses - cgt_allowance
-    if taxable_gain < 0:
-        taxable_gain = Decimal("0")
-    basic_taxable = min(taxable_gain, basic_band_available)
-    higher_taxable = taxable_gain - basic_taxable
-    estimated_cgt = q2(basic_taxable * Decimal("0.10") + higher_taxable * Decimal("0.20"))
-    
+    row = get_tax_year_summary(year)
     return jsonify({
-        "tax_year_start": tax_start.isoformat(),
-        "tax_year_end": tax_end.isoformat(),
-        "cgt_allowance_gbp": float(q2(cgt_allowance)),
-        "carry_forward_loss_gbp": float(q2(total_carry_forward_loss)),
-        "net_gain_after_losses": float(q2(net_gain_after_losses)),
-        "non_savings_income": float(q2(non_savings_income)),
-        "basic_threshold": float(q2(basic_threshold)),
-        "basic_band_available": float(q2(basic_band_available)),
-        "total_disposals": len(disposals),
-        "total_proceeds": float(q2(total_proceeds)),
-        "total_cost": float(q2(total_cost)),
-        "total_gain": float(q2(total_gain)),
-        "pos": float(q2(pos)),
-        "neg": float(q2(neg)),
-        "net_gain": float(q2(net_gain)),
-        "taxable_after_allowance": float(q2(taxable_gain)),
-        "basic_taxable_gain": float(q2(basic_taxable)),
-        "higher_taxable_gain": float(q2(higher_taxable)),
-        "estimated_cgt": float(q2(estimated_cgt))
+        "tax_year_start": date(year, 4, 6).isoformat(),
+        "tax_year_end": date(year + 1, 4, 5).isoformat(),
+        "cgt_allowance_gbp": float(q2(row.cgt_allowance_gbp)),
+        "carry_forward_loss_gbp": float(q2(row.carry_forward_loss_gbp)),
+        "net_gain_after_losses": float(q2(row.net_gain_after_losses_gbp)),
+        "non_savings_income": float(q2(row.non_savings_income_gbp)),
+        "basic_threshold": float(q2(row.basic_threshold_gbp)),
+        "basic_band_available": float(q2(row.basic_band_available_gbp)),
+        "total_disposals": row.disposal_count,
+        "total_proceeds": float(q2(row.total_proceeds_gbp)),
+        "total_cost": float(q2(row.total_cost_gbp)),
+        "total_gain": float(q2(row.total_gain_gbp)),
+        "pos": float(q2(row.gains_gbp)),
+        "neg": float(q2(row.losses_gbp)),
+        "net_gain": float(q2(row.net_gain_gbp)),
+        "taxable_after_allowance": float(q2(row.taxable_gain_gbp)),
+        "basic_taxable_gain": float(q2(row.basic_taxable_gbp)),
+        "higher_taxable_gain": float(q2(row.higher_taxable_gbp)),
+        "estimated_cgt": float(q2(row.estimated_cgt_gbp))
     })
 
 @app.route("/api/tax_years", methods=["GET"])
+@versioned_response
 def api_tax_years():
     """Return unique tax years from existing data."""
-    from collections import defaultdict
-    years = set()
-    # From sales
-    sales = SaleInput.query.all()
-    for s in sales:
-        ty = s.date.year if s.date >= date(s.date.year, 4, 6) else s.date.year - 1
-        years.add(ty)
-    # From disposals (if no sales)
-    disposals = DisposalResult.query.all()
-    for d in disposals:
-        if d.sale_date:
-            ty = d.sale_date.year if d.sale_date >= date(d.sale_date.year, 4, 6) else d.sale_date.year - 1
-            years.add(ty)
-    return jsonify(sorted(list(years)))
+    return jsonify(run_tax_years(with_sales=True))
 
 @app.route("/api/export/sa108/<int:year>")
+@versioned_response
 def api_export_sa108(year):
     tax_start = date(year, 4, 6)
     tax_end = date(year + 1, 4, 5)
-    disposals = DisposalResult.query.filter(
-        DisposalResult.sale_date >= tax_start,
-        DisposalResult.sale_date <= tax_end
-    ).order_by(DisposalResult.sale_date.asc()).all()
-    
-    if not disposals:
+    row = get_tax_year_summary(year)
+    if not row.disposal_count:
         return jsonify({"error": "No disposals for the tax year"}), 404
-    
-    # Compute aggregates similar to summary
-    total_proceeds = sum([safe_decimal(r.proceeds_gbp or 0) for r in disposals])
-    total_cost = sum([safe_decimal(r.cost_basis_gbp or 0) for r in disposals])
-    total_gain = sum([safe_decimal(r.gain_gbp or 0) for r in disposals])
-    pos_gains = sum([safe_decimal(r.gain_gbp) for r in disposals if safe_decimal(r.gain_gbp) > 0])
-    losses = sum([abs(safe_decimal(r.gain_gbp)) for r in disposals if safe_decimal(r.gain_gbp) < 0])
-    net_gain = pos_gains - losses
-    if net_gain < 0:
-        net_gain = Decimal("0")
-        allowable_loss = abs(net_gain)
-        net_gain = Decimal("0")
-    else:
-        allowable_loss = Decimal("0")
-    
-    # Carry-forward losses
-    carry_forward_losses = CarryForwardLoss.query.filter(CarryForwardLoss.tax_year < year).all()
-    total_carry_forward_loss = sum(safe_decimal(loss.amount) for loss in carry_forward_losses)
-    net_gain_after_losses = max(Decimal("0"), net_gain - total_carry_forward_loss)
-    
-    # Allowance and tax
-    sa = Setting.query.get("CGT_Allowance")
-    cgt_allowance = safe_decimal(sa.value) if sa and safe_decimal(sa.value) > 0 and year < 2024 else get_aea(year)
-    chargeable_gain = max(Decimal("0"), net_gain_after_losses - cgt_allowance)
+    disposals = run_rows(DisposalResult).filter(DisposalResult.tax_year == year).order_by(DisposalResult.sale_date.asc()).all()
     
     # Simplified disposals list for SA108 Box 3 (UK assets)
     uk_disposals = []  # Assuming all are shares in UK-listed companies or treated as such
@@ -2271,16 +2661,16 @@ def api_export_sa108(year):
         "tax_year": year,
         "tax_year_start": tax_start.isoformat(),
         "tax_year_end": tax_end.isoformat(),
-        "total_proceeds": float(q2(total_proceeds)),
-        "total_costs": float(q2(total_cost)),
-        "total_gains": float(q2(pos_gains)),
-        "total_losses": float(q2(losses)),
-        "net_gain": float(q2(net_gain)),
-        "allowable_loss": float(q2(allowable_loss)),
-        "carry_forward_loss_used": float(q2(total_carry_forward_loss)),
-        "net_gain_after_losses": float(q2(net_gain_after_losses)),
-        "cgt_allowance_used": float(q2(min(cgt_allowance, net_gain_after_losses))),
-        "chargeable_gain": float(q2(chargeable_gain)),
+        "total_proceeds": float(q2(row.total_proceeds_gbp)),
+        "total_costs": float(q2(row.total_cost_gbp)),
+        "total_gains": float(q2(row.gains_gbp)),
+        "total_losses": float(q2(row.losses_gbp)),
+        "net_gain": float(q2(row.net_gain_gbp)),
+        "allowable_loss": float(q2(row.excess_loss_gbp)),
+        "carry_forward_loss_used": float(q2(row.carry_forward_loss_gbp)),
+        "net_gain_after_losses": float(q2(row.net_gain_after_losses_gbp)),
+        "cgt_allowance_used": float(q2(min(row.cgt_allowance_gbp, row.net_gain_after_losses_gbp))),
+        "chargeable_gain": float(q2(row.taxable_gain_gbp)),
         "disposals": uk_disposals  # For Box 3 details
     }
     
@@ -2355,6 +2745,7 @@ def create_vesting():
             net_shares=safe_decimal(data.get('net_shares'))
         )
         db.session.add(v)
+        data_changed()
         db.session.commit()
         # Trigger partial recalc
         recalc_all(sale_filter=date_val.isoformat())
@@ -2384,6 +2775,7 @@ def update_vesting(id):
         new_shares = safe_decimal(data.get('shares_vested', v.shares_vested))
         if new_shares <= 0:
             raise ValueError("Shares vested must be positive")
+        old_date = v.date
         v.date = new_date
         v.shares_vested = new_shares
         v.price_usd = safe_decimal(data.get('price_usd', v.price_usd))
@@ -2394,9 +2786,10 @@ def update_vesting(id):
         v.tax_paid_gbp = safe_decimal(data.get('tax_paid_gbp', v.tax_paid_gbp))
         v.incidental_costs_gbp = safe_decimal(data.get('incidental_costs_gbp', v.incidental_costs_gbp))
         v.net_shares = safe_decimal(data.get('net_shares', v.net_shares))
+        data_changed()
         db.session.commit()
-        # Partial recalc from new_date
-        recalc_all(sale_filter=new_date.isoformat())
+        # Partial recalc from the earlier of the old and new dates
+        recalc_all(sale_filter=min(old_date, new_date).isoformat())
         return jsonify(model_to_dict(v))
     except ValueError as ve:
         db.session.rollback()
@@ -2408,8 +2801,12 @@ def update_vesting(id):
 @app.route('/api/vestings/<int:id>', methods=['DELETE'])
 def api_delete_vesting(id):
     v = Vesting.query.get_or_404(id)
+    d = v.date
     db.session.delete(v)
+    data_changed()
     db.session.commit()
+    # Replay the sales that could have matched the lot
+    recalc_all(sale_filter=d.isoformat())
     return jsonify({'message': 'Vesting deleted'})
 
 # ---------- CRUD APIs for ESPP ----------
@@ -2449,6 +2846,7 @@ def create_espp():
             notes=data.get('notes', '')
         )
         db.session.add(p)
+        data_changed()
         db.session.commit()
         # Trigger partial recalc
         recalc_all(sale_filter=date_val.isoformat())
@@ -2487,6 +2885,7 @@ def update_espp(id):
                 raise ValueError(f"ESPP discount {discount:.2f}% > 15%. Set qualifying=False for non-qualifying plans or adjust prices.")
         else:
             discount = safe_decimal(data.get('discount', p.discount))
+        old_date = p.date
         p.date = new_date
         p.shares_retained = new_shares
         p.purchase_price_usd = purchase_price
@@ -2499,9 +2898,10 @@ def update_espp(id):
         p.qualifying = qualifying
         p.incidental_costs_gbp = safe_decimal(data.get('incidental_costs_gbp', p.incidental_costs_gbp))
         p.notes = data.get('notes', p.notes)
+        data_changed()
         db.session.commit()
-        # Partial recalc
-        recalc_all(sale_filter=new_date.isoformat())
+        # Partial recalc from the earlier of the old and new dates
+        recalc_all(sale_filter=min(old_date, new_date).isoformat())
         return jsonify(model_to_dict(p))
     except ValueError as ve:
         db.session.rollback()
@@ -2513,8 +2913,11 @@ def update_espp(id):
 @app.route('/api/espp/<int:id>', methods=['DELETE'])
 def api_delete_espp(id):
     p = ESPPPurchase.query.get_or_404(id)
+    d = p.date
     db.session.delete(p)
+    data_changed()
     db.session.commit()
+    recalc_all(sale_filter=d.isoformat())
     return jsonify({'message': 'ESPP deleted'})
 
 # ---------- CRUD APIs for Sales ----------
@@ -2538,6 +2941,7 @@ def create_sale():
             incidental_costs_gbp=safe_decimal(data.get('incidental_costs_gbp', 0))
         )
         db.session.add(s)
+        data_changed()
         db.session.commit()
         # Trigger partial recalc for this sale
         recalc_all(sale_filter=[s.id])
@@ -2567,14 +2971,16 @@ def update_sale(id):
         new_shares = safe_decimal(data.get('shares_sold', s.shares_sold))
         if new_shares <= 0:
             raise ValueError("Shares sold must be positive")
+        old_date = s.date
         s.date = new_date
         s.shares_sold = new_shares
         s.sale_price_usd = safe_decimal(data.get('sale_price_usd', s.sale_price_usd))
         s.exchange_rate = safe_decimal(data.get('exchange_rate', s.exchange_rate))
         s.incidental_costs_gbp = safe_decimal(data.get('incidental_costs_gbp', s.incidental_costs_gbp))
+        data_changed()
         db.session.commit()
-        # Recompute this sale
-        recalc_all(sale_filter=[s.id])
+        # Replay from the earlier of the old and new sale dates
+        recalc_all(sale_filter=min(old_date, new_date).isoformat())
         return jsonify(model_to_dict(s))
     except ValueError as ve:
         db.session.rollback()
@@ -2586,105 +2992,200 @@ def update_sale(id):
 @app.route('/api/sales/<int:id>', methods=['DELETE'])
 def api_delete_sale(id):
     s = SaleInput.query.get_or_404(id)
+    d = s.date
     db.session.delete(s)
+    data_changed()
     db.session.commit()
+    # Later sales match against the shares it no longer takes
+    recalc_all(sale_filter=d.isoformat())
     return jsonify({'message': 'Sale deleted'})
 
 # ---------- Migration helper and bootstrap ----------
+# ---------- Schema migrations ----------
+# Each migration upgrades an existing database file by one version; the version reached is stored
+# in SQLite's PRAGMA user_version, so startup on a current schema is a single pragma read. Tables
+# missing altogether are left to db.create_all(), which builds them (indexes included) from the
+# models, so every step only touches tables that already exist. Append new steps; never reorder.
+
+def _table_exists(c, table):
+    return c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone() is not None
+
+def _add_missing_columns(c, table, columns):
+    """ALTER TABLE ADD COLUMN for each (name, ddl) not already on `table`."""
+    existing = {r[1] for r in c.execute(f"PRAGMA table_info({table})")}
+    for name, ddl in columns:
+        if name not in existing:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+
+def _migrate_legacy_columns(c):
+    """Columns added to the original tables before migrations were versioned."""
+    legacy = {
+        "vesting": [("incidental_costs_gbp", "NUMERIC DEFAULT 0")],
+        "espp": [("shares_retained", "NUMERIC"), ("purchase_price_usd", "NUMERIC"), ("market_price_usd", "NUMERIC"),
+                 ("discount_taxed_paye", "BOOLEAN"), ("paye_tax_gbp", "NUMERIC"), ("exchange_rate", "NUMERIC"),
+                 ("incidental_costs_gbp", "NUMERIC DEFAULT 0"), ("qualifying", "BOOLEAN DEFAULT 1")],
+        "sales_in": [("exchange_rate", "NUMERIC"), ("incidental_costs_gbp", "NUMERIC DEFAULT 0")],
+        "pool_snapshot": [("tax_year", "INTEGER"), ("snapshot_json", "TEXT"), ("total_shares", "NUMERIC"),
+                          ("total_cost_gbp", "NUMERIC"), ("avg_cost_gbp", "NUMERIC")],
+        "disposal_results": [("calculation_json", "TEXT")],
+    }
+    for table, columns in legacy.items():
+        if _table_exists(c, table):
+            _add_missing_columns(c, table, columns)
+
+def _migrate_unique_rate_dates(c):
+    """One rate per date (the BoE importer upserts against it): keep the first row stored for each
+    date, which is the one lookups already used, then make the date index unique."""
+    if not _table_exists(c, "exchange_rates"):
+        return
+    idx = c.execute("SELECT sql FROM sqlite_master WHERE type='index' AND name='ix_exchange_rates_date'").fetchone()
+    if idx is None or "UNIQUE" not in (idx[0] or "").upper():
+        c.execute("DELETE FROM exchange_rates WHERE id NOT IN (SELECT MIN(id) FROM exchange_rates GROUP BY date)")
+        c.execute("DROP INDEX IF EXISTS ix_exchange_rates_date")
+        c.execute("CREATE UNIQUE INDEX ix_exchange_rates_date ON exchange_rates (date)")
+
+def _migrate_hot_query_indexes(c):
+    """Indexes for the stock cache lookups and the disposal listing / per-sale queries."""
+    if _table_exists(c, "stock_data"):
+        # The original CREATE TABLE declared its (ticker, date) index inline, which SQLite rejects,
+        # so it never existed and repeated fetches stored duplicate rows: keep the first of each
+        c.execute("UPDATE stock_data SET is_prediction = 0 WHERE is_prediction IS NULL")
+        c.execute("DELETE FROM stock_data WHERE id NOT IN (SELECT MIN(id) FROM stock_data GROUP BY ticker, is_prediction, date)")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_stock_data_ticker_prediction_date ON stock_data (ticker, is_prediction, date)")
+    if _table_exists(c, "disposal_results"):
+        # A SQLite index already ends in the rowid, so (sale_date, id) replaces the sale_date index
+        c.execute("DROP INDEX IF EXISTS ix_disposal_results_sale_date")
+        c.execute("CREATE INDEX IF NOT EXISTS ix_disposal_results_sale_date_id ON disposal_results (sale_date, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS ix_disposal_results_sale_input_id ON disposal_results (sale_input_id)")
+
+def _migrate_calc_runs(c):
+    """Run-versioned results: existing rows become run 0, which readers see until the first new run is
+    published. tax_year_summaries is rebuilt with its (calc_run_id, tax_year) key by db.create_all and
+    backfilled on first read."""
+    for table in ("disposal_results", "pool_snapshot", "calculation_steps", "pool_checkpoints"):
+        if _table_exists(c, table):
+            _add_missing_columns(c, table, [("calc_run_id", "INTEGER NOT NULL DEFAULT 0")])
+            if table != "disposal_results":
+                c.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_calc_run_id ON {table} (calc_run_id)")
+    if _table_exists(c, "disposal_results"):
+        c.execute("DROP INDEX IF EXISTS ix_disposal_results_sale_date_id")
+        c.execute("CREATE INDEX IF NOT EXISTS ix_disposal_results_run_sale_date_id ON disposal_results (calc_run_id, sale_date, id)")
+    c.execute("DROP TABLE IF EXISTS tax_year_summaries")
+
+def _migrate_listing_columns(c):
+    """DisposalResult listing columns, backfilled from each row's calculation_json in id order."""
+    if not _table_exists(c, "disposal_results"):
+        return
+    _add_missing_columns(c, "disposal_results", [("fragment_index", "INTEGER"), ("lot_entry", "VARCHAR(32)"), ("lot_source", "VARCHAR(16)"),
+                                                 ("rate_used", "VARCHAR(40)"), ("equation_snippet", "TEXT")])
+    c.execute("CREATE INDEX IF NOT EXISTS ix_disposal_results_run_lot_entry ON disposal_results (calc_run_id, lot_entry)")
+    last_id = 0
+    while True:
+        rows = c.execute("SELECT id, calculation_json FROM disposal_results WHERE id > ? ORDER BY id LIMIT 1000", (last_id,)).fetchall()
+        if not rows:
+            break
+        c.executemany("UPDATE disposal_results SET fragment_index = :fragment_index, lot_entry = :lot_entry, lot_source = :lot_source, "
+                      "rate_used = :rate_used, equation_snippet = :equation_snippet WHERE id = :id",
+                      [dict(listing_columns(cgt_blob.decode(calc)), id=row_id) for row_id, calc in rows])
+        last_id = rows[-1][0]
+
+def _tax_year_sql(column):
+    """SQL for tax_year_of() over a stored ISO date column."""
+    return f"CAST(substr({column}, 1, 4) AS INTEGER) - (substr({column}, 6, 5) < '04-06')"
+
+def _migrate_tax_year_columns(c):
+    """Stored tax_year on sales, disposals and steps, backfilled from the dates; steps take their sale's year."""
+    if _table_exists(c, "sales_in"):
+        _add_missing_columns(c, "sales_in", [("tax_year", "INTEGER")])
+        c.execute(f"UPDATE sales_in SET tax_year = {_tax_year_sql('date')} WHERE date IS NOT NULL")
+        c.execute("CREATE INDEX IF NOT EXISTS ix_sales_in_tax_year ON sales_in (tax_year)")
+    if _table_exists(c, "disposal_results"):
+        _add_missing_columns(c, "disposal_results", [("tax_year", "INTEGER")])
+        c.execute(f"UPDATE disposal_results SET tax_year = {_tax_year_sql('sale_date')} WHERE sale_date IS NOT NULL")
+        c.execute("CREATE INDEX IF NOT EXISTS ix_disposal_results_run_year_sale_date_id ON disposal_results (calc_run_id, tax_year, sale_date, id)")
+    if _table_exists(c, "calculation_steps"):
+        _add_missing_columns(c, "calculation_steps", [("tax_year", "INTEGER")])
+        if _table_exists(c, "sales_in"):
+            c.execute("UPDATE calculation_steps SET tax_year = (SELECT tax_year FROM sales_in WHERE sales_in.id = calculation_steps.sale_input_id) "
+                      "WHERE sale_input_id IS NOT NULL")
+        c.execute("CREATE INDEX IF NOT EXISTS ix_calculation_steps_run_tax_year ON calculation_steps (calc_run_id, tax_year)")
+
+def _migrate_shared_run_rows(c):
+    """Result rows shared between runs (see visible_in). Each run used to hold a full copy: a row of
+    run R is now superseded by the next complete run after R, and rows of runs never published are dropped."""
+    current = c.execute("SELECT generation FROM data_versions WHERE name = 'current_run'").fetchone() if _table_exists(c, "data_versions") else None
+    current = current[0] if current else 0
+    has_runs = _table_exists(c, "calc_runs")
+    next_run = "(SELECT MIN(r.id) FROM calc_runs r WHERE r.status = 'complete' AND r.id > {table}.calc_run_id)" if has_runs else "NULL"
+    for table in ("disposal_results", "calculation_steps", "pool_snapshot", "pool_checkpoints"):
+        if not _table_exists(c, table):
+            continue
+        _add_missing_columns(c, table, [("superseded_run_id", "INTEGER")])
+        c.execute(f"DELETE FROM {table} WHERE calc_run_id > ?", (current,))
+        if has_runs:
+            c.execute(f"DELETE FROM {table} WHERE calc_run_id IN (SELECT id FROM calc_runs WHERE status != 'complete')")
+        c.execute(f"UPDATE {table} SET superseded_run_id = COALESCE({next_run.format(table=table)}, ?) WHERE calc_run_id < ?", (current, current))
+        c.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_superseded_run_id ON {table} (superseded_run_id)")
+        c.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_calc_run_id ON {table} (calc_run_id)")
+    if has_runs:
+        c.execute("UPDATE calc_runs SET status = 'failed' WHERE status = 'building'")
+    if _table_exists(c, "calculation_details") and _table_exists(c, "disposal_results"):
+        c.execute("DELETE FROM calculation_details WHERE disposal_id NOT IN (SELECT id FROM disposal_results)")
+    if _table_exists(c, "disposal_results"):
+        for index in ("ix_disposal_results_run_sale_date_id", "ix_disposal_results_run_year_sale_date_id", "ix_disposal_results_run_lot_entry"):
+            c.execute(f"DROP INDEX IF EXISTS {index}")
+        c.execute("CREATE INDEX IF NOT EXISTS ix_disposal_results_sale_date_id ON disposal_results (sale_date, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS ix_disposal_results_year_sale_date_id ON disposal_results (tax_year, sale_date, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS ix_disposal_results_lot_entry ON disposal_results (lot_entry)")
+    if _table_exists(c, "calculation_steps"):
+        c.execute("DROP INDEX IF EXISTS ix_calculation_steps_run_tax_year")
+        c.execute("CREATE INDEX IF NOT EXISTS ix_calculation_steps_tax_year ON calculation_steps (tax_year)")
+
+def _migrate_exact_checkpoint_totals(c):
+    """pool_checkpoints stores its pool totals as text. Rows saved as NUMERIC were read back as floats, so
+    the table is dropped and rebuilt by db.create_all; partial recalcs replay from the start until the
+    next recalc writes new checkpoints."""
+    c.execute("DROP TABLE IF EXISTS pool_checkpoints")
+
+MIGRATIONS = [_migrate_legacy_columns, _migrate_unique_rate_dates, _migrate_hot_query_indexes, _migrate_calc_runs, _migrate_listing_columns,
+              _migrate_tax_year_columns, _migrate_shared_run_rows, _migrate_exact_checkpoint_totals]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
 def ensure_db_schema():
+    """Run the migrations an existing database file has not had yet, one transaction per step."""
     if not os.path.exists(DB_PATH):
         return
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    def has_col(table, col):
-        try:
-            c.execute(f"PRAGMA table_info({table})")
-            return col in [r[1] for r in c.fetchall()]
-        except Exception:
-            return False
-    try:
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='carry_forward_losses'")
-        if not c.fetchone():
-            c.execute("""
-                CREATE TABLE carry_forward_losses (
-                    tax_year INTEGER PRIMARY KEY,
-                    amount NUMERIC NOT NULL,
-                    notes VARCHAR(200)
-                )
-            """)
-    except Exception:
-        pass
-
-    # StockData table
-    try:
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stock_data'")
-        if not c.fetchone():
-            c.execute("""
-                CREATE TABLE stock_data (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    ticker VARCHAR(10) NOT NULL,
-                    date DATE NOT NULL,
-                    price_usd NUMERIC(28,6) NOT NULL,
-                    price_gbp NUMERIC(28,6),
-                    volume INTEGER,
-                    is_prediction BOOLEAN DEFAULT 0,
-                    prediction_type VARCHAR(20),
-                    prediction_json TEXT,
-                    notes VARCHAR(200),
-                    INDEX idx_ticker_date (ticker, date)
-                )
-            """)
-    except Exception:
-        pass
-    try:
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='vesting'")
-        if c.fetchone():
-            if not has_col("vesting", "incidental_costs_gbp"): c.execute("ALTER TABLE vesting ADD COLUMN incidental_costs_gbp NUMERIC DEFAULT 0")
-    except Exception:
-        pass
-    try:
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='espp'")
-        if c.fetchone():
-            if not has_col("espp", "shares_retained"): c.execute("ALTER TABLE espp ADD COLUMN shares_retained NUMERIC")
-            if not has_col("espp", "purchase_price_usd"): c.execute("ALTER TABLE espp ADD COLUMN purchase_price_usd NUMERIC")
-            if not has_col("espp", "market_price_usd"): c.execute("ALTER TABLE espp ADD COLUMN market_price_usd NUMERIC")
-            if not has_col("espp", "discount_taxed_paye"): c.execute("ALTER TABLE espp ADD COLUMN discount_taxed_paye BOOLEAN")
-            if not has_col("espp", "paye_tax_gbp"): c.execute("ALTER TABLE espp ADD COLUMN paye_tax_gbp NUMERIC")
-            if not has_col("espp", "exchange_rate"): c.execute("ALTER TABLE espp ADD COLUMN exchange_rate NUMERIC")
-            if not has_col("espp", "incidental_costs_gbp"): c.execute("ALTER TABLE espp ADD COLUMN incidental_costs_gbp NUMERIC DEFAULT 0")
-            if not has_col("espp", "qualifying"): c.execute("ALTER TABLE espp ADD COLUMN qualifying BOOLEAN DEFAULT 1")
-    except Exception:
-        pass
-    try:
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sales_in'")
-        if c.fetchone():
-            if not has_col("sales_in", "exchange_rate"): c.execute("ALTER TABLE sales_in ADD COLUMN exchange_rate NUMERIC")
-            if not has_col("sales_in", "incidental_costs_gbp"): c.execute("ALTER TABLE sales_in ADD COLUMN incidental_costs_gbp NUMERIC DEFAULT 0")
-    except Exception:
-        pass
-    try:
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pool_snapshot'")
-        if c.fetchone():
-            if not has_col("pool_snapshot", "tax_year"): c.execute("ALTER TABLE pool_snapshot ADD COLUMN tax_year INTEGER")
-            if not has_col("pool_snapshot", "snapshot_json"): c.execute("ALTER TABLE pool_snapshot ADD COLUMN snapshot_json TEXT")
-            if not has_col("pool_snapshot", "total_shares"): c.execute("ALTER TABLE pool_snapshot ADD COLUMN total_shares NUMERIC")
-            if not has_col("pool_snapshot", "total_cost_gbp"): c.execute("ALTER TABLE pool_snapshot ADD COLUMN total_cost_gbp NUMERIC")
-            if not has_col("pool_snapshot", "avg_cost_gbp"): c.execute("ALTER TABLE pool_snapshot ADD COLUMN avg_cost_gbp NUMERIC")
-    except Exception:
-        pass
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
     try:
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='disposal_results'")
-        if c.fetchone():
-            if not has_col("disposal_results", "calculation_json"): c.execute("ALTER TABLE disposal_results ADD COLUMN calculation_json TEXT")
-    except Exception:
-        pass
-    conn.commit()
-    conn.close()
+        version = schema_version(conn)
+        for number, migrate in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute("BEGIN")
+            try:
+                migrate(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.close()
+
+def stamp_schema_version():
+    """Mark a database just built by db.create_all() as current: the models already carry every migration."""
+    db.session.execute(db.text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+    db.session.commit()
 
 def bootstrap():
     with app.app_context():
+        fresh = not os.path.exists(DB_PATH)
         ensure_db_schema()
         db.create_all()
+        if fresh:
+            stamp_schema_version()
+        abandon_runs(datetime.utcnow())  # a run left building by a previous process will never finish
         if not db.session.get(Setting, "CGT_Allowance"): db.session.add(Setting(key="CGT_Allowance", value="0"))  # 0 means use dynamic
         if not db.session.get(Setting, "CGT_Rate"): db.session.add(Setting(key="CGT_Rate", value="20"))
         if not db.session.get(Setting, "NonSavingsIncome"): db.session.add(Setting(key="NonSavingsIncome", value="0"))
@@ -2699,18 +3200,10 @@ def api_recalc():
         return jsonify({"error": "Missing tax_year in request body"}), 400
     try:
         tax_year = int(data["tax_year"])
-        print(f"DEBUG: Full recalc triggered by API for tax_year: {tax_year}")
-        # Perform a full recalculation, clearing all previous results to ensure consistent pool state
-        with recalc_lock:
-            DisposalResult.query.delete()
-            PoolSnapshot.query.delete()
-            CalculationStep.query.delete()
-            CalculationDetail.query.delete()
-            db.session.commit()
-
-            # Always do full recalc, ignoring tax_year_filter for the recalc itself to ensure order-independent results
-            res = recalc_all(explain=True, tax_year_filter=None)
-            db.session.commit()  # Ensure steps and summaries saved
+        # Full recalculation into a new run; readers keep the previous run until it is published
+        # Always do full recalc, ignoring tax_year_filter for the recalc itself to ensure order-independent results
+        res = recalc_all(explain=True, tax_year_filter=None)
+        db.session.commit()  # Ensure steps and summaries saved
         return jsonify({
             "success": True,
             "tax_year": tax_year,
@@ -2725,6 +3218,18 @@ def api_recalc():
         db.session.rollback()
         return jsonify({"error": f"Recalc failed: {str(e)}. Ensure data integrity for UK CGT calculations."}), 500
 
+# Span timings (and debug events) of the last recalc; only populated when CGT_TRACE is set
+@app.route("/api/recalc/trace")
+def api_recalc_trace():
+    if last_recalc_trace is None:
+        return jsonify({"error": "No traced recalc yet; set CGT_TRACE=info or CGT_TRACE=debug"}), 404
+    return jsonify(last_recalc_trace)
+
+# Hit/miss counters of this process's read-API response cache
+@app.route("/api/cache/stats")
+def api_cache_stats():
+    return jsonify(response_cache.stats())
+
 # API for calculation steps (audit logs)
 @app.route("/api/calculation-steps")
 def api_calculation_steps():
@@ -2732,22 +3237,13 @@ def api_calculation_steps():
     sale_id_str = request.args.get("sale_id")
     if tax_year_str:
         tax_year = int(tax_year_str)
-        tax_start = date(tax_year, 4, 6)
-        tax_end = date(tax_year + 1, 4, 5)
-        # Filter steps by sales in tax year
-        sales_in_year = SaleInput.query.filter(
-            SaleInput.date >= tax_start,
-            SaleInput.date <= tax_end
-        ).all()
-        sale_ids = [s.id for s in sales_in_year]
-        steps = CalculationStep.query.filter(
-            CalculationStep.sale_input_id.in_(sale_ids)
-        ).order_by(CalculationStep.sale_input_id, CalculationStep.step_order).all()
+        steps = run_rows(CalculationStep).filter(CalculationStep.tax_year == tax_year) \
+            .order_by(CalculationStep.sale_input_id, CalculationStep.step_order).all()
     elif sale_id_str:
         sale_id = int(sale_id_str)
-        steps = CalculationStep.query.filter_by(sale_input_id=sale_id).order_by(CalculationStep.step_order).all()
+        steps = run_rows(CalculationStep).filter_by(sale_input_id=sale_id).order_by(CalculationStep.step_order).all()
     else:
-        steps = CalculationStep.query.order_by(CalculationStep.timestamp.desc()).limit(100).all()
+        steps = run_rows(CalculationStep).order_by(CalculationStep.timestamp.desc()).limit(100).all()
     
     steps_list = [{
         "id": s.id,
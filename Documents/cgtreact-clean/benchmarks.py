@@ -0,0 +1,547 @@
+"""Benchmarks for the CGT engine hot paths.
+
+Usage:
+    python benchmarks.py               # run every benchmark
+    python benchmarks.py lot_store     # run one by name
+
+Each benchmark prints a small table. They run against a throwaway SQLite file
+(CGT_DB_PATH), so data.db is never touched.
+"""
+import io
+import bisect
+import os
+import json
+import sys
+import time
+import random
+import tempfile
+import contextlib
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("CGT_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="cgt-bench-"), "bench.db"))
+
+from app import (app, db, LotStore, ResultWriter, recalc_all, archive_tax_years, get_rate_for_date, resolve_rates, fx_index, invalidate_fx_index, current_generation, response_cache,
+                 rendered_trace, LISTING_COLUMNS, Vesting, SaleInput, DisposalResult, CalculationDetail, PoolSnapshot, PoolCheckpoint, ExchangeRate)
+from cgt_engine import CGTEngine, VestingRecord, SaleRecord, FxRecord, FxTable, SNAPSHOT_KEYFRAME_INTERVAL, tax_year_of
+from cgt_trace import Tracer
+import cgt_archive
+import cgt_blob
+from flask import g
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__[len("bench_"):]] = fn
+    return fn
+
+
+def best_of(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@contextlib.contextmanager
+def fresh_db():
+    """App context over an empty benchmark database."""
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        response_cache.clear()
+        yield
+        db.session.remove()
+
+
+def seed_portfolio(sale_count, start=date(2000, 1, 3)):
+    """Daily 100-share vestings and a 150-share sale every other day.
+
+    Each sale splits across two or three lots, so fragments come out at roughly 2x sale_count.
+    """
+    for i in range(sale_count * 2):
+        db.session.add(Vesting(date=start + timedelta(days=i), shares_vested=Decimal("100"), price_usd=Decimal(10 + i % 7),
+                               shares_sold=Decimal("0"), net_shares=Decimal("100"), exchange_rate=Decimal("1.25")))
+    for i in range(sale_count):
+        db.session.add(SaleInput(date=start + timedelta(days=2 * i + 1), shares_sold=Decimal("150"),
+                                 sale_price_usd=Decimal(12 + i % 5), exchange_rate=Decimal("1.25")))
+    db.session.commit()
+
+
+def synthetic_lots(n, start=date(2015, 1, 1), open_fraction=Decimal("0.1")):
+    """n lots, one per day; all but the newest `open_fraction` are fully depleted."""
+    first_open = int(n * (1 - open_fraction))
+    return [{
+        "date": start + timedelta(days=i),
+        "entry": f"V:{i}",
+        "remaining": Decimal("100") if i >= first_open else Decimal("0"),
+        "avg_cost": Decimal("10"),
+        "source": "RSU",
+    } for i in range(n)]
+
+
+@benchmark
+def bench_lot_store(sale_count=200):
+    """Same-day / 30-day / s104 lookups: linear list scans vs LotStore bisect."""
+    print(f"{'lots':>8} {'linear ms':>10} {'indexed ms':>11} {'speedup':>8}")
+    for n in (500, 2000, 8000, 32000):
+        lots = synthetic_lots(n)
+        rnd = random.Random(n)
+        sale_dates = sorted(lots[0]["date"] + timedelta(days=rnd.randrange(n)) for _ in range(sale_count))
+        store = LotStore(lots)
+
+        def linear():
+            for d in sale_dates:
+                [l for l in lots if l["date"] == d and l["remaining"] > 0]
+                [l for l in lots if d - timedelta(days=30) <= l["date"] < d and l["remaining"] > 0]
+                [l for l in lots if d < l["date"] <= d + timedelta(days=30) and l["remaining"] > 0]
+                [l for l in lots if l["date"] < d and l["remaining"] > 0]
+
+        def indexed():
+            for d in sale_dates:
+                store.on(d)
+                store.between(d - timedelta(days=30), d - timedelta(days=1))
+                store.between(d + timedelta(days=1), d + timedelta(days=30))
+                store.before(d)
+
+        t_linear = best_of(linear) * 1000
+        t_indexed = best_of(indexed) * 1000
+        print(f"{n:>8} {t_linear:>10.1f} {t_indexed:>11.1f} {t_linear / t_indexed:>7.1f}x")
+
+
+@benchmark
+def bench_bulk_persist(fragments=10000):
+    """Persisting disposal + detail rows: commit per row vs one ResultWriter transaction."""
+    def rows():
+        for i in range(fragments):
+            dr = DisposalResult(calc_run_id=0, sale_date=date(2020, 1, 1) + timedelta(days=i // 3), sale_input_id=i // 3, matched_date=date(2019, 1, 1),
+                                matching_type="Section 104", matched_shares=Decimal("10"), avg_cost_gbp=Decimal("10"), proceeds_gbp=Decimal("150"),
+                                cost_basis_gbp=Decimal("100"), gain_gbp=Decimal("50"), cgt_due_gbp=Decimal("0"), calculation_json="{}")
+            yield dr, "Gain = 150 − 100 = 50", f"Fragment {i}"
+
+    def per_row():
+        for dr, eqs, expl in rows():
+            db.session.add(dr)
+            db.session.commit()
+            db.session.add(CalculationDetail(disposal_id=dr.id, sale_input_id=dr.sale_input_id, equations=eqs, explanation=expl))
+            db.session.commit()
+
+    def bulk():
+        writer = ResultWriter()
+        for dr, eqs, expl in rows():
+            writer.add_disposal(dr, equations=eqs, explanation=expl)
+        writer.commit()
+
+    print(f"{'strategy':>16} {'fragments':>10} {'seconds':>9}")
+    for name, fn in (("commit per row", per_row), ("ResultWriter", bulk)):
+        with fresh_db():
+            elapsed = best_of(fn, repeat=1)
+        print(f"{name:>16} {fragments:>10} {elapsed:>9.2f}")
+
+
+@benchmark
+def bench_recalc(sale_count=600):
+    """Full recalc_all over a synthetic portfolio (~2 fragments per sale)."""
+    with fresh_db():
+        seed_portfolio(sale_count)
+        start = time.perf_counter()
+        recalc_all()
+        elapsed = time.perf_counter() - start
+        frags = DisposalResult.query.count()
+    print(f"{'sales':>8} {'fragments':>10} {'seconds':>9}")
+    print(f"{sale_count:>8} {frags:>10} {elapsed:>9.2f}")
+
+
+@benchmark
+def bench_partial_recalc(sale_counts=(300, 1200), edits=5):
+    """An edit to the latest sale (partial recalc) as history grows: time and result rows written per edit."""
+    print(f"{'sales':>8} {'fragments':>10} {'ms/edit':>8} {'rows/edit':>10}")
+    for sale_count in sale_counts:
+        with fresh_db():
+            seed_portfolio(sale_count)
+            recalc_all()
+            frags = DisposalResult.query.count()
+            last = SaleInput.query.order_by(SaleInput.date.desc(), SaleInput.id.desc()).first()
+            start = time.perf_counter()
+            for _ in range(edits):
+                recalc_all(sale_filter=[last.id])
+            elapsed = time.perf_counter() - start
+            run_id = current_generation("current_run")
+            written = sum(model.query.filter_by(calc_run_id=run_id).count() for model in (DisposalResult, PoolSnapshot, PoolCheckpoint))
+        print(f"{sale_count:>8} {frags:>10} {elapsed * 1000 / edits:>8.1f} {written:>10}")
+
+
+@benchmark
+def bench_trace_storage(sale_count=600):
+    """recalc_all time and stored audit-trail bytes (calculation_json + CalculationDetail rows)."""
+    with fresh_db():
+        seed_portfolio(sale_count)
+        start = time.perf_counter()
+        recalc_all()
+        elapsed = time.perf_counter() - start
+        calc_bytes = stored_bytes(DisposalResult.calculation_json)
+        detail_bytes = stored_bytes(CalculationDetail.equations) + stored_bytes(CalculationDetail.explanation)
+        db.session.execute(db.text("VACUUM"))
+        db_kb = os.path.getsize(os.environ["CGT_DB_PATH"]) / 1024
+    print(f"{'sales':>8} {'calc_json KB':>13} {'details KB':>11} {'db KB':>8} {'seconds':>9}")
+    print(f"{sale_count:>8} {calc_bytes / 1024:>13.0f} {detail_bytes / 1024:>11.0f} {db_kb:>8.0f} {elapsed:>9.2f}")
+
+
+def stored_bytes(column):
+    """Bytes the column's values take in the database (compressed size for CompressedText columns)."""
+    return db.session.query(db.func.coalesce(db.func.sum(db.func.length(db.cast(column, db.LargeBinary))), 0)).scalar()
+
+
+@benchmark
+def bench_blob_storage(sale_count=600):
+    """Stored size of calculation_json / equations / snapshot_json per codec, db size and recalc/read time."""
+    codecs = ["none", "zlib"] + (["zstd"] if cgt_blob.HAS_ZSTD else [])
+    columns = (("calculation_json", DisposalResult.calculation_json), ("equations", CalculationDetail.equations),
+               ("snapshot_json", PoolSnapshot.snapshot_json))
+    print(f"{'codec':>6} " + " ".join(f"{name + ' KB':>19}" for name, _ in columns) + f" {'db KB':>8} {'recalc s':>9} {'read ms':>8}")
+    baseline = None
+    for codec in codecs:
+        os.environ["CGT_BLOB_CODEC"] = codec
+        with fresh_db():
+            seed_portfolio(sale_count)
+            start = time.perf_counter()
+            recalc_all()
+            t_recalc = time.perf_counter() - start
+            # Eagerly rendered equations, as rows written before lazy rendering still have them
+            writer = ResultWriter()
+            for dr in DisposalResult.query:
+                eqs, expl = rendered_trace(dr.calculation_json, dr.matching_type)
+                writer.details.append((dr, {"sale_input_id": dr.sale_input_id, "equations": "\n".join(eqs), "explanation": expl}))
+            writer.commit()
+            sizes = [stored_bytes(column) for _, column in columns]
+            t_read = best_of(lambda: [(d.calculation_json, d.id) for d in DisposalResult.query] + [s.snapshot_json for s in PoolSnapshot.query])
+            db.session.commit()
+            db.session.execute(db.text("VACUUM"))
+            db_kb = os.path.getsize(os.environ["CGT_DB_PATH"]) / 1024
+        baseline = baseline or sum(sizes)
+        print(f"{codec:>6} " + " ".join(f"{n / 1024:>19.0f}" for n in sizes) + f" {db_kb:>8.0f} {t_recalc:>9.2f} {t_read * 1000:>8.1f}"
+              f"  ({100 * (1 - sum(sizes) / baseline):.0f}% smaller)")
+    os.environ.pop("CGT_BLOB_CODEC")
+
+
+@benchmark
+def bench_summary_endpoints(sale_count=600, requests_per_year=20):
+    """api_summary / SA108 / summary CSV latency per request, for every tax year in the portfolio."""
+    with fresh_db():
+        seed_portfolio(sale_count)
+        recalc_all()
+        years = sorted({d.sale_date.year if d.sale_date >= date(d.sale_date.year, 4, 6) else d.sale_date.year - 1
+                        for d in DisposalResult.query})
+        client = app.test_client()
+        print(f"{'endpoint':>18} {'years':>6} {'ms/request':>11}")
+        for label, url in (("api_summary", "/api/summary/{}"), ("api_export_sa108", "/api/export/sa108/{}"),
+                           ("download summary", "/download/summary?tax_year={}")):
+            elapsed = best_of(lambda: [client.get(url.format(y)) for y in years for _ in range(requests_per_year)], repeat=1)
+            print(f"{label:>18} {len(years):>6} {elapsed * 1000 / (len(years) * requests_per_year):>11.2f}")
+
+
+def seed_disposals(count, template_sales=50):
+    """`count` DisposalResult rows in the published run, cloned from a small real recalc at one sale per day.
+
+    Far cheaper than recalculating a portfolio of that size, for benchmarks that only read results.
+    """
+    seed_portfolio(template_sales)
+    recalc_all()
+    run_id = current_generation("current_run")
+    templates = [{c.name: getattr(r, c.name) for c in DisposalResult.__table__.columns if c.name != "id"} for r in DisposalResult.query]
+    DisposalResult.query.delete()
+    start = templates[0]["sale_date"]
+    rows = []
+    for i in range(count):
+        row = dict(templates[i % len(templates)], calc_run_id=run_id, sale_input_id=i // 2 + 1)
+        row["sale_date"] = start + timedelta(days=i // 2)
+        row["tax_year"] = tax_year_of(row["sale_date"])  # bulk inserts skip DisposalResult.set_tax_year
+        rows.append(row)
+    db.session.execute(db.insert(DisposalResult), rows)
+    db.session.commit()
+
+
+@benchmark
+def bench_transactions_page(fragment_counts=(1000, 10000, 50000), limit=100):
+    """/api/transactions latency for the first page, a deep keyset page and a tax-year page as the table grows."""
+    print(f"{'fragments':>10} {'first ms':>9} {'deep ms':>8} {'tax year ms':>12}")
+    for count in fragment_counts:
+        with fresh_db():
+            seed_disposals(count)
+            ids = [i for (i,) in db.session.query(DisposalResult.id).order_by(DisposalResult.sale_date, DisposalResult.id)]
+            middle = ids[len(ids) // 2]
+            client = app.test_client()
+            timings = [best_of(lambda: client.get(url), repeat=5) for url in (
+                f"/api/transactions?limit={limit}", f"/api/transactions?limit={limit}&after_id={middle}",
+                f"/api/transactions?limit={limit}&tax_year=2005")]
+        print(f"{count:>10} " + " ".join(f"{t * 1000:>{w}.1f}" for t, w in zip(timings, (9, 8, 12))))
+
+
+@benchmark
+def bench_transactions_listing(fragments=50000, limits=(500, 5000)):
+    """Building /api/transactions items at 50k fragments: listing columns vs decoding calculation_json per row."""
+    def from_json(r):
+        # The listing fields as they were read before DisposalResult stored them as columns
+        calc = json.loads(r.calculation_json)
+        inputs = calc.get("inputs") or {}
+        return (r.id, (calc.get("numeric_trace") or {}).get("fragment_index"), inputs.get("lot", {}).get("entry"),
+                inputs.get("lot", {}).get("source"), inputs.get("sale_rate_used"), rendered_trace(r.calculation_json, r.matching_type)[0][:3])
+
+    def from_columns(r):
+        return (r.id, r.fragment_index, r.lot_entry, r.lot_source, r.rate_used, r.equation_snippet.split("\n"))
+
+    with fresh_db():
+        seed_disposals(fragments)
+        client = app.test_client()
+        ordered = DisposalResult.query.order_by(DisposalResult.sale_date, DisposalResult.id)
+        print(f"{'limit':>6} {'json decode ms':>15} {'columns ms':>11} {'endpoint ms':>12}")
+        for limit in limits:
+            t_json = best_of(lambda: [from_json(r) for r in ordered.limit(limit)])
+            t_cols = best_of(lambda: [from_columns(r) for r in ordered.with_entities(*LISTING_COLUMNS).limit(limit)])
+            t_api = best_of(lambda: client.get(f"/api/transactions?limit={limit}"))
+            print(f"{limit:>6} {t_json * 1000:>15.1f} {t_cols * 1000:>11.1f} {t_api * 1000:>12.1f}")
+
+
+@benchmark
+def bench_csv_export(fragment_counts=(10000, 50000)):
+    """/download/disposals: time to the first chunk, total time and peak Python memory while streaming."""
+    import tracemalloc
+    print(f"{'fragments':>10} {'first chunk ms':>15} {'total ms':>9} {'peak KiB':>9} {'CSV KiB':>8}")
+    for count in fragment_counts:
+        with fresh_db():
+            seed_disposals(count)
+            client = app.test_client()
+            tracemalloc.start()
+            start = time.perf_counter()
+            chunks = iter(client.get("/download/disposals").response)
+            size = len(next(chunks))
+            t_first = time.perf_counter() - start
+            for chunk in chunks:
+                size += len(chunk)
+            t_total = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        print(f"{count:>10} {t_first * 1000:>15.1f} {t_total * 1000:>9.0f} {peak / 1024:>9.0f} {size / 1024:>8.0f}")
+
+
+@benchmark
+def bench_read_endpoints(fragments=10000, requests=50):
+    """Read endpoints: uncached 200, 200 from the response cache, and If-None-Match revalidation (304)."""
+    def uncached(url):
+        response_cache.clear()
+        return client.get(url)
+
+    with fresh_db():
+        seed_disposals(fragments)
+        client = app.test_client()
+        print(f"{'endpoint':>28} {'200 ms':>7} {'cached ms':>10} {'304 ms':>7}")
+        for url in ("/api/summary/2005", "/api/snapshot/2000", "/api/transactions?limit=500", "/api/tax_years"):
+            tag = client.get(url).headers["ETag"]
+            full = best_of(lambda: [uncached(url) for _ in range(requests)])
+            client.get(url)
+            cached = best_of(lambda: [client.get(url) for _ in range(requests)])
+            revalidated = best_of(lambda: [client.get(url, headers={"If-None-Match": tag}) for _ in range(requests)])
+            print(f"{url:>28} {full * 1000 / requests:>7.2f} {cached * 1000 / requests:>10.2f} {revalidated * 1000 / requests:>7.2f}")
+        print("cache:", response_cache.stats())
+
+
+@benchmark
+def bench_archive(sale_count=3000):
+    """Per-year totals by matching type and lot source: ORM rows + json.loads vs the columnar archive."""
+    def from_orm(year):
+        groups = {}
+        for d in DisposalResult.query.filter(DisposalResult.sale_date >= date(year, 4, 6), DisposalResult.sale_date < date(year + 1, 4, 6)):
+            lot = json.loads(d.calculation_json).get("inputs", {}).get("lot", {})
+            g = groups.setdefault((d.matching_type, lot.get("source")), [0, Decimal("0")])
+            g[0] += 1
+            g[1] += d.gain_gbp
+        return groups
+
+    with fresh_db(), tempfile.TemporaryDirectory() as directory:
+        seed_portfolio(sale_count)
+        recalc_all()
+        start = time.perf_counter()
+        written = archive_tax_years(directory=directory)
+        t_write = time.perf_counter() - start
+        years = [y for y, _, _ in written]
+        for y in years[:2]:
+            archived = {(g["matching_type"], g["lot_source"]): [g["fragments"], g["gain_gbp"]] for g in cgt_archive.summarise_year(directory, y)}
+            assert archived == from_orm(y)
+        t_orm = best_of(lambda: [from_orm(y) for y in years])
+        t_archive = best_of(lambda: [cgt_archive.summarise_year(directory, y) for y in years])
+        size = sum(os.path.getsize(path) for _, _, path in written)
+    fragments = sum(n for _, n, _ in written)
+    print(f"format {'parquet' if cgt_archive.HAS_PYARROW else 'csv.gz'}: {len(years)} years, {fragments} fragments, "
+          f"{size / 1024:.0f} KiB, written in {t_write * 1000:.0f} ms")
+    print(f"{'read path':>16} {'ms (all years)':>15}")
+    for label, elapsed in (("ORM + json", t_orm), ("archive", t_archive)):
+        print(f"{label:>16} {elapsed * 1000:>15.1f}")
+
+
+@benchmark
+def bench_fx_lookup(rate_count=4000, lookups=2000):
+    """get_rate_for_date: exact + nearest-date SQL per call vs the cached calendar index."""
+    def sql_lookup(d):
+        exact = ExchangeRate.query.filter_by(date=d).first()
+        if exact:
+            return exact.usd_gbp
+        return ExchangeRate.query.order_by(db.func.abs(db.func.julianday(ExchangeRate.date) - db.func.julianday(d)),
+                                           ExchangeRate.date.asc()).first().usd_gbp
+
+    with fresh_db():
+        start = date(2010, 1, 4)
+        # Weekday rates only, as in the BoE series, so about 2 in 7 lookups take the nearest-date path
+        days = [start + timedelta(days=i) for i in range(rate_count * 7 // 5)]
+        db.session.add_all([ExchangeRate(date=d, usd_gbp=Decimal("1.2") + Decimal(i % 400) / 1000)
+                            for i, d in enumerate(d for d in days if d.weekday() < 5)])
+        db.session.commit()
+        rnd = random.Random(1)
+        targets = [start + timedelta(days=rnd.randrange(len(days))) for _ in range(lookups)]
+        invalidate_fx_index()
+        assert [sql_lookup(d) for d in targets[:200]] == [get_rate_for_date(d, []) for d in targets[:200]]
+
+        def cold_index():
+            invalidate_fx_index()
+            g.pop("rates_generation", None)
+            for d in targets:
+                get_rate_for_date(d, [])
+
+        t_sql = best_of(lambda: [sql_lookup(d) for d in targets], repeat=1)
+        t_cold = best_of(cold_index)
+        t_warm = best_of(lambda: [get_rate_for_date(d, []) for d in targets])
+        t_check = best_of(lambda: [current_generation("rates") for _ in range(lookups)]) / lookups
+        fx = fx_index()
+    print(f"{'strategy':>24} {'rates':>6} {'lookups':>8} {'ms':>9}")
+    for label, elapsed in (("SQL per lookup", t_sql), ("index, incl. load", t_cold), ("index, warm", t_warm)):
+        print(f"{label:>24} {rate_count:>6} {lookups:>8} {elapsed * 1000:>9.1f}")
+    print(f"per-request generation check: {t_check * 1000:.3f} ms (vs {t_cold * 1000:.1f} ms to reload the index)")
+
+    # In-memory: daily calendar vs a bisect over the sorted dates, and patching vs rebuilding
+    records = [FxRecord(d, r) for d, r in fx.items()]
+    dates, values = [r.date for r in records], [r.usd_gbp for r in records]
+
+    def bisect_lookup(d):
+        i = bisect.bisect_left(dates, d)
+        if i == 0 or (i < len(dates) and dates[i] == d):
+            return values[min(i, len(dates) - 1)]
+        if i == len(dates):
+            return values[-1]
+        return values[i - 1] if (d - dates[i - 1]) <= (dates[i] - d) else values[i]
+
+    assert [bisect_lookup(d) for d in targets] == [fx.rate_for(d) for d in targets]
+    t_bisect = best_of(lambda: [bisect_lookup(d) for d in targets])
+    t_calendar = best_of(lambda: [fx.rate_for(d) for d in targets])
+    late = [FxRecord(days[-1] + timedelta(days=i), Decimal("1.3")) for i in (1, 2, 3)]
+    t_rebuild = best_of(lambda: FxTable(records + late))
+    t_patch = best_of(lambda: fx.with_rates(late))
+    print(f"{'in-memory':>24} {'ms':>9}")
+    for label, elapsed in (("bisect lookups", t_bisect), ("calendar lookups", t_calendar),
+                           ("rebuild, +3 dates", t_rebuild), ("with_rates, +3 dates", t_patch)):
+        print(f"{label:>24} {elapsed * 1000:>9.3f}")
+
+
+@benchmark
+def bench_fx_resolve(rate_count=4000, sizes=(100, 1000, 10000)):
+    """A column of dates: get_rate_for_date per row vs one resolve_rates pass (list and pandas Series)."""
+    with fresh_db():
+        start = date(2010, 1, 4)
+        days = [start + timedelta(days=i) for i in range(rate_count * 7 // 5)]
+        db.session.add_all([ExchangeRate(date=d, usd_gbp=Decimal("1.2") + Decimal(i % 400) / 1000)
+                            for i, d in enumerate(d for d in days if d.weekday() < 5)])
+        db.session.commit()
+        invalidate_fx_index()
+        rnd = random.Random(2)
+        print(f"{'dates':>7} {'per row ms':>11} {'list ms':>9} {'series ms':>10}")
+        for n in sizes:
+            targets = [start + timedelta(days=rnd.randrange(len(days))) for _ in range(n)]
+            series = pd.Series(pd.to_datetime(targets))
+            assert resolve_rates(targets) == [get_rate_for_date(d, []) for d in targets]
+            t_rows = best_of(lambda: [get_rate_for_date(d, []) for d in targets])
+            t_list = best_of(lambda: resolve_rates(targets))
+            t_series = best_of(lambda: resolve_rates(series))
+            print(f"{n:>7} {t_rows * 1000:>11.2f} {t_list * 1000:>9.2f} {t_series * 1000:>10.2f}")
+
+
+@benchmark
+def bench_boe_import(first_year=1975, last_year=2025):
+    """POST /upload_boe_csv with a multi-decade daily file: into an empty table, then again (all dates stored)."""
+    day, rows = date(first_year, 1, 2), ['"DATE","XUDLUSS"']
+    while day.year <= last_year:
+        if day.weekday() < 5:
+            rows.append(f'"{day.strftime("%d %b %y")}","{1.2 + (day.toordinal() % 500) / 1000:.4f}"')
+        day += timedelta(days=1)
+    body = ("\n".join(rows) + "\n").encode()
+    print(f"{'pass':>8} {'rows':>7} {'stored':>7} {'seconds':>9}")
+    with fresh_db():
+        client = app.test_client()
+        for label in ("empty", "repeat"):
+            start = time.perf_counter()
+            client.post("/upload_boe_csv", data={"csv_file": (io.BytesIO(body), "boe.csv")}, content_type="multipart/form-data")
+            elapsed = time.perf_counter() - start
+            print(f"{label:>8} {len(rows) - 1:>7} {ExchangeRate.query.count():>7} {elapsed:>9.2f}")
+
+
+@benchmark
+def bench_arithmetic(sale_count=400):
+    """CGTEngine.run with no database: Decimal reference vs fixed-point integer arithmetic."""
+    start = date(2000, 1, 3)
+    vestings = [VestingRecord(id=i, date=start + timedelta(days=i), shares_vested=Decimal("100.125"), price_usd=Decimal(10 + i % 7) + Decimal("0.37"),
+                              exchange_rate=Decimal("1.2537")) for i in range(sale_count * 2)]
+    sales = [SaleRecord(id=i, date=start + timedelta(days=2 * i + 1), shares_sold=Decimal("150.3"), sale_price_usd=Decimal(12 + i % 5) + Decimal("0.91"),
+                        exchange_rate=Decimal("1.2811"), incidental_costs_gbp=Decimal("7.5") if i % 3 == 0 else None) for i in range(sale_count)]
+    print(f"{'arithmetic':>12} {'sales':>6} {'fragments':>10} {'seconds':>9}")
+    for mode in ("decimal", "fixed"):
+        engine = CGTEngine(vestings=vestings, arithmetic=mode)
+        result = engine.run(sales)
+        elapsed = best_of(lambda: engine.run(sales))
+        print(f"{mode:>12} {sale_count:>6} {len(result.disposals):>10} {elapsed:>9.2f}")
+
+
+@benchmark
+def bench_snapshots(sale_count=400):
+    """Per-sale pool snapshots: full pool copy every sale vs `changed` deltas with keyframes."""
+    start = date(2000, 1, 3)
+    vestings = [VestingRecord(id=i, date=start + timedelta(days=i), shares_vested=Decimal("100"), price_usd=Decimal(10 + i % 7),
+                              exchange_rate=Decimal("1.25")) for i in range(sale_count * 2)]
+    sales = [SaleRecord(id=i, date=start + timedelta(days=2 * i + 1), shares_sold=Decimal("150"), sale_price_usd=Decimal(12 + i % 5),
+                        exchange_rate=Decimal("1.25")) for i in range(sale_count)]
+    engine = CGTEngine(vestings=vestings)
+    print(f"{'encoding':>22} {'sales':>6} {'json KB':>9} {'run s':>7}")
+    for label, every in (("full copy per sale", 1), (f"deltas, keyframe/{SNAPSHOT_KEYFRAME_INTERVAL}", SNAPSHOT_KEYFRAME_INTERVAL)):
+        result = engine.run(sales, keyframe_every=every)
+        elapsed = best_of(lambda: engine.run(sales, keyframe_every=every))
+        size = len(json.dumps(list(result.snapshots))) / 1024
+        print(f"{label:>22} {sale_count:>6} {size:>9.0f} {elapsed:>7.2f}")
+
+
+@benchmark
+def bench_tracing(sale_count=400):
+    """CGTEngine.run at each trace level; "off" should match an uninstrumented run."""
+    start = date(2000, 1, 3)
+    vestings = [VestingRecord(id=i, date=start + timedelta(days=i), shares_vested=Decimal("100"), price_usd=Decimal(10 + i % 7),
+                              exchange_rate=Decimal("1.25")) for i in range(sale_count * 2)]
+    sales = [SaleRecord(id=i, date=start + timedelta(days=2 * i + 1), shares_sold=Decimal("150"), sale_price_usd=Decimal(12 + i % 5),
+                        exchange_rate=Decimal("1.25")) for i in range(sale_count)]
+    engine = CGTEngine(vestings=vestings)
+    print(f"{'level':>6} {'sales':>6} {'events':>7} {'run s':>7}")
+    for level in ("off", "info", "debug"):
+        tracer = Tracer(level)
+        engine.run(sales, tracer=tracer)
+        elapsed = best_of(lambda: engine.run(sales, tracer=Tracer(level)))
+        print(f"{level:>6} {sale_count:>6} {len(tracer.events):>7} {elapsed:>7.2f}")
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(f"Unknown benchmark {name!r}; choose from {', '.join(BENCHMARKS)}")
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
@@ -0,0 +1,163 @@
+"""Columnar per-tax-year archive of disposal results.
+
+One file per closed tax year holds every disposal fragment as a flat row: the DisposalResult
+columns, the lot the fragment matched (`lot_*`) and each `numeric_trace` field (`trace_*`).
+Year-level analytics (slicing by matching type, lot source, ...) then read only the columns
+they need from the file instead of loading rows through the ORM and parsing calculation_json.
+
+Files are Parquet when pyarrow is installed, otherwise gzip-compressed CSV with the same
+columns; `read_year` loads either into a DataFrame. Money and share columns are exact
+Decimals in both: decimal128(28, 12) in Parquet (the DisposalResult column scale), decimal
+strings in CSV. Trace fields keep the engine's decimal strings as they are.
+
+No Flask or SQLAlchemy here: app.archive_tax_years selects the rows and calls `write_year`.
+"""
+import csv
+import gzip
+import json
+import os
+from datetime import date
+from decimal import Decimal
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# (column, kind); kind is one of "int", "date", "str", "decimal"
+RESULT_COLUMNS = [
+    ("id", "int"), ("sale_input_id", "int"), ("tax_year", "int"), ("sale_date", "date"), ("matched_date", "date"),
+    ("matching_type", "str"), ("matched_shares", "decimal"), ("avg_cost_gbp", "decimal"), ("proceeds_gbp", "decimal"),
+    ("cost_basis_gbp", "decimal"), ("gain_gbp", "decimal"),
+]
+LOT_COLUMNS = [("lot_entry", "str"), ("lot_source", "str"), ("lot_date", "date"), ("sale_rate_used", "str")]
+TRACE_FIELDS = ["fragment_index", "sale_price_usd", "rate_for_sale", "shares_matched", "proceeds_per_share_gbp",
+                "proceeds_total_gbp", "cost_per_share_gbp", "cost_total_gbp", "gain_gbp", "lot_usd_total",
+                "lot_rate_used", "lot_paye_gbp", "gross_proceeds_gbp", "pro_rata", "incidental_sale_gbp"]
+COLUMNS = RESULT_COLUMNS + LOT_COLUMNS + [(f"trace_{k}", "int" if k == "fragment_index" else "str") for k in TRACE_FIELDS]
+KINDS = dict(COLUMNS)
+
+MONEY_SCALE = 12
+
+
+def flatten(row, tax_year):
+    """Archive row for one disposal: `row` has the DisposalResult attributes (ORM row or namespace)."""
+    try:
+        calc = json.loads(row.calculation_json) if row.calculation_json else {}
+    except ValueError:
+        calc = {}
+    lot = calc.get("inputs", {}).get("lot", {})
+    trace = calc.get("numeric_trace", {})
+    out = {name: getattr(row, name, None) for name, _ in RESULT_COLUMNS}
+    out["tax_year"] = tax_year
+    out.update(lot_entry=lot.get("entry"), lot_source=lot.get("source"),
+               lot_date=date.fromisoformat(lot["date"]) if lot.get("date") else None,
+               sale_rate_used=calc.get("inputs", {}).get("sale_rate_used"))
+    for key in TRACE_FIELDS:
+        value = trace.get(key)
+        out[f"trace_{key}"] = None if value is None else (int(value) if key == "fragment_index" else str(value))
+    return out
+
+
+def year_path(directory, tax_year, parquet=None):
+    parquet = HAS_PYARROW if parquet is None else parquet
+    return os.path.join(directory, f"disposals-{tax_year}.{'parquet' if parquet else 'csv.gz'}")
+
+
+def _arrow_schema():
+    types = {"int": pa.int64(), "date": pa.date32(), "str": pa.string(), "decimal": pa.decimal128(28, MONEY_SCALE)}
+    return pa.schema([(name, types[kind]) for name, kind in COLUMNS])
+
+
+def _to_money(value):
+    return None if value is None else Decimal(value).quantize(Decimal(1).scaleb(-MONEY_SCALE))
+
+
+def write_year(directory, tax_year, rows):
+    """Write the flattened `rows` of one tax year, replacing any earlier file; returns its path."""
+    os.makedirs(directory, exist_ok=True)
+    path = year_path(directory, tax_year)
+    tmp = path + ".tmp"
+    if HAS_PYARROW:
+        columns = {name: [_to_money(r[name]) if kind == "decimal" else r[name] for r in rows] for name, kind in COLUMNS}
+        pq.write_table(pa.table(columns, schema=_arrow_schema()), tmp)
+    else:
+        with gzip.open(tmp, "wt", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([name for name, _ in COLUMNS])
+            for r in rows:
+                writer.writerow(["" if r[name] is None else r[name] for name, _ in COLUMNS])
+    os.replace(tmp, path)
+    # A year rewritten in the other format must not leave the old file behind for readers
+    other = year_path(directory, tax_year, parquet=not HAS_PYARROW)
+    if os.path.exists(other):
+        os.remove(other)
+    return path
+
+
+def archived_years(directory):
+    """Tax years with an archive file in `directory`, ascending."""
+    if not os.path.isdir(directory):
+        return []
+    years = set()
+    for name in os.listdir(directory):
+        stem, _, ext = name.partition(".")
+        if stem.startswith("disposals-") and ext in ("parquet", "csv.gz") and stem[10:].isdigit():
+            years.add(int(stem[10:]))
+    return sorted(years)
+
+
+def read_year(directory, tax_year, columns=None):
+    """DataFrame of one archived year (only `columns` if given), or None if it is not archived.
+
+    Decimal columns come back as Decimal objects, dates as datetime.date, missing values as None.
+    """
+    columns = list(columns) if columns else [name for name, _ in COLUMNS]
+    unknown = [c for c in columns if c not in KINDS]
+    if unknown:
+        raise ValueError(f"Unknown archive columns: {', '.join(unknown)}")
+    parquet, text = year_path(directory, tax_year, parquet=True), year_path(directory, tax_year, parquet=False)
+    if HAS_PYARROW and os.path.exists(parquet):
+        data = pq.read_table(parquet, columns=columns).to_pydict()
+    elif os.path.exists(text):
+        raw = pd.read_csv(text, usecols=columns, dtype=str, keep_default_na=False)
+        parsers = {"int": int, "date": date.fromisoformat, "decimal": Decimal, "str": str}
+        data = {name: [parsers[KINDS[name]](v) if v != "" else None for v in raw[name]] for name in columns}
+    else:
+        return None
+    # object columns throughout, so ints with gaps stay ints and None stays None
+    return pd.DataFrame({name: pd.Series(data[name], dtype=object) for name in columns}, columns=columns)
+
+
+def summarise_year(directory, tax_year, by=("matching_type", "lot_source")):
+    """Fragment count and Decimal totals per `by` group for an archived year, or None if not archived."""
+    by = list(by)
+    sums = ["matched_shares", "proceeds_gbp", "cost_basis_gbp", "gain_gbp"]
+    unknown = [c for c in by if c not in KINDS]
+    if unknown:
+        raise ValueError(f"Unknown archive columns: {', '.join(unknown)}")
+    parquet = year_path(directory, tax_year, parquet=True)
+    if HAS_PYARROW and os.path.exists(parquet):
+        # Grouped in Arrow: decimal sums stay exact and no per-row Python objects are built
+        table = pq.read_table(parquet, columns=list(dict.fromkeys([*by, *sums])))
+        if not by:
+            table = table.append_column("_all", pa.array([0] * table.num_rows, pa.int8()))
+        grouped = table.group_by(by or ["_all"]).aggregate([([], "count_all")] + [(name, "sum") for name in sums]).to_pylist()
+        groups = {tuple(g[k] for k in by): [g["count_all"]] + [g[f"{name}_sum"] or Decimal("0") for name in sums] for g in grouped}
+    else:
+        df = read_year(directory, tax_year, columns=list(dict.fromkeys([*by, *sums])))
+        if df is None:
+            return None
+        groups = {}
+        for row in df.itertuples(index=False):
+            key = tuple(getattr(row, k) for k in by)
+            g = groups.setdefault(key, [0] + [Decimal("0")] * len(sums))
+            g[0] += 1
+            for i, name in enumerate(sums, start=1):
+                g[i] += getattr(row, name) or Decimal("0")
+    return [{**dict(zip(by, key)), "fragments": g[0], **dict(zip(sums, g[1:]))}
+            for key, g in sorted(groups.items(), key=lambda kv: tuple("" if v is None else str(v) for v in kv[0]))]
@@ -0,0 +1,75 @@
+"""Compressed encoding for the large JSON/text audit columns.
+
+DisposalResult.calculation_json, CalculationDetail.equations and PoolSnapshot.snapshot_json
+are stored as BLOBs: one version byte naming the codec, then the payload.
+
+    0x00  UTF-8, uncompressed (payloads too small to gain from compression)
+    0x01  zlib
+    0x02  zstd (needs the optional `zstandard` package)
+
+Rows written before the encoding existed are plain TEXT and decode as they are, so no
+migration is needed: they are replaced as recalcs write new runs.
+
+Environment:
+    CGT_BLOB_CODEC=zstd|zlib|none   codec for new rows; default zstd when installed, else zlib
+"""
+import os
+import zlib
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+RAW, ZLIB, ZSTD = 0, 1, 2
+CODECS = {"none": RAW, "zlib": ZLIB, "zstd": ZSTD}
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def default_codec():
+    name = os.environ.get("CGT_BLOB_CODEC") or ("zstd" if HAS_ZSTD else "zlib")
+    if name not in CODECS:
+        raise ValueError(f"Unknown CGT_BLOB_CODEC {name!r}; expected one of {', '.join(CODECS)}")
+    if name == "zstd" and not HAS_ZSTD:
+        raise ValueError("CGT_BLOB_CODEC=zstd needs the zstandard package")
+    return CODECS[name]
+
+
+def encode(text, codec=None):
+    """Versioned blob for `text` (None stays None); falls back to RAW when compression does not help."""
+    if text is None:
+        return None
+    data = text.encode("utf-8")
+    codec = default_codec() if codec is None else codec
+    if codec == ZLIB:
+        packed = zlib.compress(data, ZLIB_LEVEL)
+    elif codec == ZSTD:
+        packed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    else:
+        packed = data
+    if len(packed) >= len(data):
+        codec, packed = RAW, data
+    return bytes((codec,)) + packed
+
+
+def decode(value):
+    """Text for a stored value: a versioned blob, or a legacy TEXT value returned as it is."""
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    if not value:
+        return ""
+    codec, payload = value[0], value[1:]
+    if codec == RAW:
+        data = payload
+    elif codec == ZLIB:
+        data = zlib.decompress(payload)
+    elif codec == ZSTD:
+        if not HAS_ZSTD:
+            raise ValueError("Stored value is zstd-compressed; install the zstandard package to read it")
+        data = zstandard.ZstdDecompressor().decompress(payload)
+    else:
+        raise ValueError(f"Unknown blob version byte {codec:#04x}")
+    return data.decode("utf-8")
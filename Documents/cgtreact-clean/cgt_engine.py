@@ -0,0 +1,966 @@
+# cgt_engine.py
+# Pure UK CGT share-matching engine: plain records in, immutable results out.
+#
+# No Flask, no SQLAlchemy, no app context. app.recalc_all loads rows, converts them with
+# the *.from_row helpers, runs CGTEngine and hands the EngineResult to a persistence sink
+# (app.ResultWriter). Hypothetical runs, tests and batch jobs can call the engine directly.
+#
+# Matching order per sale: same-day, 30-day back, 30-day forward, then Section 104 pool.
+
+import bisect
+import json
+from dataclasses import dataclass, field, fields
+from datetime import date, timedelta
+from decimal import Decimal, ROUND_HALF_UP, getcontext, InvalidOperation
+
+from cgt_trace import NULL_TRACER
+
+getcontext().prec = 50
+
+# A change dated D can alter matches back to D - 30 days (30-day forward matching)
+REPLAY_LOOKBACK = timedelta(days=30)
+
+# Per-sale snapshots carry only the `changed` lot balances; a full `pool_after` keyframe is
+# written for the first sale of each tax year and then every N sales (see pool_at).
+SNAPSHOT_KEYFRAME_INTERVAL = 50
+
+
+# ---------- Numeric helpers ----------
+def safe_decimal(x, default=Decimal("0")):
+    try:
+        if x is None or x == "":
+            return default
+        if isinstance(x, Decimal):
+            return x
+        return Decimal(str(x))
+    except (InvalidOperation, ValueError):
+        return default
+
+def q2(d) -> Decimal:
+    return safe_decimal(d).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+def q6(d: Decimal) -> Decimal:
+    return d.quantize(Decimal("0.000001"), rounding=ROUND_HALF_UP)
+
+def tax_year_of(d):
+    """UK tax year (starting year, e.g. 2024 for 2024/25) containing date `d`."""
+    return d.year if d >= date(d.year, 4, 6) else d.year - 1
+
+def get_aea(tax_year):
+    """Get Annual Exempt Amount based on tax year (ending year, e.g., 2024 for 2024/25)"""
+    if tax_year is None:
+        return Decimal("12300")
+    aea_map = {
+        2024: Decimal("3000"),  # 2024/25
+        2023: Decimal("6000"),  # 2023/24
+    }
+    for yr in range(2022, 2020, -1):  # 2022/23 to 2020/21: 12300
+        aea_map[yr] = Decimal("12300")
+    # Default for earlier or future: 12300 pre-2023, 3000 post-2024
+    return aea_map.get(tax_year, Decimal("3000") if tax_year > 2024 else Decimal("12300"))
+
+def build_fragment_trace(sale_price_usd: Decimal, lot, qty, rate_for_sale, fragment_index):
+    """Numeric inputs and totals for one fragment; the equation text is rendered from this on demand."""
+    sale_price_usd = safe_decimal(sale_price_usd)
+    qty = safe_decimal(qty)
+    lot_usd_total = safe_decimal(lot.get("usd_total")) if lot.get("usd_total") is not None else None
+    lot_rate_used = safe_decimal(lot.get("rate_used")) if lot.get("rate_used") is not None else None
+    lot_paye = safe_decimal(lot.get("paye")) if lot.get("paye") is not None else Decimal("0")
+
+    proceeds_per_share_gbp = (sale_price_usd / safe_decimal(rate_for_sale)) if safe_decimal(rate_for_sale) != 0 else sale_price_usd
+    proceeds_total = q2(proceeds_per_share_gbp * qty)
+
+    cost_per_share_used = q2(safe_decimal(lot["avg_cost"]))
+    cost_total = q2(cost_per_share_used * qty)
+    gain = q2(proceeds_total - cost_total)
+
+    return {
+        "sale_price_usd": str(sale_price_usd),
+        "rate_for_sale": str(rate_for_sale),
+        "proceeds_per_share_gbp": str(q2(proceeds_per_share_gbp)),
+        "proceeds_total_gbp": str(proceeds_total),
+        "cost_per_share_gbp": str(cost_per_share_used),
+        "cost_total_gbp": str(cost_total),
+        "gain_gbp": str(gain),
+        "lot_usd_total": str(lot_usd_total) if lot_usd_total is not None else None,
+        "lot_rate_used": str(lot_rate_used) if lot_rate_used is not None else None,
+        "lot_paye_gbp": str(lot_paye) if lot_paye is not None else None,
+        "shares_matched": str(q6(qty)),
+        "fragment_index": int(fragment_index)
+    }
+
+def render_equations(numeric_trace):
+    """Human-readable equation lines for a fragment's numeric_trace."""
+    t = numeric_trace
+    qty = t["shares_matched"]
+    equations = [f"Proceeds per share (GBP) = round(sale_price_usd / rate) = round({t['sale_price_usd']} / {t['rate_for_sale']}) = {t['proceeds_per_share_gbp']}"]
+    if t.get("gross_proceeds_gbp") is not None:
+        equations.append(f"Adjusted total proceeds = {t['gross_proceeds_gbp']} × {t['pro_rata']} (after £{t['incidental_sale_gbp']} incidental) = {t['proceeds_total_gbp']}")
+    else:
+        equations.append(f"Total proceeds = {t['proceeds_per_share_gbp']} × {qty} = {t['proceeds_total_gbp']}")
+    equations.append(f"Cost per share used = {t['cost_per_share_gbp']}")
+    equations.append(f"Total cost = {t['cost_per_share_gbp']} × {qty} = {t['cost_total_gbp']}")
+    if t.get("lot_usd_total") is not None and t.get("lot_rate_used") is not None:
+        lot_usd_total, lot_rate_used = Decimal(t["lot_usd_total"]), Decimal(t["lot_rate_used"])
+        purchase_gbp = q2(lot_usd_total / lot_rate_used) if lot_rate_used != 0 else q2(lot_usd_total)
+        equations.append(f"Lot USD total {lot_usd_total} → GBP = {lot_usd_total} / {lot_rate_used} = {purchase_gbp}")
+        lot_paye = safe_decimal(t.get("lot_paye_gbp"))
+        if lot_paye != 0:
+            equations.append(f"PAYE added = £{q2(lot_paye)} → chosen lot total = £{q2(purchase_gbp + lot_paye)}")
+    equations.append(f"Gain = {t['proceeds_total_gbp']} − {t['cost_total_gbp']} = {t['gain_gbp']}")
+    return equations
+
+SNIPPET_EQUATIONS = 3
+
+def equation_snippet(numeric_trace):
+    """The first SNIPPET_EQUATIONS lines of render_equations, as shown in disposal listings."""
+    return tuple(render_equations(numeric_trace)[:SNIPPET_EQUATIONS])
+
+def render_explanation(calc, matching_type):
+    """One-line summary of a fragment, e.g. "Fragment 2 matched 40 shares from V:3 (Section 104)"."""
+    t = calc["numeric_trace"]
+    lot = calc.get("inputs", {}).get("lot", {})
+    explanation = f"Fragment {t['fragment_index']} matched {t['shares_matched']} shares from {lot.get('entry')} ({matching_type})"
+    if t.get("gross_proceeds_gbp") is not None:
+        explanation += ", adjusted for incidental costs"
+    return explanation
+
+def build_fragment_detail_struct(sale_price_usd: Decimal, lot, qty, rate_for_sale, fragment_index):
+    numeric_trace = build_fragment_trace(sale_price_usd, lot, qty, rate_for_sale, fragment_index)
+    return {"equations": render_equations(numeric_trace), "numeric_trace": numeric_trace}
+
+
+# ---------- Arithmetic modes ----------
+def _div_half_up(n, d):
+    """Integer n / d rounded to the nearest integer, ties away from zero (Decimal ROUND_HALF_UP)."""
+    if d < 0:
+        n, d = -n, -d
+    q, r = divmod(abs(n), d)
+    if 2 * r >= d:
+        q += 1
+    return q if n >= 0 else -q
+
+def _ratio(x):
+    return safe_decimal(x).as_integer_ratio()
+
+class DecimalArithmetic:
+    """Reference mode: Decimal at 50 significant digits, rounded via q2/q6 as the engine always has."""
+    name = "decimal"
+    zero = Decimal("0")
+
+    def shares(self, x):
+        return safe_decimal(x)
+
+    def cost(self, avg_cost):
+        return avg_cost
+
+    def pool_cost(self, x):
+        return safe_decimal(x)
+
+    def per_share(self, cost, shares):
+        return cost / shares
+
+    def shares_out(self, q):
+        return q
+
+    def cost_out(self, c):
+        return c
+
+    def pool_cost_out(self, c):
+        return c
+
+    def money_out(self, m):
+        return m
+
+    def shares_float(self, q):
+        return float(q)
+
+    def cost_float(self, c):
+        return float(q2(c))
+
+    def fragment(self, sale_price_usd, lot, qty, rate_for_sale, fragment_index):
+        trace = build_fragment_trace(sale_price_usd, lot, qty, rate_for_sale, fragment_index)
+        return trace, Decimal(trace["proceeds_total_gbp"]), Decimal(trace["cost_total_gbp"]), Decimal(trace["gain_gbp"])
+
+    def pro_rata(self, gross_total, incidental):
+        return (gross_total - incidental) / gross_total
+
+    def scale_money(self, m, pro_rata):
+        return q2(m * pro_rata)
+
+    def ratio_str(self, pro_rata, percent=False):
+        return str(q2(pro_rata * 100 if percent else pro_rata))
+
+    def money_str(self, m):
+        return str(q2(m))
+
+
+class FixedPointArithmetic(DecimalArithmetic):
+    """Exact integer mode for the matching loop.
+
+    Shares are integer micro-shares (inputs finer than 1e-6 are rejected), per-share costs are
+    integers of 1e-18 GBP, pool cost is micro-shares x 1e-18 GBP, and fragment money is integer
+    pence. Fragment totals are single rational divisions of the inputs rounded half-up to the
+    penny, i.e. at exactly the points where q2/q6 round on the Decimal path; values are converted
+    back to Decimal only when a Disposal record is built.
+    """
+    name = "fixed"
+    zero = 0
+    SHARE = 10 ** 6
+    COST = 10 ** 18
+
+    def shares(self, x):
+        n, d = _ratio(x)
+        q, r = divmod(n * self.SHARE, d)
+        if r:
+            raise ValueError(f"Share quantity {x} is finer than 1e-6; use decimal arithmetic")
+        return q
+
+    def cost(self, avg_cost):
+        n, d = _ratio(avg_cost)
+        return _div_half_up(n * self.COST, d)
+
+    def pool_cost(self, x):
+        n, d = _ratio(x)
+        return _div_half_up(n * self.COST * self.SHARE, d)
+
+    def per_share(self, cost, shares):
+        return _div_half_up(cost, shares)
+
+    def shares_out(self, q):
+        return Decimal(q).scaleb(-6)
+
+    def cost_out(self, c):
+        return Decimal(c).scaleb(-18)
+
+    def pool_cost_out(self, c):
+        return Decimal(c).scaleb(-24)
+
+    def money_out(self, m):
+        return Decimal(m).scaleb(-2)
+
+    def shares_float(self, q):
+        return q / self.SHARE
+
+    def cost_float(self, c):
+        return _div_half_up(c, self.COST // 100) / 100
+
+    def fragment(self, sale_price_usd, lot, qty, rate_for_sale, fragment_index):
+        sale_price_usd = safe_decimal(sale_price_usd)
+        pn, pd = sale_price_usd.as_integer_ratio()
+        rn, rd = _ratio(rate_for_sale)
+        if rn != 0:
+            pn, pd = pn * rd, pd * rn  # proceeds per share in GBP, exactly
+        pps = _div_half_up(pn * 100, pd)
+        proceeds_total = _div_half_up(pn * 100 * qty, pd * self.SHARE)
+        cost_per_share = _div_half_up(lot["avg_cost"], self.COST // 100)
+        cost_total = _div_half_up(cost_per_share * qty, self.SHARE)
+        gain = proceeds_total - cost_total
+        money = self.money_str
+        lot_paye = lot.get("paye")
+
+        numeric_trace = {
+            "sale_price_usd": str(sale_price_usd),
+            "rate_for_sale": str(rate_for_sale),
+            "proceeds_per_share_gbp": money(pps),
+            "proceeds_total_gbp": money(proceeds_total),
+            "cost_per_share_gbp": money(cost_per_share),
+            "cost_total_gbp": money(cost_total),
+            "gain_gbp": money(gain),
+            "lot_usd_total": str(safe_decimal(lot["usd_total"])) if lot.get("usd_total") is not None else None,
+            "lot_rate_used": str(safe_decimal(lot["rate_used"])) if lot.get("rate_used") is not None else None,
+            "lot_paye_gbp": str(safe_decimal(lot_paye)) if lot_paye is not None else "0",
+            "shares_matched": str(self.shares_out(qty)),
+            "fragment_index": int(fragment_index)
+        }
+        return numeric_trace, proceeds_total, cost_total, gain
+
+    def pro_rata(self, gross_total, incidental):
+        n, d = _ratio(incidental)
+        return (gross_total * d - n * 100, gross_total * d)  # (net / gross) as an exact fraction
+
+    def scale_money(self, m, pro_rata):
+        return _div_half_up(m * pro_rata[0], pro_rata[1])
+
+    def ratio_str(self, pro_rata, percent=False):
+        return self.money_str(_div_half_up(pro_rata[0] * (10000 if percent else 100), pro_rata[1]))
+
+    def money_str(self, m):
+        return str(Decimal(m).scaleb(-2))
+
+
+ARITHMETIC = {mode.name: mode for mode in (DecimalArithmetic(), FixedPointArithmetic())}
+
+
+# ---------- Input records ----------
+class _Record:
+    @classmethod
+    def from_row(cls, row):
+        """Copy the matching attributes off an ORM row (or any object with the same field names)."""
+        return cls(**{f.name: getattr(row, f.name, f.default) for f in fields(cls)})
+
+@dataclass(frozen=True)
+class VestingRecord(_Record):
+    id: int
+    date: date
+    shares_vested: Decimal
+    price_usd: Decimal = None
+    total_usd: Decimal = None
+    exchange_rate: Decimal = None
+    incidental_costs_gbp: Decimal = None
+    shares_sold: Decimal = None
+    net_shares: Decimal = None
+
+@dataclass(frozen=True)
+class EsppRecord(_Record):
+    id: int
+    date: date
+    shares_retained: Decimal
+    purchase_price_usd: Decimal = None
+    exchange_rate: Decimal = None
+    paye_tax_gbp: Decimal = None
+    discount_taxed_paye: bool = True
+    incidental_costs_gbp: Decimal = None
+
+@dataclass(frozen=True)
+class SaleRecord(_Record):
+    id: int
+    date: date
+    shares_sold: Decimal
+    sale_price_usd: Decimal = None
+    exchange_rate: Decimal = None
+    incidental_costs_gbp: Decimal = None
+
+@dataclass(frozen=True)
+class FxRecord(_Record):
+    date: date
+    usd_gbp: Decimal  # USD per GBP
+
+@dataclass(frozen=True)
+class TaxSettings:
+    allowance: Decimal = Decimal("12300")
+    non_savings_income: Decimal = Decimal("0")
+    basic_threshold: Decimal = Decimal("37700")
+
+    @property
+    def basic_band_available(self):
+        return max(Decimal("0"), self.basic_threshold - self.non_savings_income)
+
+
+# ---------- Result records ----------
+@dataclass(frozen=True)
+class Disposal:
+    """One matched fragment of a sale, or the error row for a sale that could not be matched."""
+    sale_id: int
+    sale_date: date
+    matched_date: date
+    matching_type: str
+    matched_shares: Decimal
+    avg_cost_gbp: Decimal
+    proceeds_gbp: Decimal
+    cost_basis_gbp: Decimal
+    gain_gbp: Decimal
+    calculation_json: str
+    fragment_index: int = 0
+    # Listing columns, copied out of calculation_json so list endpoints need not decode it
+    lot_entry: str = None
+    lot_source: str = None
+    rate_used: str = None
+    equation_snippet: tuple = ()
+
+    @property
+    def is_error(self):
+        return self.matching_type.startswith("ERROR")
+
+@dataclass(frozen=True)
+class Step:
+    sale_input_id: int
+    step_order: int
+    message: str
+
+@dataclass(frozen=True)
+class Checkpoint:
+    """Lot balances and s104 totals captured before the sale (as_of_date, next_sale_id) is applied.
+
+    `balances` holds (entry, remaining) for lots dated before as_of_date + REPLAY_LOOKBACK; only
+    those can have been depleted by earlier sales, so later lots are rebuilt fresh on restore.
+    """
+    as_of_date: date
+    next_sale_id: int
+    sales_processed: int
+    balances: tuple
+    pool_shares: Decimal
+    pool_cost_gbp: Decimal
+    id: int = None
+
+@dataclass(frozen=True)
+class EngineResult:
+    disposals: tuple
+    snapshots: tuple  # per-sale {"sale", "changed", ["pool_after",] "error"} dicts, JSON-ready; see pool_at
+    steps: tuple
+    checkpoints: tuple
+    holding_shares: Decimal
+    holding_cost_gbp: Decimal
+
+    @property
+    def errors_present(self):
+        return any(d.is_error for d in self.disposals)
+
+    @property
+    def holding_avg_cost_gbp(self):
+        return self.holding_cost_gbp / self.holding_shares if self.holding_shares > 0 else Decimal("0")
+
+    def disposals_in_tax_year(self, tax_year):
+        return [d for d in self.disposals if d.sale_date and tax_year_of(d.sale_date) == tax_year]
+
+@dataclass(frozen=True)
+class TaxSummary:
+    pos: Decimal
+    neg: Decimal
+    net_gain: Decimal
+    excess_loss: Decimal
+    carry_forward_loss: Decimal
+    net_gain_after_losses: Decimal
+    settings: TaxSettings
+    taxable_gain: Decimal
+    basic_taxable: Decimal
+    higher_taxable: Decimal
+    estimated_cgt: Decimal
+
+    def as_dict(self):
+        return {
+            "pos": float(q2(self.pos)), "neg": float(q2(self.neg)), "net_gain": float(q2(self.net_gain)),
+            "cgt_allowance": float(q2(self.settings.allowance)),
+            "non_savings_income": float(q2(self.settings.non_savings_income)),
+            "basic_threshold": float(q2(self.settings.basic_threshold)),
+            "basic_band_available": float(q2(self.settings.basic_band_available)),
+            "total_carry_forward_loss": float(q2(self.carry_forward_loss)),
+            "net_gain_after_losses": float(q2(self.net_gain_after_losses)),
+            "taxable_gain": float(q2(self.taxable_gain)),
+            "basic_taxable": float(q2(self.basic_taxable)),
+            "higher_taxable": float(q2(self.higher_taxable)),
+            "estimated_cgt": float(self.estimated_cgt)
+        }
+
+@dataclass(frozen=True)
+class YearSummary:
+    """Disposal totals for one tax year plus its TaxSummary."""
+    tax_year: int
+    disposal_count: int
+    total_proceeds: Decimal
+    total_cost: Decimal
+    total_gain: Decimal
+    tax: TaxSummary
+
+    @property
+    def carry_forward_used(self):
+        return min(self.tax.carry_forward_loss, self.tax.net_gain)
+
+
+# ---------- FX lookup ----------
+class FxTable:
+    """USD/GBP rates by date; a date without a rate uses the nearest dated rate (earlier wins ties).
+
+    Lookups go through a daily calendar: one slot per day from the first to the last rate,
+    pre-filled with the nearest-date answer, so `rate_for` is an index by day ordinal. Dates
+    outside the range take the first / last rate.
+    """
+
+    def __init__(self, records=()):
+        self._dates, self._rates = [], []
+        for r in sorted(records, key=lambda r: r.date):
+            if self._dates and self._dates[-1] == r.date:
+                continue  # first rate stored for a date wins
+            self._dates.append(r.date)
+            self._rates.append(safe_decimal(r.usd_gbp))
+        self._first = self._dates[0].toordinal() if self._dates else 0
+        self._calendar = [None] * (self._dates[-1].toordinal() - self._first + 1) if self._dates else []
+        for i in range(len(self._dates) - 1):
+            self._fill(i)
+        if self._dates:
+            self._calendar[-1] = self._rates[-1]
+
+    def _fill(self, i):
+        """Calendar days from _dates[i] up to (not including) _dates[i + 1]."""
+        lo, hi = self._dates[i].toordinal(), self._dates[i + 1].toordinal()
+        mid = (lo + hi) // 2  # days up to the midpoint are nearer (or tied) to the earlier rate
+        base = self._first
+        self._calendar[lo - base:mid - base + 1] = [self._rates[i]] * (mid - lo + 1)
+        self._calendar[mid - base + 1:hi - base] = [self._rates[i + 1]] * (hi - mid - 1)
+
+    def __len__(self):
+        return len(self._dates)
+
+    def items(self):
+        return zip(self._dates, self._rates)
+
+    def rate_for(self, d):
+        if d is None or not self._dates:
+            return Decimal("1")
+        i = d.toordinal() - self._first
+        if i < 0:
+            return self._rates[0]
+        if i >= len(self._calendar):
+            return self._rates[-1]
+        return self._calendar[i]
+
+    def calendar(self):
+        """(ordinal of the first rate's date, per-day rates) for vectorised lookups; do not mutate the list."""
+        return self._first, self._calendar
+
+    def with_rates(self, records):
+        """Copy of this table with `records` added; dates already present keep their rate.
+
+        Only the calendar days between each new date and its neighbours are recomputed.
+        """
+        new_dates, new_rates, added = [], [], []
+        incoming = sorted(((r.date, safe_decimal(r.usd_gbp)) for r in records), key=lambda x: x[0])
+        i = 0
+        for d, rate in incoming:
+            while i < len(self._dates) and self._dates[i] < d:
+                new_dates.append(self._dates[i]); new_rates.append(self._rates[i]); i += 1
+            if (i < len(self._dates) and self._dates[i] == d) or (new_dates and new_dates[-1] == d):
+                continue
+            added.append(len(new_dates))
+            new_dates.append(d); new_rates.append(rate)
+        new_dates.extend(self._dates[i:]); new_rates.extend(self._rates[i:])
+        if not added:
+            return self
+        table = FxTable()
+        table._dates, table._rates = new_dates, new_rates
+        table._first = new_dates[0].toordinal()
+        if self._dates:
+            table._calendar = ([None] * (self._first - table._first) + self._calendar
+                               + [None] * (new_dates[-1].toordinal() - self._dates[-1].toordinal()))
+        else:
+            table._calendar = [None] * (new_dates[-1].toordinal() - table._first + 1)
+        for seg in sorted({s for p in added for s in (p - 1, p) if 0 <= s < len(new_dates) - 1}):
+            table._fill(seg)
+        table._calendar[-1] = new_rates[-1]
+        return table
+
+
+# ---------- Lot store (date-indexed) ----------
+class LotStore:
+    """Acquisition lots kept sorted by (date, entry) with bisect range lookups on date.
+
+    Lots are plain dicts ("date", "remaining", "avg_cost", "entry", ...); iteration yields
+    every lot in order. `_open_from` skips the fully depleted prefix, which keeps Section 104
+    scans proportional to the open lots rather than the whole history.
+
+    The Section 104 pool is every lot dated before `pool_date`. Its running totals
+    (`pool_shares`, `pool_cost`) are updated in O(1) by `deplete`, and lots join the pool
+    once via `admit_until` as sales move forward in time. Quantities are whatever the
+    arithmetic mode uses ("remaining" in shares, "avg_cost" per share).
+    """
+
+    def __init__(self, lots=(), arithmetic=None):
+        self.math = arithmetic or ARITHMETIC["decimal"]
+        self._lots = sorted(lots, key=lambda x: (x["date"], x["entry"]))
+        self._dates = [lot["date"] for lot in self._lots]
+        self._open_from = 0
+        self._admitted = 0
+        self.pool_date = date.min
+        self.pool_shares = self.math.zero
+        self.pool_cost = self.math.zero
+
+    def __iter__(self):
+        return iter(self._lots)
+
+    def __len__(self):
+        return len(self._lots)
+
+    def _skip_depleted(self):
+        while self._open_from < len(self._lots) and self._lots[self._open_from]["remaining"] <= 0:
+            self._open_from += 1
+        return self._open_from
+
+    def dated_before(self, d):
+        """Every lot acquired strictly before `d`, depleted ones included."""
+        return self._lots[:bisect.bisect_left(self._dates, d)]
+
+    def between(self, start, end):
+        """Open lots with start <= date <= end, in (date, entry) order."""
+        lo = max(bisect.bisect_left(self._dates, start), self._skip_depleted())
+        hi = bisect.bisect_right(self._dates, end)
+        return [lot for lot in self._lots[lo:hi] if lot["remaining"] > 0]
+
+    def on(self, d):
+        return self.between(d, d)
+
+    def before(self, d):
+        """Open lots acquired strictly before `d`, yielded FIFO."""
+        lo = self._skip_depleted()
+        hi = bisect.bisect_left(self._dates, d)
+        for lot in self._lots[lo:hi]:
+            if lot["remaining"] > 0:
+                yield lot
+
+    def admit_until(self, d):
+        """Move every lot dated before `d` into the Section 104 pool totals."""
+        if d <= self.pool_date:
+            return
+        while self._admitted < len(self._lots) and self._dates[self._admitted] < d:
+            lot = self._lots[self._admitted]
+            self.pool_shares += lot["remaining"]
+            self.pool_cost += lot["avg_cost"] * lot["remaining"]
+            self._admitted += 1
+        self.pool_date = d
+
+    def restore_pool(self, pool_date, pool_shares, pool_cost):
+        """Resume pool totals from a checkpoint taken at `pool_date` (lot balances already restored)."""
+        self._admitted = bisect.bisect_left(self._dates, pool_date)
+        self.pool_date = pool_date
+        self.pool_shares = pool_shares
+        self.pool_cost = pool_cost
+
+    def deplete(self, lot, qty):
+        lot["remaining"] -= qty
+        if lot["date"] < self.pool_date:
+            self.pool_shares -= qty
+            self.pool_cost -= lot["avg_cost"] * qty
+
+    @property
+    def pool_avg_cost(self):
+        return self.math.per_share(self.pool_cost, self.pool_shares) if self.pool_shares > 0 else self.math.zero
+
+    def checkpoint(self, next_sale, sales_processed):
+        m = self.math
+        horizon = next_sale.date + REPLAY_LOOKBACK
+        balances = tuple((lot["entry"], m.shares_out(lot["remaining"])) for lot in self.dated_before(horizon))
+        self.admit_until(next_sale.date)
+        return Checkpoint(as_of_date=next_sale.date, next_sale_id=next_sale.id, sales_processed=sales_processed,
+                          balances=balances, pool_shares=m.shares_out(self.pool_shares), pool_cost_gbp=m.pool_cost_out(self.pool_cost))
+
+    def restore(self, cp):
+        """Apply a Checkpoint's balances and pool totals; returns the number of lots restored."""
+        balances = dict(cp.balances)
+        restored = 0
+        for lot in self.dated_before(cp.as_of_date + REPLAY_LOOKBACK):
+            if lot["entry"] in balances:
+                lot["remaining"] = self.math.shares(balances[lot["entry"]])
+                restored += 1
+        self.restore_pool(cp.as_of_date, self.math.shares(cp.pool_shares), self.math.pool_cost(cp.pool_cost_gbp))
+        return restored
+
+
+# ---------- Engine ----------
+class CGTEngine:
+    """Share matching over plain acquisition / sale / FX records.
+
+    The engine holds the acquisitions; each `run` rebuilds the lots, so one engine can
+    evaluate any number of sale sequences (e.g. what-if sales) without touching a database.
+
+    arithmetic: "decimal" (reference) or "fixed" (integer micro-shares / pence, see
+    FixedPointArithmetic). Lot costs are derived in Decimal either way; only the matching
+    loop and fragment maths change representation.
+    """
+
+    def __init__(self, vestings=(), espp=(), fx_rates=(), settings=None, arithmetic="decimal"):
+        self.vestings = tuple(vestings)
+        self.espp = tuple(espp)
+        self.fx = fx_rates if isinstance(fx_rates, FxTable) else FxTable(fx_rates)
+        self.settings = settings or TaxSettings()
+        self.math = ARITHMETIC[arithmetic]
+
+    def _build_lots(self, log_step):
+        m = self.math
+        lots = []
+        for v in self.vestings:
+            net = safe_decimal(v.net_shares) if v.net_shares is not None else (safe_decimal(v.shares_vested) - safe_decimal(v.shares_sold or 0))
+            if net <= 0:
+                log_step(f"Skip vesting {v.id} net {net}")
+                continue
+            usd_total = safe_decimal(v.total_usd) if v.total_usd else (safe_decimal(v.price_usd) * safe_decimal(v.shares_vested) if v.price_usd else Decimal("0"))
+            exc = safe_decimal(v.exchange_rate) if v.exchange_rate else (self.fx.rate_for(v.date) or Decimal("1"))
+            if exc == 0: exc = Decimal("1")
+            total_gbp = (usd_total / exc) + safe_decimal(v.incidental_costs_gbp or 0)
+            avg_cost = (total_gbp / net) if net != 0 else Decimal("0")
+            entry_key = f"V:{v.id}"
+            tooltip = f"RSU {v.date}: USD {usd_total} / rate {exc} → £{q2(total_gbp - safe_decimal(v.incidental_costs_gbp or 0))}; incidental £{q2(v.incidental_costs_gbp or 0)}; per-share £{q2(avg_cost)}"
+            lots.append({"date": v.date, "remaining": m.shares(net), "avg_cost": m.cost(avg_cost), "usd_total": usd_total, "rate_used": exc, "paye": None, "entry": entry_key, "source": "RSU", "tooltip": tooltip})
+            log_step(f"Added RSU lot {entry_key} shares {net} per-share {q2(avg_cost)} (incidental {q2(v.incidental_costs_gbp or 0)})")
+
+        for p in self.espp:
+            shares = safe_decimal(p.shares_retained)
+            if shares <= 0:
+                log_step(f"Skip ESPP {p.id} retained {shares}"); continue
+            purchase_price_usd = safe_decimal(p.purchase_price_usd) if p.purchase_price_usd else Decimal("0")
+            exc = safe_decimal(p.exchange_rate) if p.exchange_rate else (self.fx.rate_for(p.date) or Decimal("1"))
+            if exc == 0: exc = Decimal("1")
+            usd_total = purchase_price_usd * shares
+            purchase_gbp = (usd_total / exc) if exc != 0 else usd_total + safe_decimal(p.incidental_costs_gbp or 0)
+            paye = safe_decimal(p.paye_tax_gbp) if p.paye_tax_gbp else Decimal("0")
+            chosen_total_gbp = purchase_gbp + (paye if p.discount_taxed_paye else Decimal("0"))
+            avg_cost = (chosen_total_gbp / shares) if shares != 0 else Decimal("0")
+            entry_key = f"E:{p.id}"
+            tooltip = f"ESPP {p.date}: USD {usd_total} / rate {exc} → purchase £{q2(purchase_gbp - safe_decimal(p.incidental_costs_gbp or 0))}; incidental £{q2(p.incidental_costs_gbp or 0)}; PAYE £{q2(paye)}; per-share £{q2(avg_cost)}"
+            lots.append({"date": p.date, "remaining": m.shares(shares), "avg_cost": m.cost(avg_cost), "usd_total": usd_total, "rate_used": exc, "paye": (paye if p.paye_tax_gbp else None), "entry": entry_key, "source": "ESPP", "tooltip": tooltip})
+            log_step(f"Added ESPP lot {entry_key} shares {shares} per-share {q2(avg_cost)} (incidental {q2(p.incidental_costs_gbp or 0)})")
+        return LotStore(lots, arithmetic=m)
+
+    def run(self, sales, tax_year=None, resume_from=None, checkpoint_every=None, keyframe_every=SNAPSHOT_KEYFRAME_INTERVAL, tracer=None):
+        """Match `sales` (in date, id order) against the lots and return an EngineResult.
+
+        resume_from: Checkpoint to restore before the first sale; `sales` must then start at it.
+        checkpoint_every: emit a Checkpoint before every Nth sale (counting from the start of history).
+        keyframe_every: snapshot keyframe spacing; 1 stores the full pool after every sale.
+        tracer: cgt_trace.Tracer for lot_build / matching / fragment_build spans and per-sale events.
+        """
+        m = self.math
+        tracer = tracer or NULL_TRACER
+        steps = []
+        disposals = []
+        checkpoints = []
+        per_sale_snapshots = []
+
+        def log_step(msg, sale_input_id=None):
+            steps.append(Step(sale_input_id, len(steps) + 1, msg))
+
+        keyframe = {"index": None, "tax_year": None}
+
+        def record_snapshot(s, changed, error):
+            snap = {"sale": {"id": s.id, "date": s.date.isoformat(), "shares": float(s.shares_sold)}, "changed": changed}
+            ty = tax_year_of(s.date)
+            if ty != keyframe["tax_year"] or len(per_sale_snapshots) - keyframe["index"] >= keyframe_every:
+                snap["pool_after"] = [{"entry": lot["entry"], "date": lot["date"].isoformat(), "source": lot["source"], "remaining": m.shares_float(lot["remaining"]), "per_share_cost": m.cost_float(lot["avg_cost"]), "tooltip": lot.get("tooltip","")} for lot in lots]
+                keyframe.update(index=len(per_sale_snapshots), tax_year=ty)
+            snap["error"] = error
+            per_sale_snapshots.append(snap)
+
+        log_step("Building lots from Vestings and ESPP purchases (ordered).")
+        with tracer.span("lot_build"):
+            lots = self._build_lots(log_step)
+        log_step(f"Total lots built: {len(lots)}")
+        if resume_from:
+            restored = lots.restore(resume_from)
+            log_step(f"Restored {restored} lot balances from checkpoint {resume_from.id} (before sale {resume_from.next_sale_id} on {resume_from.as_of_date}); replaying {len(sales)} sales.")
+        sales_processed = resume_from.sales_processed if resume_from else 0
+
+        st = self.settings
+        log_step(f"Using allowance £{q2(st.allowance)} for tax year {tax_year if tax_year else 'all'}, non-savings income £{q2(st.non_savings_income)}, basic band available £{q2(st.basic_band_available)} (threshold £{q2(st.basic_threshold)}).")
+
+        for s in sales:
+            with tracer.span("matching"):
+                if checkpoint_every and sales_processed and sales_processed % checkpoint_every == 0:
+                    checkpoints.append(lots.checkpoint(s, sales_processed))
+                sales_processed += 1
+                lots.admit_until(s.date)
+                log_step(f"Process sale {s.id} date {s.date} shares {safe_decimal(s.shares_sold)}", s.id)
+                remaining = m.shares(s.shares_sold)
+                rate_for_sale = safe_decimal(s.exchange_rate) if s.exchange_rate else self.fx.rate_for(s.date)
+                incidental_sale = safe_decimal(s.incidental_costs_gbp or 0)
+                if rate_for_sale == Decimal("1") and not self.fx and not s.exchange_rate:
+                    log_step("No year-level FX configured; using 1.0", s.id)
+                fragments = []
+                changed = {}
+                if tracer.debug:
+                    tracer.event("sale", sale_id=s.id, shares=str(m.shares_out(remaining)), rate=str(rate_for_sale), incidental=str(incidental_sale),
+                                 open_lots=[(l["entry"], str(m.shares_out(l["remaining"]))) for l in lots if l["remaining"] > 0])
+
+                for lot in lots.on(s.date):
+                    if remaining <= 0: break
+                    if lot["remaining"] > 0:
+                        before = lot["remaining"]
+                        take = min(lot["remaining"], remaining)
+                        lots.deplete(lot, take)
+                        after = lot["remaining"]
+                        changed[lot["entry"]] = {"matching": "Same-day", "before": m.shares_float(before), "after": m.shares_float(after), "delta": m.shares_float(after - before)}
+                        fragments.append(("Same-day", lot, take))
+                        remaining -= take
+
+                if remaining > 0:
+                    window_start = s.date - timedelta(days=30)
+                    for lot in lots.between(window_start, s.date - timedelta(days=1)):
+                        if remaining <= 0: break
+                        if lot["remaining"] > 0:
+                            before = lot["remaining"]
+                            take = min(lot["remaining"], remaining)
+                            lots.deplete(lot, take)
+                            after = lot["remaining"]
+                            changed[lot["entry"]] = {"matching": "30-day", "before": m.shares_float(before), "after": m.shares_float(after), "delta": m.shares_float(after - before)}
+                            fragments.append(("30-day", lot, take))
+                            remaining -= take
+
+                if remaining > 0:
+                    window_end = s.date + timedelta(days=30)
+                    for lot in lots.between(s.date + timedelta(days=1), window_end):
+                        if remaining <= 0: break
+                        if lot["remaining"] > 0:
+                            before = lot["remaining"]
+                            take = min(lot["remaining"], remaining)
+                            lots.deplete(lot, take)
+                            after = lot["remaining"]
+                            changed[lot["entry"]] = {"matching": "30-day forward", "before": m.shares_float(before), "after": m.shares_float(after), "delta": m.shares_float(after - before)}
+                            fragments.append(("30-day forward", lot, take))
+                            remaining -= take
+                            log_step(f"30-day forward match from {lot['entry']} {m.shares_out(take)} shares", s.id)
+
+                if remaining > 0:
+                    # Section 104 pooling: average from the running pool of all prior remaining lots
+                    if lots.pool_shares > 0:
+                        avg_cost_s104 = lots.pool_avg_cost
+                        take = remaining
+                        # Deplete prior lots FIFO
+                        depleted_take = m.zero
+                        for lot in lots.before(s.date):
+                            if take <= 0: break
+                            this_take = min(lot["remaining"], take)
+                            before = lot["remaining"]
+                            lots.deplete(lot, this_take)
+                            after = lot["remaining"]
+                            changed[lot["entry"]] = {"matching": "Section 104", "before": m.shares_float(before), "after": m.shares_float(after), "delta": m.shares_float(after - before)}
+                            take -= this_take
+                            depleted_take += this_take
+                        # Create virtual lot for fragment
+                        virtual_lot = {
+                            "entry": "S104_POOL",
+                            "date": s.date,
+                            "source": "POOLED",
+                            "avg_cost": avg_cost_s104,
+                            "usd_total": None,
+                            "rate_used": None,
+                            "paye": None,
+                            "tooltip": f"s104 average from prior lots: £{q2(m.cost_out(avg_cost_s104))} for {m.shares_out(depleted_take)} shares"
+                        }
+                        fragments.append(("Section 104", virtual_lot, depleted_take))
+                        remaining = 0
+                        log_step(f"s104 match: {m.shares_out(depleted_take)} shares at avg £{q2(m.cost_out(avg_cost_s104))}", s.id)
+                    else:
+                        log_step("s104: No prior lots available", s.id)
+
+                if remaining > 0:
+                    disposals.append(Disposal(sale_id=s.id, sale_date=s.date, matched_date=None, matching_type="ERROR: insufficient holdings",
+                                              matched_shares=Decimal("0"), avg_cost_gbp=Decimal("0"), proceeds_gbp=Decimal("0"),
+                                              cost_basis_gbp=Decimal("0"), gain_gbp=Decimal("0"),
+                                              calculation_json=json.dumps({"error": "insufficient holdings", "requested": str(s.shares_sold), "remaining_unmatched": str(m.shares_out(remaining))})))
+                    log_step(f"ERROR sale {s.id} insufficient remaining {m.shares_out(remaining)}", s.id)
+                    record_snapshot(s, changed, error=True)
+                    continue
+
+                # Build raw fragments
+                with tracer.span("fragment_build"):
+                    raw_fragments = []
+                    frag_index = 0
+                    for mtype, lot, qty in fragments:
+                        frag_index += 1
+                        trace, proceeds_total, cost_total, gain = m.fragment(s.sale_price_usd, lot, qty, rate_for_sale, frag_index)
+                        inputs = {"sale_price_usd": str(s.sale_price_usd), "sale_rate_used": str(rate_for_sale), "lot": {"entry": lot["entry"], "date": str(lot["date"]), "source": lot["source"], "usd_total": str(lot.get("usd_total")), "rate_used": str(lot.get("rate_used")), "paye": str(lot.get("paye"))}}
+                        if tracer.debug:
+                            tracer.event("fragment", sale_id=s.id, fragment_index=frag_index, matching_type=mtype, shares=str(m.shares_out(qty)),
+                                         proceeds_gbp=str(m.money_out(proceeds_total)), cost_gbp=str(m.money_out(cost_total)), gain_gbp=str(m.money_out(gain)))
+                        raw_fragments.append((mtype, lot, qty, inputs, trace, proceeds_total, cost_total, gain, frag_index))
+
+                # Apply incidental costs to proceeds
+                pro_rata = None
+                if incidental_sale > 0 and raw_fragments:
+                    total_gross_proceeds = sum(f[5] for f in raw_fragments)
+                    if total_gross_proceeds > 0:
+                        pro_rata = m.pro_rata(total_gross_proceeds, incidental_sale)
+                        log_step(f"Applied incidental costs £{q2(incidental_sale)} to sale {s.id} (pro-rata {m.ratio_str(pro_rata, percent=True)}%)", s.id)
+                    else:
+                        log_step(f"No proceeds to adjust for incidental £{q2(incidental_sale)} on sale {s.id}", s.id)
+                        raw_fragments = []
+
+                for mtype, lot, qty, inputs, trace, proceeds_total, cost_total, gain, frag_index in raw_fragments:
+                    if pro_rata is not None:
+                        gross_proceeds = proceeds_total
+                        proceeds_total = m.scale_money(gross_proceeds, pro_rata)
+                        gain = proceeds_total - cost_total
+                        trace["gross_proceeds_gbp"] = m.money_str(gross_proceeds)
+                        trace["pro_rata"] = m.ratio_str(pro_rata)
+                        trace["incidental_sale_gbp"] = str(q2(incidental_sale))
+                        trace["proceeds_total_gbp"] = m.money_str(proceeds_total)
+                        trace["gain_gbp"] = m.money_str(gain)
+                        inputs["incidental_sale"] = str(incidental_sale)
+                    disposals.append(Disposal(sale_id=s.id, sale_date=s.date, matched_date=lot["date"], matching_type=mtype,
+                                              matched_shares=m.shares_out(qty), avg_cost_gbp=m.cost_out(lot["avg_cost"]), proceeds_gbp=m.money_out(proceeds_total),
+                                              cost_basis_gbp=m.money_out(cost_total), gain_gbp=m.money_out(gain),
+                                              calculation_json=json.dumps({"inputs": inputs, "numeric_trace": trace}),
+                                              fragment_index=frag_index, lot_entry=lot["entry"], lot_source=lot["source"],
+                                              rate_used=inputs["sale_rate_used"], equation_snippet=equation_snippet(trace)))
+
+                record_snapshot(s, changed, error=False)
+
+        # Admitting every lot turns the running pool totals into whole-holding totals
+        lots.admit_until(date.max)
+        return EngineResult(disposals=tuple(disposals), snapshots=tuple(per_sale_snapshots), steps=tuple(steps),
+                            checkpoints=tuple(checkpoints), holding_shares=m.shares_out(lots.pool_shares), holding_cost_gbp=m.pool_cost_out(lots.pool_cost))
+
+
+# ---------- Snapshot reader ----------
+def pool_at(snapshots, index):
+    """Full pool_after lot list for snapshots[index].
+
+    Starts from the nearest keyframe at or before `index` and replays each later
+    snapshot's `changed` balances. Snapshots stored before delta encoding carry a
+    pool_after on every sale and decode as all-keyframes.
+    """
+    if index < 0:
+        index += len(snapshots)
+    start = index
+    while start >= 0 and "pool_after" not in snapshots[start]:
+        start -= 1
+    if start < 0:
+        raise ValueError(f"No pool keyframe at or before snapshot {index}")
+    pool = [dict(lot) for lot in snapshots[start]["pool_after"]]
+    by_entry = {lot["entry"]: lot for lot in pool}
+    for snap in snapshots[start + 1:index + 1]:
+        for entry, change in snap["changed"].items():
+            by_entry[entry]["remaining"] = change["after"]
+    return pool
+
+
+# ---------- Tax-year summary ----------
+def summarise_tax_year(gains, settings, carry_forward_loss=Decimal("0"), tracer=None):
+    """Net the year's fragment gains, apply brought-forward losses, the AEA and the basic/higher bands."""
+    gains = [safe_decimal(g) for g in gains]
+    pos = safe_decimal(sum(g for g in gains if g > 0))
+    neg = safe_decimal(sum(abs(g) for g in gains if g < 0))
+    if tracer is not None and tracer.debug:
+        tracer.event("gains_netted", pos=str(pos), neg=str(neg), carry_forward_loss=str(carry_forward_loss))
+    net_gain = max(Decimal("0"), pos - neg)
+    excess_loss = max(Decimal("0"), neg - pos)
+    net_gain_after_losses = max(Decimal("0"), net_gain - carry_forward_loss)
+    taxable_gain = max(Decimal("0"), net_gain_after_losses - settings.allowance)
+    basic_taxable = min(taxable_gain, settings.basic_band_available)
+    higher_taxable = taxable_gain - basic_taxable
+    estimated_cgt = q2(basic_taxable * Decimal("0.10") + higher_taxable * Decimal("0.20"))
+    return TaxSummary(pos=pos, neg=neg, net_gain=net_gain, excess_loss=excess_loss, carry_forward_loss=carry_forward_loss,
+                      net_gain_after_losses=net_gain_after_losses, settings=settings, taxable_gain=taxable_gain,
+                      basic_taxable=basic_taxable, higher_taxable=higher_taxable, estimated_cgt=estimated_cgt)
+
+def allocate_cgt(gain, summary):
+    """Share of the year's estimated CGT attributable to one fragment's gain (losses carry none)."""
+    gain = safe_decimal(gain)
+    pos = q2(summary.pos)
+    if gain <= 0 or pos <= 0 or summary.estimated_cgt <= 0:
+        return None
+    return q2(summary.estimated_cgt * (gain / pos))
+
+
+def summarise_all_years(disposals, settings_for, carry_forward_losses=None, years=(), tracer=None):
+    """YearSummary for every tax year in one pass over `disposals` (any order).
+
+    disposals: objects with sale_date, proceeds_gbp, cost_basis_gbp and gain_gbp (Disposal or DisposalResult).
+    settings_for: tax_year -> TaxSettings (the AEA varies by year).
+    carry_forward_losses: {tax_year: amount}; a year brings forward the sum for every earlier year.
+    years: extra years to summarise even when they have no disposals.
+    """
+    totals = {ty: [0, Decimal("0"), Decimal("0"), []] for ty in years}
+    for d in disposals:
+        if not d.sale_date:
+            continue
+        t = totals.setdefault(tax_year_of(d.sale_date), [0, Decimal("0"), Decimal("0"), []])
+        t[0] += 1
+        t[1] += safe_decimal(d.proceeds_gbp or 0)
+        t[2] += safe_decimal(d.cost_basis_gbp or 0)
+        t[3].append(safe_decimal(d.gain_gbp or 0))
+    losses = sorted((carry_forward_losses or {}).items())
+    summaries = {}
+    for ty in sorted(totals):
+        count, proceeds, cost, gains = totals[ty]
+        brought_forward = safe_decimal(sum(amount for loss_year, amount in losses if loss_year < ty))
+        summaries[ty] = YearSummary(tax_year=ty, disposal_count=count, total_proceeds=proceeds, total_cost=cost,
+                                    total_gain=safe_decimal(sum(gains)), tax=summarise_tax_year(gains, settings_for(ty), brought_forward, tracer=tracer))
+    return summaries
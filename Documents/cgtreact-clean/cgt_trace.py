@@ -0,0 +1,116 @@
+"""Structured tracing for recalc runs.
+
+Spans time the coarse phases of a run (lot build, matching, fragment build, persistence,
+tax summary) and are aggregated per path, so a span entered once per sale costs one
+entry in the export, not one per sale. Events carry the per-sale detail that used to be
+printed as DEBUG lines.
+
+Everything is gated on the tracer's level. A disabled tracer hands back a shared no-op
+span and never reads the clock; callers check `tracer.debug` before building an event
+payload, so a run with tracing off formats nothing.
+
+Environment:
+    CGT_TRACE=info    span timings
+    CGT_TRACE=debug   span timings plus per-sale / per-fragment events
+    CGT_TRACE_DIR     also write each run's JSON export to <dir>/<name>-<timestamp>.json
+"""
+import os
+import json
+import time
+from datetime import datetime
+
+OFF, INFO, DEBUG = 0, 10, 20
+LEVELS = {"off": OFF, "info": INFO, "debug": DEBUG}
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.tracer._stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = self.tracer._stack
+        path = "/".join(stack)
+        stack.pop()
+        stat = self.tracer.spans.get(path)
+        if stat is None:
+            self.tracer.spans[path] = [1, elapsed, elapsed]
+        else:
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = max(stat[2], elapsed)
+        return False
+
+
+class Tracer:
+    """Span timings and debug events for one run; see the module docstring."""
+
+    def __init__(self, level=OFF, name="recalc"):
+        self.level = LEVELS.get(level, OFF) if isinstance(level, str) else level
+        self.name = name
+        self.info = self.level >= INFO
+        self.debug = self.level >= DEBUG
+        self.started_at = datetime.utcnow()
+        self.spans = {}  # "a/b/c" -> [count, total seconds, max seconds]
+        self.events = []
+        self._stack = []
+
+    @classmethod
+    def from_env(cls, name="recalc"):
+        return cls(os.environ.get("CGT_TRACE", "off").strip().lower(), name=name)
+
+    def span(self, name):
+        """Context manager timing `name` under the current span; a no-op when tracing is off."""
+        if not self.info:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def event(self, name, **fields):
+        """Record a debug event in the current span. Guard payload construction with `tracer.debug`."""
+        if self.debug:
+            self.events.append({"span": "/".join(self._stack), "event": name, **fields})
+
+    def export(self):
+        return {
+            "run": self.name,
+            "level": next(k for k, v in sorted(LEVELS.items(), key=lambda kv: -kv[1]) if self.level >= v),
+            "started_at": self.started_at.isoformat(),
+            "spans": [{"path": path, "count": count, "total_ms": round(total * 1000, 3), "max_ms": round(worst * 1000, 3)}
+                      for path, (count, total, worst) in sorted(self.spans.items())],
+            "events": self.events,
+        }
+
+    def to_json(self):
+        return json.dumps(self.export(), default=str)
+
+    def write(self, directory):
+        """Write the export to `directory` and return the file path."""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.name}-{self.started_at.strftime('%Y%m%dT%H%M%S%f')}.json")
+        with open(path, "w") as f:
+            f.write(self.to_json())
+        return path
+
+
+NULL_TRACER = Tracer(OFF)
@@ -5,13 +5,17 @@ const api = axios.create({
 });
 
 export const fetchFragments = async (year: string) => {
-  const res = await api.get('/transactions');
-  const yearNum = parseInt(year.split('-')[0]);
-  const filteredData = res.data.items.filter((item: any) => {
-    const saleYear = parseInt(item.sale_date.split('-')[0]);
-    return saleYear === yearNum;
-  });
-  return filteredData;
+  // The tax year filter runs server-side; follow next_after_id until the last page
+  const items: any[] = [];
+  let afterId: number | null = null;
+  do {
+    const params: Record<string, string | number> = { tax_year: parseInt(year.split('-')[0]), limit: 1000 };
+    if (afterId !== null) params.after_id = afterId;
+    const res = await api.get('/transactions', { params });
+    items.push(...res.data.items);
+    afterId = res.data.next_after_id ?? null;
+  } while (afterId !== null);
+  return items;
 };
 
 export const fetchSnapshot = async (year: number) => {
@@ -12,6 +12,9 @@ const TransactionTable = () => {
         <TableRow>
           <TableCell>Date</TableCell>
           <TableCell>Match Type</TableCell>
+          <TableCell>Lot</TableCell>
+          <TableCell>Source</TableCell>
+          <TableCell>Rate</TableCell>
           <TableCell>Cost</TableCell>
           <TableCell>Proceeds</TableCell>
           <TableCell>Gain</TableCell>
@@ -23,10 +26,13 @@ const TransactionTable = () => {
           <TableRow key={f.id}>
             <TableCell>{f.sale_date}</TableCell>
             <TableCell>{f.match_type}</TableCell>
+            <TableCell>{f.lot_entry}</TableCell>
+            <TableCell>{f.source}</TableCell>
+            <TableCell>{f.rate_used}</TableCell>
             <TableCell>£{f.acquisition_cost.toFixed(2)}</TableCell>
             <TableCell>£{f.proceeds.toFixed(2)}</TableCell>
             <TableCell>£{f.gain.toFixed(2)}</TableCell>
-            <TableCell>
+            <TableCell title={(f.calculation_snippet || []).join('\n')}>
               <Button variant="outlined" size="small" onClick={() => setSelectedFragment(f)}>View</Button>
             </TableCell>
           </TableRow>
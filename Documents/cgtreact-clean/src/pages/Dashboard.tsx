@@ -78,13 +78,20 @@ const Dashboard = () => {
           acquisition_cost: f.avg_cost_gbp * f.matched_shares,
           proceeds: f.proceeds_gbp,
           gain: f.gain_gbp,
+          matched_shares: f.matched_shares,
+          avg_cost_gbp: f.avg_cost_gbp,
+          cost_basis_gbp: f.cost_basis_gbp,
+          fragment_index: f.fragment_index,
+          lot_entry: f.lot_entry,
+          matched_date: f.matched_date,
+          source: f.source,
+          rate_used: f.rate_used,
+          calculation_snippet: f.calculation_snippet,
         }));
 
-        // Map snapshot: parse snapshot_json to lots
+        // Map snapshot: the backend rebuilds the pool after the year's last sale from the delta-encoded snapshot_json
         const snapshot = snapshotRes;
-        const perSaleSnaps = JSON.parse(snapshot.snapshot_json || '[]');
-        const lastSnap = perSaleSnaps[perSaleSnaps.length - 1] || { pool_after: [] };
-        const poolAfter = lastSnap.pool_after || [];
+        const poolAfter = snapshot.pool_after || [];
         const lots = poolAfter.map((lot: any) => ({
           source: lot.source,
           quantity: lot.remaining,
@@ -32,6 +32,8 @@ export interface DisposalFragment {
   matched_date?: string;
   source?: string;
   rate_used?: string;
+  fragment_index?: number;
+  calculation_snippet?: string[];
   trace?: any;
 }
 
@@ -80,6 +82,15 @@ export interface PoolSnapshot {
   total_shares: number;
   total_cost_gbp: number;
   avg_cost_gbp: number;
+  sale_id?: number | null;
+  pool_after?: {
+    entry: string;
+    date: string;
+    source: string;
+    remaining: number;
+    per_share_cost: number;
+    tooltip?: string;
+  }[];
   snapshot_json: string;
   lots: {
     source: string;
@@ -7,7 +7,7 @@ from decimal import Decimal
 # Add project root to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app import app, db, Vesting, ESPPPurchase, SaleInput, ExchangeRate, Setting, get_aea, build_fragment_detail_struct, load_rates_sorted, get_rate_for_date, recalc_all, DisposalResult
+from app import app, db, Vesting, ESPPPurchase, SaleInput, ExchangeRate, Setting, get_aea, build_fragment_detail_struct, load_rates_sorted, get_rate_for_date, invalidate_fx_index, response_cache, recalc_all, DisposalResult
 
 @pytest.fixture(scope="function")
 def app_context():
@@ -16,6 +16,8 @@ def app_context():
     app.config['TESTING'] = True
     with app.app_context():
         db.create_all()
+        invalidate_fx_index()  # the cached rate index belongs to the previous test's database
+        response_cache.clear()  # so are cached responses: data versions restart with each database
         # Bootstrap settings
         if not Setting.query.get("CGT_Allowance"):
             db.session.add(Setting(key="CGT_Allowance", value="0"))
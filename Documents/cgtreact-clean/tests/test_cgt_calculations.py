@@ -1,9 +1,10 @@
 import pytest
 from datetime import date, timedelta
 from decimal import Decimal
+import io
 import json
 
-from app import get_aea, build_fragment_detail_struct, load_rates_sorted, get_rate_for_date, recalc_all, Vesting, ESPPPurchase, SaleInput, ExchangeRate, Setting, q2, DisposalResult, CarryForwardLoss
+from app import get_aea, build_fragment_detail_struct, load_rates_sorted, get_rate_for_date, invalidate_fx_index, recalc_all, Vesting, ESPPPurchase, SaleInput, ExchangeRate, Setting, q2, DisposalResult, CarryForwardLoss
 
 class TestAEA:
     """Test Annual Exempt Amount per UK tax years."""
@@ -63,6 +64,95 @@ class TestExchangeRates:
         rate = get_rate_for_date(test_date, loaded_rates)
         assert rate == Decimal("1.3")  # Latest earlier: 2020
 
+    def test_nearest_date_tie_breaks_earlier(self, session, rates):
+        session.add(ExchangeRate(date=date(2020, 1, 11), usd_gbp=Decimal("1.4")))
+        session.commit()
+        invalidate_fx_index()
+        assert get_rate_for_date(date(2020, 1, 6), []) == Decimal("1.3")  # equidistant
+        assert get_rate_for_date(date(2020, 1, 7), []) == Decimal("1.4")
+        assert get_rate_for_date(date(2030, 1, 1), []) == Decimal("1.2")
+
+    def test_index_invalidated_by_rate_routes(self, session, client, rates):
+        assert get_rate_for_date(date(2023, 2, 1), []) == Decimal("1.2")
+        client.post("/add_rate", data={"date": "2023-02-01", "rate": "1.25"})
+        assert get_rate_for_date(date(2023, 2, 1), []) == Decimal("1.25")
+        added = ExchangeRate.query.filter_by(date=date(2023, 2, 1)).one()
+        client.post(f"/edit_rate/{added.id}", data={"date": "2023-02-01", "rate": "1.27"})
+        assert get_rate_for_date(date(2023, 2, 1), []) == Decimal("1.27")
+        client.get(f"/delete_rate/{added.id}")
+        assert get_rate_for_date(date(2023, 2, 1), []) == Decimal("1.2")
+        csv_body = b'"DATE","XUDLUSS"\n"01 Feb 23","1.2600"\n'
+        client.post("/upload_boe_csv", data={"csv_file": (io.BytesIO(csv_body), "boe.csv")}, content_type="multipart/form-data")
+        assert get_rate_for_date(date(2023, 2, 1), []) == Decimal("1.26")
+
+    def test_resolve_rates_matches_single_lookups(self, session, client, rates):
+        import pandas as pd
+        from app import resolve_rates
+        session.add(ExchangeRate(date=date(2020, 1, 11), usd_gbp=Decimal("1.4")))
+        session.commit()
+        invalidate_fx_index()
+        days = [date(2019, 6, 1), date(2020, 1, 6), date(2020, 1, 7), date(2021, 5, 5), date(2030, 1, 1)]
+        assert resolve_rates(days) == [get_rate_for_date(d, []) for d in days]
+        series = pd.Series(pd.to_datetime(days + [None]), index=range(10, 16))
+        resolved = resolve_rates(series)
+        assert list(resolved.index) == list(range(10, 16))
+        assert list(resolved) == [get_rate_for_date(d, []) for d in days] + [Decimal("1")]
+        assert resolve_rates([]) == []
+
+        resp = client.post("/api/rates/resolve", json={"dates": ["2020-01-06", "2020-01-07"]})
+        assert resp.get_json() == {"dates": ["2020-01-06", "2020-01-07"], "rates": [1.3, 1.4]}
+        assert client.get("/api/rates/resolve?dates=2023-01-01").get_json()["rates"] == [1.2]
+        assert client.post("/api/rates/resolve", json={"dates": ["2020-13-01"]}).status_code == 400
+
+    def test_generation_reload_across_processes(self, session, rates):
+        from flask import g
+        from app import current_generation, bump_generation
+        assert get_rate_for_date(date(2023, 2, 1), []) == Decimal("1.2")
+        # Another worker adds a rate and bumps the generation; this process's index is untouched
+        session.add(ExchangeRate(date=date(2023, 2, 1), usd_gbp=Decimal("1.31")))
+        bump_generation("rates")
+        session.commit()
+        assert current_generation("rates") == 1
+        assert get_rate_for_date(date(2023, 2, 1), []) == Decimal("1.2")  # generation checked once per request
+        g.pop("rates_generation")  # next request
+        assert get_rate_for_date(date(2023, 2, 1), []) == Decimal("1.31")
+
+class TestBoeImport:
+    """Streaming BoE CSV importer: chunked ON CONFLICT(date) DO NOTHING inserts."""
+
+    def test_counts_and_no_date_window(self, session):
+        from app import import_boe_csv
+        session.add(ExchangeRate(date=date(2020, 1, 2), usd_gbp=Decimal("1.31")))
+        session.commit()
+        lines = ['"DATE","XUDLUSS"', '"02 Jan 75","2.3520"', '"03 Jan 75","2.3555"', '"02 Jan 20","1.3200"',
+                 '"03 Jan 20","1.3100"', '"03 Jan 20","1.3150"', '"06 Jan 20",""', 'not a date,1.2', '', '"07 Jan 2030","1.2500"']
+        assert import_boe_csv(lines, chunk_size=2) == (4, 2, 2)
+        session.commit()
+        stored = {r.date: r.usd_gbp for r in ExchangeRate.query}
+        assert stored[date(1975, 1, 2)] == Decimal("2.3520") and stored[date(2030, 1, 7)] == Decimal("1.25")
+        assert stored[date(2020, 1, 2)] == Decimal("1.31")  # existing date untouched
+        assert stored[date(2020, 1, 3)] == Decimal("1.31")  # first row in the file wins
+
+    def test_add_rate_overrides_existing_date(self, session, client):
+        session.add(ExchangeRate(date=date(2020, 1, 2), usd_gbp=Decimal("1.31")))
+        session.commit()
+        client.post("/add_rate", data={"date": "2020-01-02", "rate": "1.4"})
+        assert [r.usd_gbp for r in ExchangeRate.query] == [Decimal("1.4")]
+
+    def test_new_dates_patch_the_index(self, session, client, monkeypatch):
+        import app as app_module
+        session.add(ExchangeRate(date=date(2020, 1, 2), usd_gbp=Decimal("1.31")))
+        session.commit()
+        assert get_rate_for_date(date(2020, 1, 10), []) == Decimal("1.31")
+        monkeypatch.setattr(app_module, "FxTable", None)  # a full reload would fail
+        client.post("/add_rate", data={"date": "2020-01-09", "rate": "1.35"})
+        csv_body = b'"DATE","XUDLUSS"\n"13 Jan 20","1.3000"\n"02 Jan 20","1.2000"\n'
+        client.post("/upload_boe_csv", data={"csv_file": (io.BytesIO(csv_body), "boe.csv")}, content_type="multipart/form-data")
+        assert app_module._fx_index[0] == app_module.current_generation("rates")
+        assert [get_rate_for_date(date(2020, 1, d), []) for d in (2, 5, 6, 10, 11, 12)] == \
+            [Decimal("1.31"), Decimal("1.31"), Decimal("1.35"), Decimal("1.35"), Decimal("1.35"), Decimal("1.3")]
+
+
 class TestFragmentDetail:
     """Test build_fragment_detail_struct for gain calculations."""
     
@@ -502,4 +592,717 @@ class TestSplitYearScenario:
         assert summary["net_gain"] == 1000.0
         assert summary["cgt_allowance"] == 6000.0
         assert summary["taxable_gain"] == 0.0
-        # TODO: Implement proration, e.g., effective AEA = 6000 * (6/12) = 3000, taxable 700 @20% = 140
\ No newline at end of file
+        # TODO: Implement proration, e.g., effective AEA = 6000 * (6/12) = 3000, taxable 700 @20% = 140
+
+class TestIncrementalReplay:
+    """Test checkpointed partial recalc matches a full replay."""
+
+    @staticmethod
+    def _results(*where):
+        from app import run_rows
+        rows = run_rows(DisposalResult).filter(*where).order_by(DisposalResult.sale_date, DisposalResult.sale_input_id, DisposalResult.id).all()
+        return [(r.sale_input_id, r.matching_type, r.matched_shares, r.proceeds_gbp, r.cost_basis_gbp, r.gain_gbp, r.calculation_json) for r in rows]
+
+    @pytest.fixture
+    def history(self, session, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, "CHECKPOINT_INTERVAL", 3)
+        # Monthly vestings; quarterly sales that hit 30-day back, 30-day forward and s104 matching
+        start = date(2019, 1, 15)
+        for i in range(36):
+            d = start + timedelta(days=30 * i)
+            session.add(Vesting(date=d, shares_vested=Decimal("100"), price_usd=Decimal(10 + i), shares_sold=0, net_shares=Decimal("100"), exchange_rate=Decimal("1")))
+            if i % 3 == 0:
+                session.add(SaleInput(date=d + timedelta(days=40), shares_sold=Decimal("250"), sale_price_usd=Decimal(12 + i), exchange_rate=Decimal("1")))
+        session.commit()
+        recalc_all()
+
+    def test_checkpoints_written(self, session, history):
+        from app import PoolCheckpoint
+        cps = PoolCheckpoint.query.order_by(PoolCheckpoint.sales_processed).all()  # a single run so far
+        assert [cp.sales_processed for cp in cps] == [3, 6, 9]
+        assert all(Decimal(cp.pool_shares) > 0 for cp in cps)
+
+    def test_checkpoint_pool_totals_are_exact(self, session, history):
+        from app import PoolCheckpoint, engine_from_db, load_replay_checkpoint, run_rows
+        from cgt_engine import SaleRecord
+        # Pool totals with more significant digits than a float keeps
+        session.add(Vesting(date=date(2019, 1, 20), shares_vested=Decimal("1234567.123456789012"), price_usd=Decimal("10") / 3, shares_sold=0,
+                            net_shares=Decimal("1234567.123456789012"), exchange_rate=Decimal("1")))
+        session.commit()
+        recalc_all()
+        sales = [SaleRecord.from_row(s) for s in SaleInput.query.order_by(SaleInput.date, SaleInput.id)]
+        expected = engine_from_db().run(sales, checkpoint_every=3).checkpoints
+        stored = run_rows(PoolCheckpoint).order_by(PoolCheckpoint.sales_processed).all()
+        assert [(Decimal(cp.pool_shares), Decimal(cp.pool_cost_gbp)) for cp in stored] == [(cp.pool_shares, cp.pool_cost_gbp) for cp in expected]
+        restored = load_replay_checkpoint(stored[-1].as_of_date + timedelta(days=31))
+        assert (restored.pool_shares, restored.pool_cost_gbp) == (expected[-1].pool_shares, expected[-1].pool_cost_gbp)
+
+    def test_backdated_vesting_matches_full_replay(self, session, history):
+        early = self._results(DisposalResult.sale_date < date(2021, 1, 1))
+        back_dated = date(2021, 6, 20)
+        session.add(Vesting(date=back_dated, shares_vested=Decimal("500"), price_usd=Decimal("1"), shares_sold=0, net_shares=Decimal("500"), exchange_rate=Decimal("1")))
+        session.commit()
+
+        recalc_all(sale_filter=back_dated.isoformat())
+        partial = self._results()
+        # Sales well before the change are carried over into the new run unchanged
+        assert self._results(DisposalResult.sale_date < date(2021, 1, 1)) == early
+
+        recalc_all()
+        assert partial == self._results()
+
+    def test_new_sale_matches_full_replay(self, session, history):
+        s = SaleInput(date=date(2020, 9, 1), shares_sold=Decimal("120"), sale_price_usd=Decimal("30"), exchange_rate=Decimal("1"))
+        session.add(s)
+        session.commit()
+
+        recalc_all(sale_filter=[s.id])
+        partial = self._results()
+        recalc_all()
+        assert partial == self._results()
+
+    def test_same_day_sales_at_lookback_edge_match_full_replay(self, session, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, "CHECKPOINT_INTERVAL", 1)
+        session.add(Vesting(date=date(2020, 1, 1), shares_vested=Decimal("100"), price_usd=Decimal("10"), shares_sold=0, net_shares=Decimal("100"), exchange_rate=Decimal("1")))
+        # A checkpoint falls between the two 2020-03-01 sales, exactly 30 days before the vesting added below
+        for d in (date(2020, 3, 1), date(2020, 3, 1), date(2020, 6, 1)):
+            session.add(SaleInput(date=d, shares_sold=Decimal("10"), sale_price_usd=Decimal("20"), exchange_rate=Decimal("1")))
+        session.commit()
+        recalc_all()
+        session.add(Vesting(date=date(2020, 3, 31), shares_vested=Decimal("50"), price_usd=Decimal("30"), shares_sold=0, net_shares=Decimal("50"), exchange_rate=Decimal("1")))
+        session.commit()
+
+        recalc_all(sale_filter="2020-03-31")
+        partial = self._results()
+        recalc_all()
+        assert partial == self._results()
+
+    def test_rate_edit_discards_checkpoints_costed_at_old_rate(self, session, client, monkeypatch):
+        import app as app_module
+        from app import PoolCheckpoint
+        monkeypatch.setattr(app_module, "CHECKPOINT_INTERVAL", 1)
+        late = ExchangeRate(date=date(2020, 10, 1), usd_gbp=Decimal("1.0"))
+        session.add_all([ExchangeRate(date=date(2020, 1, 1), usd_gbp=Decimal("1.0")), ExchangeRate(date=date(2020, 7, 1), usd_gbp=Decimal("1.0")), late])
+        for d in (date(2020, 1, 1), date(2020, 10, 1)):  # costed at the stored rates
+            session.add(Vesting(date=d, shares_vested=Decimal("100"), price_usd=Decimal("10"), shares_sold=0, net_shares=Decimal("100")))
+        for d in (date(2020, 3, 1), date(2020, 6, 15), date(2020, 9, 1), date(2020, 12, 1)):
+            session.add(SaleInput(date=d, shares_sold=Decimal("10"), sale_price_usd=Decimal("20"), exchange_rate=Decimal("1")))
+        session.commit()
+        recalc_all()
+
+        client.post(f"/edit_rate/{late.id}", data={"date": "2020-10-01", "rate": "2.0"})
+        # Only checkpoints up to the previous rate's date (2020-07-01) survive
+        assert [cp.as_of_date for cp in PoolCheckpoint.query] == [date(2020, 6, 15)]
+        recalc_all(sale_filter="2020-12-01")
+        partial = self._results()
+        recalc_all()
+        assert partial == self._results()
+
+    def test_deleted_vesting_matches_full_replay(self, session, client, history):
+        v = Vesting.query.filter_by(date=date(2020, 2, 9)).one()
+        client.delete(f"/api/vestings/{v.id}")
+        # A later partial recalc must not resume from a checkpoint that still holds the lot
+        client.post("/api/sales", json={"date": "2021-09-01", "shares_sold": "50", "sale_price_usd": "30", "exchange_rate": "1"})
+        partial = self._results()
+        recalc_all()
+        assert partial == self._results()
+
+    def test_deleted_sale_matches_full_replay(self, session, client, history):
+        s = SaleInput.query.filter_by(date=date(2021, 2, 13)).one()
+        client.delete(f"/api/sales/{s.id}")
+        partial = self._results()
+        assert s.id not in {row[0] for row in partial}
+        recalc_all()
+        assert partial == self._results()
+
+    def test_partial_run_shares_unchanged_rows(self, session, history):
+        from app import CalcRun, CalculationStep, PoolCheckpoint, run_rows, current_run_id
+        base = current_run_id()
+        early = {r.id for r in run_rows(DisposalResult).filter(DisposalResult.sale_date < date(2021, 1, 1))}
+        stored = DisposalResult.query.count()
+        last = SaleInput.query.order_by(SaleInput.date.desc()).first()
+        recalc_all(sale_filter=[last.id])
+        run_id = current_run_id()
+        assert run_id != base
+        # The sales before the replay keep their rows; the new run only wrote the replayed ones
+        assert {r.id for r in run_rows(DisposalResult).filter(DisposalResult.sale_date < date(2021, 1, 1))} == early
+        written = DisposalResult.query.filter_by(calc_run_id=run_id).all()
+        replayed = {r.sale_input_id for r in written}
+        assert last.id in replayed and replayed <= {s.id for s in SaleInput.query.filter(SaleInput.date >= date(2021, 1, 1))}
+        assert DisposalResult.query.count() == stored + len(written)
+        # The previous run still reads as it was
+        assert run_rows(DisposalResult, base).count() == stored
+        assert run_rows(PoolCheckpoint).count() == run_rows(PoolCheckpoint, base).count()
+
+    def test_partial_run_keeps_one_snapshot_per_year(self, session, history):
+        from app import PoolSnapshot, run_rows
+        before = sorted((p.tax_year or 0, p.snapshot_json) for p in run_rows(PoolSnapshot))
+        disposals = run_rows(DisposalResult).count()
+        recalc_all(tax_year_filter=2020, sale_filter=[SaleInput.query.order_by(SaleInput.date.desc()).first().id])
+        assert sorted((p.tax_year or 0, p.snapshot_json) for p in run_rows(PoolSnapshot)) == before
+        assert run_rows(DisposalResult).count() == disposals  # the 2020 rows it set cgt_due_gbp on were copied, not duplicated
+
+
+@pytest.fixture
+def one_sale(session):
+    """One vesting and one sale in 2022/23, recalculated."""
+    session.add(Vesting(date=date(2022, 5, 1), shares_vested=Decimal("100"), price_usd=Decimal("10"), exchange_rate=Decimal("1"),
+                        shares_sold=Decimal("0"), net_shares=Decimal("100")))
+    session.add(SaleInput(date=date(2022, 8, 1), shares_sold=Decimal("40"), sale_price_usd=Decimal("20"), exchange_rate=Decimal("1")))
+    session.commit()
+    recalc_all()
+
+
+class TestCalcRuns:
+    """Recalcs write a new run and readers switch to it only when it is published."""
+
+    @staticmethod
+    def _new_request():
+        from flask import g
+        g.pop("current_run_id", None)  # the test client shares the test's app context
+
+    def test_building_run_is_invisible(self, session, client, one_sale):
+        from app import start_run, publish_run, retire_rows
+        before = (client.get("/api/transactions").get_json(), client.get("/api/summary/2022").get_json())
+        run = start_run("full")
+        retire_rows(run.id)
+        session.add(DisposalResult(calc_run_id=run.id, sale_date=date(2022, 9, 1), matching_type="Section 104", matched_shares=Decimal("1"),
+                                   proceeds_gbp=Decimal("99"), cost_basis_gbp=Decimal("1"), gain_gbp=Decimal("98")))
+        session.commit()
+        self._new_request()
+        assert (client.get("/api/transactions").get_json(), client.get("/api/summary/2022").get_json()) == before
+        publish_run(run)
+        session.commit()
+        self._new_request()
+        assert [t["proceeds_gbp"] for t in client.get("/api/transactions").get_json()["items"]] == [99.0]
+
+    def test_failed_run_is_not_published(self, session, client, one_sale, monkeypatch):
+        import app as app_module
+        from app import CalcRun, current_run_id
+        published = current_run_id()
+
+        def broken(*args, **kwargs):
+            raise RuntimeError("engine failed")
+        monkeypatch.setattr(app_module, "engine_from_db", broken)
+        with pytest.raises(RuntimeError):
+            recalc_all()
+        self._new_request()
+        assert current_run_id() == published
+        assert CalcRun.query.order_by(CalcRun.id.desc()).first().status == "failed"
+        assert client.get("/api/summary/2022").get_json()["total_disposals"] == 1
+
+    def test_overlapping_runs_refused(self, session, one_sale):
+        from app import CalcRun, RunConflictError, start_run, publish_run, current_run_id
+        published = current_run_id()
+        run = start_run("full")
+        with pytest.raises(RunConflictError):
+            start_run("partial")  # e.g. an edit in another process while `run` builds
+        # A run whose base was replaced while it built is never published
+        run.status = "complete"
+        session.add(CalcRun(kind="full", base_run_id=published, status="complete"))
+        session.commit()
+        newer = CalcRun.query.order_by(CalcRun.id.desc()).first()
+        publish_run(newer)
+        session.commit()
+        stale = CalcRun(kind="partial", base_run_id=published, status="building")
+        session.add(stale)
+        session.commit()
+        with pytest.raises(RunConflictError):
+            publish_run(stale)
+        session.rollback()
+        self._new_request()
+        assert current_run_id() == newer.id
+
+    def test_failed_partial_run_is_purged(self, session, one_sale, monkeypatch):
+        import app as app_module
+        rows = [(r.id, r.calc_run_id, r.superseded_run_id) for r in DisposalResult.query.order_by(DisposalResult.id)]
+
+        def broken(*args, **kwargs):
+            raise RuntimeError("summary failed")
+        monkeypatch.setattr(app_module, "refresh_tax_year_summaries", broken)
+        with pytest.raises(RuntimeError):
+            recalc_all(sale_filter=[SaleInput.query.one().id])  # fails after writing its disposals
+        assert [(r.id, r.calc_run_id, r.superseded_run_id) for r in DisposalResult.query.order_by(DisposalResult.id)] == rows
+
+    def test_old_runs_collected(self, session, one_sale):
+        from app import CalcRun, TaxYearSummary, RUN_RETENTION, current_run_id, run_rows
+        for _ in range(3):
+            recalc_all()
+        kept = [r.id for r in CalcRun.query.order_by(CalcRun.id)]
+        assert len(kept) == RUN_RETENTION and kept[-1] == current_run_id()
+        assert {r.calc_run_id for r in DisposalResult.query} == set(kept)
+        assert {r.calc_run_id for r in TaxYearSummary.query} <= set(kept)
+        # Only rows some kept run still sees are left
+        visible = set()
+        for run_id in kept:
+            visible |= {r.id for r in run_rows(DisposalResult, run_id)}
+        assert {r.id for r in DisposalResult.query} == visible
+
+
+class TestDataVersionEtags:
+    """Read endpoints tag responses with the data generation and revalidate with a single read."""
+
+    def test_304_without_touching_results(self, session, client, one_sale):
+        from sqlalchemy import event
+        from app import db
+        urls = ["/api/summary/2022", "/api/snapshot/2022", "/api/transactions?tax_year=2022", "/api/tax_years", "/api/export/sa108/2022"]
+        tags = {url: client.get(url).headers["ETag"] for url in urls}
+        assert len(set(tags.values())) == 1 and next(iter(tags.values())).startswith('W/"data-')
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            for url, tag in tags.items():
+                resp = client.get(url, headers={"If-None-Match": tag})
+                assert resp.status_code == 304 and resp.data == b"" and resp.headers["ETag"] == tag
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        assert statements and all("data_versions" in st and "disposal_results" not in st for st in statements)
+
+    def test_writes_and_recalcs_change_the_tag(self, session, client, one_sale):
+        def tag():
+            return client.get("/api/summary/2022").headers["ETag"]
+        seen = [tag()]
+        client.post("/api/settings", json={"key": "NonSavingsIncome", "value": "60000"})
+        seen.append(tag())
+        client.post("/api/sales", json={"date": "2022-09-01", "shares_sold": "10", "sale_price_usd": "25", "exchange_rate": "1"})
+        seen.append(tag())
+        recalc_all()
+        seen.append(tag())
+        assert len(set(seen)) == len(seen)
+        resp = client.get("/api/summary/2022", headers={"If-None-Match": seen[0]})
+        assert resp.status_code == 200 and resp.get_json()["total_disposals"] == 2
+
+
+class TestResponseCache:
+    """Read endpoints are served from an LRU keyed by endpoint, arguments and data version."""
+
+    def test_lru_eviction(self):
+        from app import ResponseCache
+        cache = ResponseCache(2)
+        cache.put("a", 1); cache.put("b", 2)
+        assert cache.get("a") == 1
+        cache.put("c", 3)  # evicts b, the least recently used
+        assert cache.get("b") is None and cache.get("c") == 3
+        assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1 and cache.stats()["entries"] == 2
+
+    def test_hits_until_data_changes(self, session, client, one_sale):
+        from sqlalchemy import event
+        from app import db, response_cache
+        before = response_cache.stats()
+        first = client.get("/api/summary/2022").get_json()
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            assert client.get("/api/summary/2022").get_json() == first
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        assert all("tax_year_summaries" not in st for st in statements)
+        client.get("/api/summary/2021")  # other arguments: a separate entry
+        stats = client.get("/api/cache/stats").get_json()
+        assert (stats["hits"] - before["hits"], stats["misses"] - before["misses"], stats["entries"]) == (1, 2, 2)
+
+        client.post("/api/settings", json={"key": "NonSavingsIncome", "value": "60000"})
+        assert response_cache.stats()["entries"] == 0
+        assert client.get("/api/summary/2022").get_json() != first
+        assert client.get("/api/cache/stats").get_json()["misses"] - before["misses"] == 3
+
+
+class TestTaxYearColumns:
+    """tax_year is stored on sales, disposals and steps and kept in step with their dates."""
+
+    def test_follows_the_sale_date(self, session, client, one_sale):
+        from flask import g
+        from app import run_rows
+        sale = SaleInput.query.one()
+        assert sale.tax_year == 2022 and {d.tax_year for d in DisposalResult.query} == {2022}
+        sale.date = date(2023, 4, 5)
+        assert sale.tax_year == 2022
+        assert client.put(f"/api/sales/{sale.id}", json={"date": "2023-04-06"}).status_code == 200
+        g.pop("current_run_id", None)  # the test client shares the test's app context
+        assert SaleInput.query.one().tax_year == 2023
+        assert {d.tax_year for d in run_rows(DisposalResult)} == {2023}
+        assert client.get("/api/tax_years").get_json() == [2023]
+        assert client.get("/api/transactions", query_string={"tax_year": 2022}).get_json()["count"] == 0
+
+    def test_steps_filtered_by_year(self, session, client, one_sale):
+        from app import run_rows, CalculationStep
+        session.add(SaleInput(date=date(2023, 6, 1), shares_sold=Decimal("10"), sale_price_usd=Decimal("20"), exchange_rate=Decimal("1")))
+        session.commit()
+        recalc_all(explain=True)
+        sale_ids = {s.tax_year: s.id for s in SaleInput.query}
+        assert {s.tax_year for s in run_rows(CalculationStep).filter(CalculationStep.sale_input_id.is_(None))} == {None}
+        for year, sale_id in sale_ids.items():
+            steps = client.get("/api/calculation-steps", query_string={"tax_year": year}).get_json()["steps"]
+            assert steps and {s["sale_input_id"] for s in steps} == {sale_id}
+
+
+class TestLotStore:
+    """Test date-indexed range lookups used by the matching loop."""
+
+    @pytest.fixture
+    def store(self):
+        from app import LotStore
+        lots = [
+            {"date": date(2023, 1, 10), "entry": "V:2", "remaining": Decimal("0")},
+            {"date": date(2023, 1, 1), "entry": "V:1", "remaining": Decimal("10")},
+            {"date": date(2023, 1, 10), "entry": "E:1", "remaining": Decimal("5")},
+            {"date": date(2023, 2, 1), "entry": "V:3", "remaining": Decimal("7")},
+        ]
+        return LotStore(lots)
+
+    def test_iterates_in_date_entry_order(self, store):
+        assert [l["entry"] for l in store] == ["V:1", "E:1", "V:2", "V:3"]
+
+    def test_on_and_between_skip_depleted(self, store):
+        assert [l["entry"] for l in store.on(date(2023, 1, 10))] == ["E:1"]
+        assert [l["entry"] for l in store.between(date(2023, 1, 2), date(2023, 2, 1))] == ["E:1", "V:3"]
+
+    def test_before_is_exclusive(self, store):
+        assert [l["entry"] for l in store.before(date(2023, 2, 1))] == ["V:1", "E:1"]
+        store._lots[0]["remaining"] = Decimal("0")
+        assert [l["entry"] for l in store.before(date(2023, 2, 2))] == ["E:1", "V:3"]
+
+    def test_running_pool_totals(self):
+        from app import LotStore
+        lots = [{"date": date(2023, 1, d), "entry": f"V:{d}", "remaining": Decimal("10"), "avg_cost": Decimal(d)} for d in (1, 5, 9)]
+        store = LotStore(lots)
+        store.admit_until(date(2023, 1, 6))
+        assert (store.pool_shares, store.pool_cost) == (Decimal("20"), Decimal("60"))
+        store.deplete(lots[0], Decimal("4"))  # in pool
+        store.deplete(lots[2], Decimal("3"))  # not yet admitted
+        assert (store.pool_shares, store.pool_cost) == (Decimal("16"), Decimal("56"))
+        store.admit_until(date.max)
+        assert store.pool_shares == sum(l["remaining"] for l in lots)
+        assert store.pool_cost == sum(l["remaining"] * l["avg_cost"] for l in lots)
+
+
+class TestSnapshotApi:
+    """api_snapshot decodes the delta-encoded per-sale snapshots."""
+
+    def test_pool_after_for_last_and_given_sale(self, session, client):
+        for i in range(4):
+            session.add(Vesting(date=date(2021, 5, 1) + timedelta(days=60 * i), shares_vested=Decimal("100"), price_usd=Decimal("10"),
+                                exchange_rate=Decimal("1"), shares_sold=Decimal("0"), net_shares=Decimal("100")))
+        sales = [SaleInput(date=date(2021, 6, 1) + timedelta(days=60 * i), shares_sold=Decimal("30"),
+                           sale_price_usd=Decimal("12"), exchange_rate=Decimal("1")) for i in range(3)]
+        session.add_all(sales)
+        session.commit()
+        recalc_all()
+        body = client.get("/api/snapshot/2021").get_json()
+        per_sale = json.loads(body["snapshot_json"])
+        assert "pool_after" in per_sale[0] and "pool_after" not in per_sale[-1]
+        assert sum(lot["remaining"] for lot in body["pool_after"]) == 310.0
+        first = client.get(f"/api/snapshot/2021?sale_id={sales[0].id}").get_json()
+        assert sum(lot["remaining"] for lot in first["pool_after"]) == 370.0
+        assert client.get("/api/snapshot/2021?sale_id=999").status_code == 404
+
+
+class TestCompressedBlobs:
+    """calculation_json / equations / snapshot_json are stored compressed and decoded on read."""
+
+    def test_round_trip(self):
+        import cgt_blob
+        text = json.dumps({"numeric_trace": {"gain_gbp": "12.50"}, "pad": "x" * 500})
+        for codec in (cgt_blob.RAW, cgt_blob.ZLIB):
+            blob = cgt_blob.encode(text, codec)
+            assert blob[0] == codec and cgt_blob.decode(blob) == text
+        assert len(cgt_blob.encode(text, cgt_blob.ZLIB)) < len(text) // 4
+        assert cgt_blob.encode("{}", cgt_blob.ZLIB)[0] == cgt_blob.RAW  # too small to gain
+        assert cgt_blob.decode("{legacy text}") == "{legacy text}" and cgt_blob.encode(None) is None
+        with pytest.raises(ValueError):
+            cgt_blob.decode(b"\x7f...")
+
+    def test_endpoints_decode_compressed_and_legacy_rows(self, session, client, monkeypatch):
+        from app import db
+        monkeypatch.setenv("CGT_BLOB_CODEC", "zlib")
+        session.add(Vesting(date=date(2021, 5, 1), shares_vested=Decimal("100"), price_usd=Decimal("10"), exchange_rate=Decimal("1"),
+                            shares_sold=Decimal("0"), net_shares=Decimal("100")))
+        session.add(SaleInput(date=date(2021, 8, 1), shares_sold=Decimal("30"), sale_price_usd=Decimal("12"), exchange_rate=Decimal("1")))
+        session.commit()
+        recalc_all()
+        dr = DisposalResult.query.one()
+        stored = session.execute(db.text("SELECT calculation_json FROM disposal_results")).scalar()
+        assert isinstance(stored, bytes) and stored[0] == 1
+        assert client.get(f"/api/transaction/{dr.id}").get_json()["calculation"]["inputs"]["lot"]["source"] == "POOLED"
+        assert json.loads(client.get("/api/snapshot/2021").get_json()["snapshot_json"])[0]["sale"]["date"] == "2021-08-01"
+        assert "pool_after" in client.get("/download/pool").data.decode()
+
+        # Rows written before the encoding are plain TEXT
+        legacy = json.dumps({"inputs": {"lot": {"source": "ESPP"}}})
+        session.execute(db.text("UPDATE disposal_results SET calculation_json = :v"), {"v": legacy})
+        session.commit()
+        session.expire_all()
+        assert client.get(f"/api/transaction/{dr.id}").get_json()["calculation"]["inputs"]["lot"]["source"] == "ESPP"
+
+
+class TestTransactionTraceApi:
+    """Only numeric traces are persisted; equations are rendered when a disposal is opened."""
+
+    def test_equations_rendered_on_request(self, session, client):
+        from app import CalculationDetail
+        session.add(Vesting(date=date(2021, 5, 1), shares_vested=Decimal("100"), price_usd=Decimal("10"), exchange_rate=Decimal("1.25"),
+                            shares_sold=Decimal("0"), net_shares=Decimal("100")))
+        session.add(SaleInput(date=date(2021, 7, 1), shares_sold=Decimal("40"), sale_price_usd=Decimal("15"), exchange_rate=Decimal("1.25")))
+        session.commit()
+        recalc_all()
+        dr = DisposalResult.query.one()
+        assert "equations" not in json.loads(dr.calculation_json)
+        assert CalculationDetail.query.count() == 0
+        body = client.get(f"/api/transaction/{dr.id}").get_json()
+        assert body["calculation"]["equations"][-1] == "Gain = 480.00 − 320.00 = 160.00"
+        assert body["details"][0]["explanation"].startswith("Fragment 1 matched 40.000000 shares")
+        listing = client.get("/api/transactions").get_json()["items"][0]
+        assert listing["calculation_snippet"] == body["calculation"]["equations"][:3]
+        lot = body["calculation"]["inputs"]["lot"]
+        assert (listing["lot_entry"], listing["source"], listing["rate_used"], listing["fragment_index"]) == (lot["entry"], lot["source"], body["calculation"]["inputs"]["sale_rate_used"], 1)
+
+
+class TestTransactionsListing:
+    """/api/transactions filters in SQL and pages by (sale_date, id) keyset."""
+
+    @pytest.fixture
+    def fragments(self, session):
+        # Vestings every 20 days, sales every 45 days across 2021/22 and 2022/23: a mix of matching types
+        for i in range(30):
+            session.add(Vesting(date=date(2021, 5, 1) + timedelta(days=20 * i), shares_vested=Decimal("50"), price_usd=Decimal(10 + i % 4),
+                                exchange_rate=Decimal("1"), shares_sold=Decimal("0"), net_shares=Decimal("50")))
+        for i in range(12):
+            session.add(SaleInput(date=date(2021, 6, 1) + timedelta(days=45 * i), shares_sold=Decimal("70"), sale_price_usd=Decimal("15"),
+                                  exchange_rate=Decimal("1")))
+        session.commit()
+        recalc_all()
+
+    @staticmethod
+    def _pages(client, **params):
+        ids, after = [], None
+        while True:
+            query = dict(params, limit=4, **({"after_id": after} if after else {}))
+            body = client.get("/api/transactions", query_string=query).get_json()
+            assert body["count"] <= 4
+            ids += [i["disposal_id"] for i in body["items"]]
+            after = body["next_after_id"]
+            if after is None:
+                return ids
+
+    def test_pages_cover_the_listing_in_order(self, session, client, fragments):
+        rows = DisposalResult.query.order_by(DisposalResult.sale_date, DisposalResult.id).all()
+        assert len(rows) > 8
+        assert self._pages(client) == [r.id for r in rows]
+        everything = client.get("/api/transactions", query_string={"limit": 5000}).get_json()
+        assert everything["next_after_id"] is None and everything["count"] == len(rows)
+
+    def test_filters(self, session, client, fragments):
+        rows = DisposalResult.query.order_by(DisposalResult.sale_date, DisposalResult.id).all()
+        in_2022 = [r.id for r in rows if date(2022, 4, 6) <= r.sale_date < date(2023, 4, 6)]
+        assert in_2022 and self._pages(client, tax_year=2022) == in_2022
+        assert self._pages(client, matching="Section 104") == [r.id for r in rows if r.matching_type == "Section 104"]
+        sale_id = rows[-1].sale_input_id
+        assert self._pages(client, sale_id=sale_id) == [r.id for r in rows if r.sale_input_id == sale_id]
+        entries = {r.id: json.loads(r.calculation_json)["inputs"]["lot"]["entry"] for r in rows}
+        entry = next(e for e in entries.values() if e.startswith("V:"))
+        assert self._pages(client, lot=entry) == [i for i, e in entries.items() if e == entry]
+        assert self._pages(client, q=entry.lower()) == [i for i, e in entries.items() if entry.lower() in e.lower()]
+
+    def test_bad_cursor_and_params(self, session, client, fragments):
+        assert client.get("/api/transactions?after_id=999999").status_code == 400
+        assert client.get("/api/transactions?tax_year=abc").status_code == 400
+
+
+class TestCsvExports:
+    """/download/<kind> streams its CSV in chunks."""
+
+    def test_disposals_streamed_in_chunks(self, session, client, monkeypatch):
+        import csv
+        import app as app_module
+        monkeypatch.setattr(app_module, "CSV_FLUSH_ROWS", 2)
+        monkeypatch.setattr(app_module, "CSV_YIELD_PER", 3)
+        session.add(Vesting(date=date(2021, 5, 1), shares_vested=Decimal("1000"), price_usd=Decimal("10"), exchange_rate=Decimal("1"),
+                            shares_sold=Decimal("0"), net_shares=Decimal("1000")))
+        session.add_all([SaleInput(date=date(2021, 6, 1) + timedelta(days=7 * i), shares_sold=Decimal("10"), sale_price_usd=Decimal("12"),
+                                   exchange_rate=Decimal("1")) for i in range(7)])
+        session.commit()
+        recalc_all()
+        resp = client.get("/download/disposals")
+        assert resp.is_streamed and resp.mimetype == "text/csv"
+        assert resp.headers["Content-Disposition"] == "attachment; filename=disposals.csv"
+        chunks = list(resp.response)
+        assert len(chunks) == 5  # header, then 2 + 2 + 2 + 1 rows
+        rows = list(csv.reader(io.StringIO("".join(c.decode() if isinstance(c, bytes) else c for c in chunks))))
+        expected = DisposalResult.query.order_by(DisposalResult.sale_date, DisposalResult.id).all()
+        assert rows[0][0] == "disposal_id" and [int(r[0]) for r in rows[1:]] == [d.id for d in expected]
+        assert rows[1][9] == "20.0"
+
+
+class TestRecalcTrace:
+    """recalc_all exports per-run span timings when tracing is on."""
+
+    def test_trace_returned_and_served(self, session, client):
+        from cgt_trace import Tracer
+        session.add(Vesting(date=date(2021, 5, 1), shares_vested=Decimal("100"), price_usd=Decimal("10"), exchange_rate=Decimal("1"),
+                            shares_sold=Decimal("0"), net_shares=Decimal("100")))
+        session.add(SaleInput(date=date(2021, 7, 1), shares_sold=Decimal("40"), sale_price_usd=Decimal("15"), exchange_rate=Decimal("1")))
+        session.commit()
+        assert "trace" not in recalc_all(tracer=Tracer())
+        trace = recalc_all(tax_year_filter=2021, tracer=Tracer("info"))["trace"]
+        paths = [span["path"] for span in trace["spans"]]
+        assert paths == ["recalc", "recalc/lot_build", "recalc/matching", "recalc/matching/fragment_build",
+                         "recalc/persistence", "recalc/tax_summary", "recalc/year_summaries"]
+        assert client.get("/api/recalc/trace").get_json() == json.loads(json.dumps(trace))
+
+
+class TestTaxYearSummaries:
+    """api_summary, SA108 and the summary CSV read the materialised per-year rows."""
+
+    @pytest.fixture
+    def two_years(self, session):
+        session.add(Vesting(date=date(2020, 5, 1), shares_vested=Decimal("1000"), price_usd=Decimal("10"), exchange_rate=Decimal("1"),
+                            shares_sold=Decimal("0"), net_shares=Decimal("1000")))
+        session.add_all([SaleInput(date=date(2021, 7, 1), shares_sold=Decimal("400"), sale_price_usd=Decimal("50"), exchange_rate=Decimal("1")),
+                         SaleInput(date=date(2022, 7, 1), shares_sold=Decimal("100"), sale_price_usd=Decimal("8"), exchange_rate=Decimal("1"))])
+        session.add(Setting(key="NonSavingsIncome", value="30000"))
+        session.commit()
+        recalc_all()
+
+    def test_every_year_materialised(self, session, client, two_years):
+        from app import TaxYearSummary
+        assert [r.tax_year for r in TaxYearSummary.query.order_by(TaxYearSummary.tax_year)] == [2021, 2022]
+        body = client.get("/api/summary/2021").get_json()
+        assert (body["total_disposals"], body["net_gain"], body["cgt_allowance_gbp"]) == (1, 16000.0, 12300.0)
+        assert body["basic_taxable_gain"] == 3700.0 and body["estimated_cgt"] == 370.0
+        sa108 = client.get("/api/export/sa108/2022").get_json()
+        assert (sa108["total_losses"], sa108["allowable_loss"], sa108["chargeable_gain"]) == (200.0, 200.0, 0.0)
+        csv_rows = client.get("/download/summary?tax_year=2021").data.decode().splitlines()
+        assert csv_rows[0].split(",")[-4:] == ["taxable_after_allowance", "basic_taxable_gain", "higher_taxable_gain", "estimated_cgt"]
+        assert csv_rows[1].split(",")[-4:] == ["3700.0", "3700.0", "0.0", "370.0"]
+        assert client.get("/api/export/sa108/2023").status_code == 404
+        assert client.get("/api/summary/2023").get_json()["total_disposals"] == 0
+
+    def test_settings_change_refreshes(self, session, client, two_years):
+        client.post("/api/settings", json={"key": "NonSavingsIncome", "value": "60000"})
+        assert client.get("/api/summary/2021").get_json()["estimated_cgt"] == 740.0
+
+
+class TestSchemaMigrations:
+    """Versioned ensure_db_schema: legacy files are upgraded once, current ones are left alone."""
+
+    @pytest.fixture
+    def legacy_db(self, tmp_path, monkeypatch):
+        import sqlite3
+        import app as app_module
+        path = tmp_path / "legacy.db"
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+            CREATE TABLE vesting (id INTEGER PRIMARY KEY, date DATE, shares_vested NUMERIC);
+            CREATE TABLE exchange_rates (id INTEGER PRIMARY KEY, date DATE, usd_gbp NUMERIC);
+            CREATE INDEX ix_exchange_rates_date ON exchange_rates (date);
+            INSERT INTO exchange_rates (date, usd_gbp) VALUES ('2020-01-02', 1.3), ('2020-01-02', 1.4);
+            CREATE TABLE stock_data (id INTEGER PRIMARY KEY, ticker VARCHAR(10), date DATE, price_usd NUMERIC, is_prediction BOOLEAN);
+            INSERT INTO stock_data (ticker, date, price_usd, is_prediction) VALUES
+                ('AAPL', '2024-01-02', 10, 0), ('AAPL', '2024-01-02', 11, NULL), ('AAPL', '2024-01-02', 12, 1);
+            CREATE TABLE disposal_results (id INTEGER PRIMARY KEY, sale_date DATE, sale_input_id INTEGER, matching_type VARCHAR(32), calculation_json TEXT);
+            CREATE INDEX ix_disposal_results_sale_date ON disposal_results (sale_date);
+            CREATE TABLE sales_in (id INTEGER PRIMARY KEY, date DATE, shares_sold NUMERIC);
+            INSERT INTO sales_in (id, date, shares_sold) VALUES (2, '2021-04-05', 10), (3, '2021-04-06', 10);
+            CREATE TABLE calculation_steps (id INTEGER PRIMARY KEY, sale_input_id INTEGER, step_order INTEGER, message TEXT);
+            INSERT INTO calculation_steps (sale_input_id, step_order, message) VALUES (3, 1, 'matched'), (NULL, 2, 'done');
+        """)
+        # A row from before traces were rendered lazily: equations are stored in calculation_json
+        calc = {"inputs": {"sale_rate_used": "1.25", "lot": {"entry": "V:7", "source": "RSU"}},
+                "numeric_trace": {"fragment_index": 2}, "equations": ["a = 1", "b = 2", "c = 3", "d = 4"]}
+        conn.execute("INSERT INTO disposal_results (sale_date, sale_input_id, matching_type, calculation_json) VALUES ('2021-07-01', 3, 'Same day', ?)",
+                     (json.dumps(calc),))
+        conn.commit()
+        conn.close()
+        monkeypatch.setattr(app_module, "DB_PATH", str(path))
+        return path
+
+    def test_upgrades_legacy_file_once(self, legacy_db, monkeypatch):
+        import sqlite3
+        import app as app_module
+        app_module.ensure_db_schema()
+        conn = sqlite3.connect(legacy_db)
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == app_module.SCHEMA_VERSION
+        indexes = {name: sql for name, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type='index'")}
+        assert "UNIQUE" in indexes["ix_exchange_rates_date"] and "UNIQUE" in indexes["ux_stock_data_ticker_prediction_date"]
+        assert {"ix_disposal_results_sale_date_id", "ix_disposal_results_year_sale_date_id", "ix_disposal_results_sale_input_id"} <= set(indexes)
+        assert "ix_disposal_results_sale_date" not in indexes and "ix_disposal_results_run_sale_date_id" not in indexes
+        assert conn.execute("SELECT usd_gbp FROM exchange_rates").fetchall() == [(1.3,)]
+        assert conn.execute("SELECT price_usd, is_prediction FROM stock_data ORDER BY id").fetchall() == [(10, 0), (12, 1)]
+        assert "incidental_costs_gbp" in {r[1] for r in conn.execute("PRAGMA table_info(vesting)")}
+        assert conn.execute("SELECT calc_run_id, fragment_index, lot_entry, lot_source, rate_used, equation_snippet FROM disposal_results").fetchall() == \
+            [(0, 2, "V:7", "RSU", "1.25", "a = 1\nb = 2\nc = 3")]
+        visible = "calc_run_id <= 0 AND coalesce(superseded_run_id, 1) > 0"
+        plan = conn.execute(f"EXPLAIN QUERY PLAN SELECT * FROM disposal_results WHERE {visible} ORDER BY sale_date, id").fetchall()
+        assert "ix_disposal_results_sale_date_id" in str(plan) and "TEMP B-TREE" not in str(plan)
+        assert conn.execute("SELECT id, tax_year FROM sales_in ORDER BY id").fetchall() == [(2, 2020), (3, 2021)]
+        assert conn.execute("SELECT tax_year FROM disposal_results").fetchall() == [(2021,)]
+        assert conn.execute("SELECT tax_year FROM calculation_steps ORDER BY id").fetchall() == [(2021,), (None,)]
+        plan = conn.execute(f"EXPLAIN QUERY PLAN SELECT * FROM disposal_results WHERE {visible} AND tax_year = 2021 ORDER BY sale_date, id").fetchall()
+        assert "ix_disposal_results_year_sale_date_id" in str(plan) and "TEMP B-TREE" not in str(plan)
+        conn.close()
+        # Current schema: no migration runs again
+        monkeypatch.setattr(app_module, "MIGRATIONS", [None] * app_module.SCHEMA_VERSION)
+        app_module.ensure_db_schema()
+
+    def test_cache_stock_data_keeps_one_row_per_day(self, session):
+        import pandas as pd
+        from app import cache_stock_data, StockData
+        session.add(StockData(ticker="AAPL", date=date(2024, 1, 2), price_usd=Decimal("9"), is_prediction=True))
+        session.commit()
+        df = pd.DataFrame({"Date": pd.to_datetime(["2024-01-02", "2024-01-03"]), "price_usd": [10.0, 11.0]})
+        cache_stock_data(df, "AAPL")
+        cache_stock_data(df.assign(price_usd=[20.0, 21.0]), "AAPL")
+        rows = StockData.query.filter_by(ticker="AAPL").order_by(StockData.is_prediction, StockData.date).all()
+        assert [(r.date, r.is_prediction, r.price_usd) for r in rows] == [
+            (date(2024, 1, 2), False, Decimal("10")), (date(2024, 1, 3), False, Decimal("11")), (date(2024, 1, 2), True, Decimal("9"))]
+
+
+class TestArchive:
+    """Per-tax-year columnar archive: closed years only, read back without the database."""
+
+    @pytest.fixture
+    def archived(self, session, tmp_path, monkeypatch):
+        import app as app_module
+        session.add_all([
+            Vesting(date=date(2020, 5, 1), shares_vested=Decimal("100"), price_usd=Decimal("10"), exchange_rate=Decimal("1"), net_shares=Decimal("100")),
+            ESPPPurchase(date=date(2021, 6, 20), shares_retained=Decimal("50"), purchase_price_usd=Decimal("8"), market_price_usd=Decimal("9"),
+                         exchange_rate=Decimal("1"), qualifying=True),
+            SaleInput(date=date(2021, 7, 1), shares_sold=Decimal("120"), sale_price_usd=Decimal("20"), exchange_rate=Decimal("1"),
+                      incidental_costs_gbp=Decimal("12")),
+        ])
+        session.commit()
+        recalc_all()
+        monkeypatch.setattr(app_module, "ARCHIVE_DIR", str(tmp_path))
+        return tmp_path
+
+    @pytest.fixture(params=["csv", "parquet"])
+    def fmt(self, request, monkeypatch):
+        import cgt_archive
+        if request.param == "parquet":
+            pytest.importorskip("pyarrow")
+        monkeypatch.setattr(cgt_archive, "HAS_PYARROW", request.param == "parquet")
+
+    def test_round_trip_and_year_slices(self, session, client, archived, fmt):
+        import cgt_archive
+        body = client.post("/api/archive", json={}).get_json()
+        assert [(a["tax_year"], a["fragments"]) for a in body["archived"]] == [(2021, 2)]
+        session.query(DisposalResult).delete()  # reads must not need the database
+        session.commit()
+        df = cgt_archive.read_year(str(archived), 2021)
+        assert list(df["matching_type"]) == ["30-day", "Section 104"]
+        assert list(df["lot_source"]) == ["ESPP", "POOLED"] and list(df["trace_fragment_index"]) == [1, 2]
+        assert df["proceeds_gbp"].sum() == Decimal("2388") and df["trace_incidental_sale_gbp"][0] == "12.00"
+        groups = client.get("/api/archive/2021?by=lot_source").get_json()["groups"]
+        assert groups == [{"lot_source": "ESPP", "fragments": 1, "matched_shares": 50.0, "proceeds_gbp": 995.0, "cost_basis_gbp": 400.0, "gain_gbp": 595.0},
+                          {"lot_source": "POOLED", "fragments": 1, "matched_shares": 70.0, "proceeds_gbp": 1393.0, "cost_basis_gbp": 700.0, "gain_gbp": 693.0}]
+        assert client.get("/api/archive/2020").status_code == 404
+        assert client.get("/api/archive/2021?by=nope").status_code == 400
+        assert client.get("/api/archive").get_json()["tax_years"] == [2021]
+
+    def test_open_year_not_archived(self, session, archived):
+        from app import archive_tax_years, tax_year_of
+        assert archive_tax_years([tax_year_of(date.today())]) == []
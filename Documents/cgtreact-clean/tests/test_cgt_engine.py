@@ -0,0 +1,265 @@
+import dataclasses
+import json
+import random
+from types import SimpleNamespace
+import pytest
+from datetime import date, timedelta
+from decimal import Decimal
+
+from cgt_trace import Tracer
+from cgt_engine import (CGTEngine, FxTable, FxRecord, VestingRecord, EsppRecord, SaleRecord, TaxSettings,
+                        summarise_tax_year, summarise_all_years, allocate_cgt, pool_at, tax_year_of, q2, render_equations, render_explanation)
+
+
+def vest(id, d, shares, price="10", rate="1"):
+    return VestingRecord(id=id, date=d, shares_vested=Decimal(shares), price_usd=Decimal(price), exchange_rate=Decimal(rate))
+
+def sale(id, d, shares, price="20", rate="1", incidental=None):
+    return SaleRecord(id=id, date=d, shares_sold=Decimal(shares), sale_price_usd=Decimal(price), exchange_rate=Decimal(rate),
+                      incidental_costs_gbp=Decimal(incidental) if incidental else None)
+
+
+class TestEngineMatching:
+    """CGTEngine runs on plain records with no app context or database."""
+
+    def test_same_day_then_s104(self):
+        engine = CGTEngine(vestings=[vest(1, date(2020, 1, 1), 100), vest(2, date(2021, 1, 1), 50, price="12")])
+        result = engine.run([sale(1, date(2021, 1, 1), 80)])
+        kinds = [(d.matching_type, d.matched_shares) for d in result.disposals]
+        assert kinds == [("Same-day", Decimal("50")), ("Section 104", Decimal("30"))]
+        assert result.disposals[0].gain_gbp == Decimal("400.00")  # (20 - 12) * 50
+        assert result.disposals[1].gain_gbp == Decimal("300.00")  # (20 - 10) * 30
+        assert result.holding_shares == Decimal("70")
+
+    def test_thirty_day_forward(self):
+        engine = CGTEngine(vestings=[vest(1, date(2020, 1, 1), 100), vest(2, date(2020, 2, 10), 40, price="15")])
+        result = engine.run([sale(1, date(2020, 2, 1), 60)])
+        assert [(d.matching_type, d.matched_shares) for d in result.disposals] == [
+            ("30-day forward", Decimal("40")), ("Section 104", Decimal("20"))]
+
+    def test_insufficient_holdings(self):
+        result = CGTEngine(vestings=[vest(1, date(2020, 1, 1), 10)]).run([sale(1, date(2020, 1, 1), 25)])
+        assert result.errors_present
+        assert result.disposals[-1].matching_type == "ERROR: insufficient holdings"
+        assert result.snapshots[-1]["error"] is True
+
+    def test_incidental_costs_reduce_proceeds(self):
+        engine = CGTEngine(vestings=[vest(1, date(2020, 1, 1), 100)])
+        (d,) = engine.run([sale(1, date(2020, 6, 1), 100, incidental="100")]).disposals
+        assert d.proceeds_gbp == Decimal("1900.00")
+        assert d.gain_gbp == Decimal("900.00")
+        calc = json.loads(d.calculation_json)
+        assert "equations" not in calc
+        assert render_explanation(calc, d.matching_type).endswith("adjusted for incidental costs")
+        assert render_equations(calc["numeric_trace"])[1] == "Adjusted total proceeds = 2000.00 × 0.95 (after £100.00 incidental) = 1900.00"
+
+    def test_results_are_immutable_and_runs_repeatable(self):
+        engine = CGTEngine(vestings=[vest(1, date(2020, 1, 1), 100)], espp=[
+            EsppRecord(id=1, date=date(2020, 3, 1), shares_retained=Decimal("20"), purchase_price_usd=Decimal("8"),
+                       exchange_rate=Decimal("1"), paye_tax_gbp=Decimal("10"))])
+        sales = [sale(1, date(2020, 6, 1), 60), sale(2, date(2020, 7, 1), 60)]
+        first, second = engine.run(sales), engine.run(sales)
+        assert first.disposals == second.disposals
+        with pytest.raises(dataclasses.FrozenInstanceError):
+            first.disposals[0].gain_gbp = Decimal("0")
+
+    def test_checkpoint_resume_matches_full_run(self):
+        vestings = [vest(i, date(2020, 1, 1) + timedelta(days=20 * i), 100) for i in range(1, 20)]
+        sales = [sale(i, date(2020, 1, 15) + timedelta(days=35 * i), 120) for i in range(1, 10)]
+        engine = CGTEngine(vestings=vestings)
+        full = engine.run(sales, checkpoint_every=3)
+        cp = full.checkpoints[1]
+        start = next(i for i, s in enumerate(sales) if s.id == cp.next_sale_id)
+        resumed = engine.run(sales[start:], resume_from=cp)
+        replayed = {d.sale_id for d in resumed.disposals}
+        assert resumed.disposals == tuple(d for d in full.disposals if d.sale_id in replayed)
+
+
+class TestFixedPointArithmetic:
+    """Integer micro-share / pence mode must agree with the Decimal path to the penny."""
+
+    @staticmethod
+    def random_portfolio(seed):
+        rnd = random.Random(seed)
+        start = date(2018, 1, 1)
+        money = lambda lo, hi: Decimal(rnd.randrange(lo * 100, hi * 100)) / 100
+        rate = lambda: Decimal(rnd.randrange(11000, 16000)) / 10000
+        vestings = [VestingRecord(id=i, date=start + timedelta(days=rnd.randrange(1500)),
+                                  shares_vested=Decimal(rnd.randrange(1, 400000)) / 1000, price_usd=money(5, 300),
+                                  exchange_rate=rate() if rnd.random() < 0.7 else None,
+                                  incidental_costs_gbp=money(0, 20) if rnd.random() < 0.3 else None)
+                    for i in range(1, 60)]
+        espp = [EsppRecord(id=i, date=start + timedelta(days=rnd.randrange(1500)), shares_retained=Decimal(rnd.randrange(1, 90000)) / 1000,
+                           purchase_price_usd=money(5, 200), exchange_rate=rate() if rnd.random() < 0.7 else None,
+                           paye_tax_gbp=money(1, 400) if rnd.random() < 0.5 else None, discount_taxed_paye=rnd.random() < 0.8)
+                for i in range(1, 20)]
+        sales = sorted((SaleRecord(id=i, date=start + timedelta(days=rnd.randrange(1600)), shares_sold=Decimal(rnd.randrange(1, 300000)) / 1000,
+                                   sale_price_usd=money(5, 400), exchange_rate=rate() if rnd.random() < 0.6 else None,
+                                   incidental_costs_gbp=money(1, 60) if rnd.random() < 0.4 else None)
+                        for i in range(1, 45)), key=lambda s: (s.date, s.id))
+        fx = [FxRecord(start + timedelta(days=30 * i), rate()) for i in range(55)]
+        return vestings, espp, fx, sales
+
+    @pytest.mark.parametrize("seed", range(8))
+    def test_matches_decimal_to_the_penny(self, seed):
+        vestings, espp, fx, sales = self.random_portfolio(seed)
+        reference = CGTEngine(vestings, espp, fx).run(sales, checkpoint_every=5)
+        fixed = CGTEngine(vestings, espp, fx, arithmetic="fixed").run(sales, checkpoint_every=5)
+        assert len(fixed.disposals) == len(reference.disposals) > 0
+
+        def pennies(d):
+            return (d.sale_id, d.matching_type, d.matched_date, d.matched_shares, q2(d.avg_cost_gbp),
+                    d.proceeds_gbp, d.cost_basis_gbp, d.gain_gbp)
+        assert [pennies(d) for d in fixed.disposals] == [pennies(d) for d in reference.disposals]
+        assert fixed.holding_shares == reference.holding_shares
+        assert q2(fixed.holding_cost_gbp) == q2(reference.holding_cost_gbp)
+        assert [c.balances for c in fixed.checkpoints] == [c.balances for c in reference.checkpoints]
+        assert [s["changed"] for s in fixed.snapshots] == [s["changed"] for s in reference.snapshots]
+
+    def test_resume_from_fixed_checkpoint(self):
+        vestings, espp, fx, sales = self.random_portfolio(99)
+        engine = CGTEngine(vestings, espp, fx, arithmetic="fixed")
+        full = engine.run(sales, checkpoint_every=4)
+        cp = full.checkpoints[2]
+        start = next(i for i, s in enumerate(sales) if s.id == cp.next_sale_id)
+        resumed = engine.run(sales[start:], resume_from=cp)
+        assert resumed.disposals == full.disposals[len(full.disposals) - len(resumed.disposals):]
+
+    def test_rejects_sub_micro_share_quantities(self):
+        engine = CGTEngine(vestings=[VestingRecord(id=1, date=date(2020, 1, 1), shares_vested=Decimal("1.0000001"),
+                                                   price_usd=Decimal("10"), exchange_rate=Decimal("1"))], arithmetic="fixed")
+        with pytest.raises(ValueError):
+            engine.run([])
+
+
+class TestSnapshotDeltas:
+    """Per-sale snapshots store `changed` deltas plus keyframes; pool_at rebuilds any sale."""
+
+    def test_pool_at_matches_full_copies(self):
+        vestings, espp, fx, sales = TestFixedPointArithmetic.random_portfolio(3)
+        engine = CGTEngine(vestings, espp, fx)
+        full = engine.run(sales, keyframe_every=1).snapshots
+        deltas = engine.run(sales, keyframe_every=7).snapshots
+        assert all("pool_after" in snap for snap in full)
+        assert sum("pool_after" in snap for snap in deltas) < len(deltas) / 2
+        for i in range(len(deltas)):
+            assert pool_at(deltas, i) == full[i]["pool_after"]
+
+    def test_keyframe_at_each_tax_year_start(self):
+        vestings, espp, fx, sales = TestFixedPointArithmetic.random_portfolio(5)
+        snaps = CGTEngine(vestings, espp, fx).run(sales).snapshots
+        years = [tax_year_of(date.fromisoformat(snap["sale"]["date"])) for snap in snaps]
+        for i, ty in enumerate(years):
+            if i == 0 or years[i - 1] != ty:
+                assert "pool_after" in snaps[i]
+
+
+class TestFxTable:
+    """Nearest-date FX lookup used for rows without their own rate."""
+
+    def test_nearest_rate_and_tie(self):
+        fx = FxTable([FxRecord(date(2020, 1, 1), Decimal("1.2")), FxRecord(date(2020, 1, 11), Decimal("1.4"))])
+        assert fx.rate_for(date(2020, 1, 11)) == Decimal("1.4")
+        assert fx.rate_for(date(2020, 1, 4)) == Decimal("1.2")
+        assert fx.rate_for(date(2020, 1, 6)) == Decimal("1.2")  # equidistant: earlier wins
+        assert fx.rate_for(date(2020, 1, 7)) == Decimal("1.4")
+        assert FxTable().rate_for(date(2020, 1, 1)) == Decimal("1")
+
+    @staticmethod
+    def nearest(records, d):
+        """Reference policy: nearest date, earlier wins ties, first record per date wins."""
+        first = {}
+        for r in records:
+            first.setdefault(r.date, r.usd_gbp)
+        return first[min(first, key=lambda x: (abs((x - d).days), x))]
+
+    def test_calendar_matches_nearest_date_policy(self):
+        rnd = random.Random(7)
+        start = date(2020, 1, 1)
+        records = [FxRecord(start + timedelta(days=rnd.randrange(120)), Decimal(rnd.randrange(1000, 1500)) / 1000)
+                   for _ in range(40)]
+        fx = FxTable(records)
+        for offset in range(-10, 140):  # before, inside (weekends, gaps, ties) and after the range
+            d = start + timedelta(days=offset)
+            assert fx.rate_for(d) == self.nearest(records, d), d
+
+    def test_with_rates_matches_rebuild(self):
+        rnd = random.Random(11)
+        start = date(2020, 1, 1)
+        make = lambda n: [FxRecord(start + timedelta(days=rnd.randrange(-30, 150)), Decimal(rnd.randrange(1000, 1500)) / 1000)
+                          for _ in range(n)]
+        base, extra = make(25), make(10)
+        patched, rebuilt = FxTable(base).with_rates(extra), FxTable(base + extra)
+        assert list(patched.items()) == list(rebuilt.items())
+        assert patched._calendar == rebuilt._calendar
+        assert FxTable().with_rates(extra)._calendar == FxTable(extra)._calendar
+        assert FxTable(base).with_rates(base[:3])._calendar == FxTable(base)._calendar  # known dates keep their rate
+
+
+class TestTracing:
+    """Tracer spans and events; a disabled tracer records nothing."""
+
+    def test_spans_and_events_by_level(self):
+        engine = CGTEngine(vestings=[vest(1, date(2020, 1, 1), 100), vest(2, date(2020, 3, 1), 100)])
+        sales = [sale(1, date(2020, 2, 1), 50), sale(2, date(2020, 4, 1), 120)]
+        off, info, debug = Tracer(), Tracer("info"), Tracer("debug")
+        assert engine.run(sales, tracer=off).disposals == engine.run(sales, tracer=debug).disposals
+        engine.run(sales, tracer=info)
+        assert not off.spans and not off.events
+        assert not info.events
+        spans = {span["path"]: span["count"] for span in json.loads(debug.to_json())["spans"]}
+        assert spans == {"lot_build": 1, "matching": 2, "matching/fragment_build": 2}
+        assert [e["event"] for e in debug.events] == ["sale", "fragment", "sale", "fragment"]
+        assert debug.events[0]["open_lots"] == [("V:1", "100"), ("V:2", "100")]
+
+
+class TestTaxSummary:
+    """Tax-year netting and CGT allocation without a database."""
+
+    def test_summary_and_allocation(self):
+        settings = TaxSettings(allowance=Decimal("3000"), non_savings_income=Decimal("30000"))
+        summary = summarise_tax_year([Decimal("8000"), Decimal("4000"), Decimal("-2000")], settings)
+        assert summary.net_gain == Decimal("10000")
+        assert summary.taxable_gain == Decimal("7000")
+        assert summary.estimated_cgt == Decimal("700.00")  # all within the 7700 basic band left
+        assert allocate_cgt(Decimal("8000"), summary) == Decimal("466.67")
+        assert allocate_cgt(Decimal("-2000"), summary) is None
+        assert summary.as_dict()["basic_band_available"] == 7700.0
+
+    def test_all_years_in_one_pass(self):
+        disposals = [SimpleNamespace(sale_date=d, proceeds_gbp=Decimal("1000"), cost_basis_gbp=Decimal("1000") - g, gain_gbp=g)
+                     for d, g in [(date(2021, 5, 1), Decimal("9000")), (date(2022, 4, 5), Decimal("-500")),
+                                  (date(2022, 4, 6), Decimal("5000")), (date(2021, 4, 6), Decimal("200"))]]
+        settings_for = lambda ty: TaxSettings(allowance=Decimal("3000") if ty >= 2022 else Decimal("12300"))
+        years = summarise_all_years(disposals, settings_for, {2020: Decimal("400"), 2021: Decimal("100")}, years=(2023,))
+        assert sorted(years) == [2021, 2022, 2023]
+        y21, y22 = years[2021], years[2022]
+        assert (y21.disposal_count, y21.total_proceeds, y21.total_gain) == (3, Decimal("3000"), Decimal("8700"))
+        assert y21.tax == summarise_tax_year([Decimal("9000"), Decimal("-500"), Decimal("200")], settings_for(2021), Decimal("400"))
+        assert y22.tax.carry_forward_loss == Decimal("500") and y22.carry_forward_used == Decimal("500")
+        assert y22.tax.taxable_gain == Decimal("1500")
+        assert years[2023].disposal_count == 0 and years[2023].tax.estimated_cgt == Decimal("0.00")
+
+    def test_excess_loss(self):
+        summary = summarise_tax_year([Decimal("100"), Decimal("-400")], TaxSettings())
+        assert summary.excess_loss == Decimal("300")
+        assert summary.estimated_cgt == Decimal("0.00")
+
+
+class TestEngineMatchesRecalc:
+    """recalc_all is a thin persistence layer over the engine."""
+
+    def test_engine_matches_persisted_results(self, session):
+        from app import engine_from_db, recalc_all, Vesting, SaleInput, DisposalResult, SaleRecord
+        for i in range(6):
+            session.add(Vesting(date=date(2020, 1, 10) + timedelta(days=45 * i), shares_vested=Decimal("100"), price_usd=Decimal(10 + i),
+                                exchange_rate=Decimal("1.25"), shares_sold=Decimal("0"), net_shares=Decimal("100")))
+        for i in range(4):
+            session.add(SaleInput(date=date(2020, 2, 1) + timedelta(days=60 * i), shares_sold=Decimal("70"),
+                                  sale_price_usd=Decimal("18"), exchange_rate=Decimal("1.3")))
+        session.commit()
+        recalc_all()
+        stored = [(r.sale_input_id, r.matching_type, r.matched_shares, r.gain_gbp) for r in DisposalResult.query.order_by(DisposalResult.id)]
+        sales = [SaleRecord.from_row(s) for s in SaleInput.query.order_by(SaleInput.date, SaleInput.id)]
+        result = engine_from_db().run(sales)
+        assert [(d.sale_id, d.matching_type, d.matched_shares, d.gain_gbp) for d in result.disposals] == stored